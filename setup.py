@@ -17,7 +17,8 @@ setup(
     author="Nicholas H.Tollervey",
     author_email="ntoll@ntoll.org",
     url="https://github.com/ntoll/uflash",
-    py_modules=["uflash", "py2hex"],
+    packages=["uflash"],
+    package_data={"uflash": ["firmware.bin"]},
     license="MIT",
     classifiers=[
         "Development Status :: 4 - Beta",
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the uflash benchmarks.
+"""
+import json
+import os
+
+import pytest
+import uflash
+from uflash import bench
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+def test_make_script():
+    """
+    The generated scripts have the requested size.
+    """
+    for size in (0, 1, 1024, 8192):
+        assert len(bench.make_script(size)) == size
+
+
+def test_max_script_size():
+    """
+    The maximum script size is the largest script_to_fs accepts.
+    """
+    for version_id in (uflash._MICROBIT_ID_V1, uflash._MICROBIT_ID_V2):
+        size = bench.max_script_size(version_id)
+        assert uflash.script_to_fs(bench.make_script(size), version_id)
+        with pytest.raises(ValueError):
+            uflash.script_to_fs(bench.make_script(size + 1), version_id)
+    with pytest.raises(ValueError):
+        bench.max_script_size("1234")
+
+
+def test_median_percentile():
+    """
+    The median and percentiles are computed from the values in any order.
+    """
+    assert bench.median([3, 1, 2]) == 2
+    assert bench.median([4, 1, 3, 2]) == 2.5
+    values = list(range(100, 0, -1))
+    assert bench.percentile(values, 95) == 95
+    assert bench.percentile(values, 100) == 100
+    assert bench.percentile(values, 0) == 1
+    assert bench.percentile([7], 95) == 7
+
+
+@pytest.mark.skipif(
+    bench.tracemalloc is None, reason="tracemalloc is not available"
+)
+def test_peak_memory():
+    """
+    The peak memory allocated during the call is measured.
+    """
+    assert bench.peak_memory(lambda: bytearray(1000000)) >= 1000000
+    assert bench.peak_memory(lambda: None) < 1000000
+
+
+def test_measure():
+    """
+    The function is called once to warm up, repeat times number of times to
+    take the samples, and once more for the peak memory.
+    """
+    calls = []
+    with mock.patch("uflash.bench.peak_memory", return_value=42):
+        result = bench.measure(lambda: calls.append(1), repeat=3, number=2)
+    assert len(calls) == 1 + 3 * 2
+    assert len(result["samples"]) == 3
+    assert result["median"] == bench.median(result["samples"])
+    assert result["p95"] == max(result["samples"])
+    assert result["peak_memory"] == 42
+
+
+def test_bench_import():
+    """
+    Importing uflash is timed in new Python processes.
+    """
+    ((name, result),) = bench.bench_import(repeat=2)
+    assert name == "import uflash"
+    assert len(result["samples"]) == 2
+    assert 0 < result["median"] < 10
+    assert result["peak_memory"] > 0
+
+
+def test_bench_script_to_fs():
+    """
+    The script_to_fs benchmark covers 3 script sizes for V1 and V2.
+    """
+    with mock.patch(
+        "uflash.bench.measure", return_value="result"
+    ) as mock_measure:
+        results = bench.bench_script_to_fs()
+
+    assert len(results) == 6
+    assert mock_measure.call_count == 6
+    assert results[0] == ("script_to_fs V1 1 KB (1024 bytes)", "result")
+    assert results[-1] == ("script_to_fs V2 max (20150 bytes)", "result")
+
+
+def test_bench_stages(tmpdir):
+    """
+    All the pipeline stages are measured, with real calls.
+    """
+    with mock.patch("uflash.bench.peak_memory", return_value=0):
+        results = (
+            bench.bench_bytes_to_ihex(1)
+            + bench.bench_pad_hex_string(1)
+            + bench.bench_embed_fs_uhex(1)
+            + bench.bench_save_hex(str(tmpdir), 1)
+            + bench.bench_py2hex(str(tmpdir), 1)
+        )
+    assert [name for name, _ in results] == [
+        "bytes_to_ihex Intel Hex (1024 bytes)",
+        "bytes_to_ihex Intel Hex (32768 bytes)",
+        "bytes_to_ihex Universal Hex (1024 bytes)",
+        "bytes_to_ihex Universal Hex (32768 bytes)",
+        "pad_hex_string (1024 bytes)",
+        "pad_hex_string (27206 bytes)",
+        "embed_fs_uhex (1024 bytes)",
+        "embed_fs_uhex (20150 bytes)",
+        "save_hex (str)",
+        "save_hex (chunks)",
+        "save_hex (low memory)",
+        "py2hex corpus (5 scripts)",
+    ]
+    assert all(result["median"] > 0 for _, result in results)
+    assert tmpdir.join("script_20150.hex").check()
+
+
+def test_run(tmpdir):
+    """
+    Only the benchmarks asked for are run, in a temporary directory that is
+    then removed, and the in-process hex cache is restored afterwards.
+    """
+    uflash.cache_configure(max_entries=5)
+    try:
+        with mock.patch(
+            "uflash.bench.measure", return_value="result"
+        ), mock.patch("uflash.bench.bench_import") as mock_import:
+            report = bench.run(
+                1, str(tmpdir), ["save_hex", "script_to_fs V1 max"]
+            )
+        assert uflash.cache_info()["max_entries"] == 5
+    finally:
+        uflash.cache_configure(max_entries=32)
+    assert mock_import.call_count == 0
+    assert report["uflash"] == uflash.get_version()
+    assert report["benchmarks"] == {
+        "save_hex (str)": "result",
+        "save_hex (chunks)": "result",
+        "save_hex (low memory)": "result",
+        "script_to_fs V1 max (27206 bytes)": "result",
+    }
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_default_directory():
+    """
+    The benchmark files go in a tmpfs if there's one.
+    """
+    with mock.patch("os.path.isdir", return_value=True), mock.patch(
+        "os.access", return_value=True
+    ):
+        assert bench.default_directory() == "/dev/shm"
+    with mock.patch("os.path.isdir", return_value=False):
+        assert bench.default_directory() == bench.tempfile.gettempdir()
+
+
+def test_main(capsys, tmpdir):
+    """
+    The benchmark report is printed (or written to a file) as JSON.
+    """
+    report = {"benchmarks": {"foo": {"median": 0.001}}}
+    with mock.patch("uflash.bench.run", return_value=report) as mock_run:
+        bench.main(["-r", "3", "script_to_fs"])
+        bench.main(["-o", str(tmpdir.join("report.json")), "-d", "/tmp"])
+
+    stdout, _ = capsys.readouterr()
+    assert json.loads(stdout) == report
+    assert json.loads(tmpdir.join("report.json").read()) == report
+    assert mock_run.call_args_list == [
+        mock.call(3, None, ["script_to_fs"]),
+        mock.call(20, "/tmp", []),
+    ]
+
+
+def test_mann_whitney_u():
+    """
+    The p-value is small when the current samples are clearly larger, and
+    large otherwise.
+    """
+    baseline = [1.0, 1.1, 0.9, 1.05, 0.95, 1.02, 0.98, 1.01]
+    slower = [value * 1.5 for value in baseline]
+    assert bench.mann_whitney_u(baseline, slower) < 0.001
+    assert bench.mann_whitney_u(slower, baseline) > 0.999
+    assert 0.4 < bench.mann_whitney_u(baseline, baseline) < 0.6
+    # A hand-worked example: U = 4, mean 2, variance 5/3, so z = 1.1619.
+    p_value = bench.mann_whitney_u([1, 2], [3, 4])
+    assert abs(p_value - 0.1226) < 0.0001
+    # All tied, or no samples, is no evidence of a difference.
+    assert bench.mann_whitney_u([1, 1, 1], [1, 1, 1]) == 1.0
+    assert bench.mann_whitney_u([], [1]) == 1.0
+
+
+def make_result(samples, peak_memory=1000):
+    """
+    Returns a benchmark result with the given samples.
+    """
+    return bench.summarise(samples, peak_memory)
+
+
+def test_compare():
+    """
+    A benchmark regressed if it's significantly slower by more than the
+    threshold, or uses more than threshold extra memory.
+    """
+    samples = [1.0, 1.1, 0.9, 1.05, 0.95, 1.02, 0.98, 1.01]
+    baseline = {
+        "benchmarks": {
+            "same": make_result(samples),
+            "slower": make_result(samples),
+            "a bit slower": make_result(samples),
+            "bigger": make_result(samples),
+            "missing": make_result(samples),
+        }
+    }
+    report = {
+        "benchmarks": {
+            "same": make_result(samples),
+            "slower": make_result([s * 1.5 for s in samples]),
+            "a bit slower": make_result([s * 1.05 for s in samples]),
+            "bigger": make_result(samples, 2000),
+            "new": make_result(samples),
+        }
+    }
+    comparisons = bench.compare(baseline, report)
+    assert [(c[0], c[4]) for c in comparisons] == [
+        ("a bit slower", []),
+        ("bigger", ["memory"]),
+        ("missing", []),
+        ("same", []),
+        ("slower", ["time"]),
+    ]
+    assert comparisons[2][2] is None
+    comparisons = bench.compare(baseline, report, threshold=0.01, alpha=0.1)
+    assert comparisons[0][4] == ["time"]
+    comparisons = bench.compare(baseline, report, threshold=0.01, alpha=0)
+    assert comparisons[0][4] == []
+
+
+def test_print_comparison(capsys):
+    """
+    Each comparison is printed, returning True if anything regressed or is
+    missing.
+    """
+    result = make_result([0.001, 0.001])
+    slower = make_result([0.002, 0.002])
+    assert not bench.print_comparison([("foo", result, result, 0.5, [])])
+    assert bench.print_comparison(
+        [("foo", result, slower, 0.001, ["time", "memory"])]
+    )
+    assert bench.print_comparison([("bar", result, None, None, [])])
+    stdout, _ = capsys.readouterr()
+    lines = stdout.splitlines()
+    assert lines[0].startswith("foo ")
+    assert lines[0].endswith("1.000 ms ->     1.000 ms ( +0.0%, p=0.500) ok")
+    assert lines[1].endswith("(+100.0%, p=0.001) TIME MEMORY")
+    assert lines[2].endswith("MISSING")
+
+
+def test_main_compare(capsys, tmpdir):
+    """
+    Comparing against a baseline runs the benchmarks in it (or those of them
+    asked for), and exits with an error if any regressed.
+    """
+    samples = [0.001, 0.0011, 0.0009, 0.00105, 0.00095, 0.00102]
+    baseline = {
+        "benchmarks": {
+            "save_hex (str)": make_result(samples),
+            "script_to_fs V1 1 KB": make_result(samples),
+        }
+    }
+    tmpdir.join("baseline.json").write(json.dumps(baseline))
+    argv = ["--compare", str(tmpdir.join("baseline.json"))]
+    with mock.patch("uflash.bench.run", return_value=baseline) as mock_run:
+        bench.main(argv)
+        bench.main(argv + ["save_hex"])
+    assert mock_run.call_args_list == [
+        mock.call(20, None, ["save_hex (str)", "script_to_fs V1 1 KB"]),
+        mock.call(20, None, ["save_hex (str)"]),
+    ]
+    stdout, _ = capsys.readouterr()
+    assert stdout.count(" ok\n") == 3
+    slower = {
+        "benchmarks": {
+            "save_hex (str)": make_result([s * 2 for s in samples]),
+            "script_to_fs V1 1 KB": make_result(samples),
+        }
+    }
+    with mock.patch("uflash.bench.run", return_value=slower):
+        with pytest.raises(SystemExit) as ex:
+            bench.main(argv + ["-o", str(tmpdir.join("report.json"))])
+    assert ex.value.code == 1
+    assert json.loads(tmpdir.join("report.json").read()) == slower
+    stdout, _ = capsys.readouterr()
+    assert "TIME" in stdout
+    with mock.patch("uflash.bench.run", return_value=slower):
+        bench.main(argv + ["-t", "1.5"])
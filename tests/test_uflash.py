@@ -2,9 +2,14 @@
 """
 Tests for the uflash module.
 """
+import binascii
 import ctypes
+import hashlib
+import json
 import os
 import os.path
+import select
+import subprocess
 import sys
 import tempfile
 import time
@@ -24,6 +29,9 @@ else:
         import mock
 
 
+RUNTIME_SHA = (
+    "443e179a8d0ce655c5b9c7e8ed0ea4e89f64a0444e0af330c09f87d7cc74c0e2"
+)
 TEST_SCRIPT = b"""from microbit import *
 
 display.scroll('Hello, World!')
@@ -140,6 +148,33 @@ TEST_UHEX_V1_INSERTION_INDEX = 11
 TEST_UHEX_V2_INSERTION_INDEX = 20
 
 
+@pytest.fixture(autouse=True)
+def clear_hex_cache():
+    """
+    Each test starts with an empty in-process hex cache.
+    """
+    uflash.cache_clear()
+    yield
+    uflash.cache_clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_microbits_cache():
+    """
+    Each test starts without any cached micro:bit devices.
+    """
+    uflash._MICROBITS_CACHE.clear()
+    yield
+    uflash._MICROBITS_CACHE.clear()
+
+
+def join_chunks(chunks):
+    """
+    Returns the hex string formed by a list of bytes-like hex chunks.
+    """
+    return b"".join(memoryview(c).tobytes() for c in chunks).decode("ascii")
+
+
 def test_get_version():
     """
     Ensure a call to get_version returns the expected string.
@@ -148,6 +183,140 @@ def test_get_version():
     assert result == ".".join([str(i) for i in uflash._VERSION])
 
 
+def test_get_runtime():
+    """
+    Ensure the runtime is generated from the bundled image and then reused.
+    """
+    with mock.patch.dict(uflash.__dict__):
+        uflash.__dict__.pop("_RUNTIME", None)
+        runtime = uflash.get_runtime()
+        assert uflash.get_runtime() is runtime
+        assert uflash._RUNTIME is runtime
+    assert runtime.startswith(":020000040000FA\n:0400000A9900")
+    assert runtime.endswith(":00000001FF\n")
+    assert hashlib.sha256(runtime.encode("ascii")).hexdigest() == RUNTIME_SHA
+
+
+def test_get_runtime_not_loaded_on_import():
+    """
+    Importing uflash should not load the runtime until it is needed.
+    """
+    with mock.patch.dict(uflash.__dict__, {"_RUNTIME_HEX": None}):
+        uflash.__dict__.pop("_RUNTIME", None)
+        with mock.patch("uflash._load_runtime_image") as mock_load, mock.patch(
+            "uflash._runtime_image_to_hex", return_value=b"runtime"
+        ):
+            assert "_RUNTIME" not in uflash.__dict__
+            assert uflash._RUNTIME == "runtime"
+            assert mock_load.call_count == 1
+            assert uflash.get_runtime() == "runtime"
+            assert mock_load.call_count == 1
+            mock_load.assert_called_once_with(uflash._RUNTIME_PATH)
+
+
+def test_import_does_not_load_optional_modules():
+    """
+    Importing uflash doesn't import the modules only some features need, as
+    they slow it down (for example, uflash --version).
+    """
+    optional = [
+        "concurrent.futures",
+        "fnmatch",
+        "glob",
+        "hashlib",
+        "json",
+        "tempfile",
+    ]
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            "-c",
+            "import sys, uflash; "
+            "print(' '.join(m for m in sys.argv[1:] if m in sys.modules))",
+        ]
+        + optional,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(uflash.__file__))),
+    )
+    assert output.split() == []
+
+
+def test_pack_runtime_image():
+    """
+    A Universal Hex packed into a runtime image is serialised back into the
+    exact same records, with the data records stored as binary segments.
+    """
+    uhex = "\n".join(TEST_UNIVERSAL_HEX_LIST)
+    image = uflash._pack_runtime_image(uhex)
+
+    assert image.startswith(uflash._RUNTIME_IMAGE_MAGIC)
+    assert len(image) < len(uhex) // 2
+    result = uflash._runtime_image_to_hex(memoryview(image))
+    assert result == uhex.encode("ascii")
+
+
+def test_pack_runtime_image_bundled():
+    """
+    The bundled runtime image is identical to packing its own hex.
+    """
+    runtime = uflash.get_runtime()
+    with open(uflash._RUNTIME_PATH, "rb") as image_file:
+        assert uflash._pack_runtime_image(runtime) == image_file.read()
+
+
+def test_pack_runtime_image_not_lossless():
+    """
+    Hex records that would not be reproduced byte by byte raise a ValueError.
+    """
+    uhex = "\n".join(TEST_UNIVERSAL_HEX_LIST).lower()
+
+    with pytest.raises(ValueError) as ex:
+        uflash._pack_runtime_image(uhex)
+    assert ex.value.args[0] == "The hex records cannot be packed losslessly."
+
+
+def test_load_runtime_image():
+    """
+    The runtime image is loaded as a memoryview, checking its format.
+    """
+    image = uflash._load_runtime_image(uflash._RUNTIME_PATH)
+    assert isinstance(image, memoryview)
+    assert image[:5].tobytes() == uflash._RUNTIME_IMAGE_MAGIC
+
+    path = os.path.join(tempfile.gettempdir(), "not_a_runtime.bin")
+    with open(path, "wb") as image_file:
+        image_file.write(b":020000040000FA\n")
+    with pytest.raises(ValueError) as ex:
+        uflash._load_runtime_image(path)
+    assert "Unknown runtime image format" in ex.value.args[0]
+
+
+def test_runtime_image_to_hex_corrupted():
+    """
+    An unknown entry in the runtime image raises a ValueError.
+    """
+    image = memoryview(uflash._RUNTIME_IMAGE_MAGIC + b"\xff")
+
+    with pytest.raises(ValueError) as ex:
+        uflash._runtime_image_to_hex(image)
+    assert ex.value.args[0] == "Corrupted runtime image."
+
+
+def test_data_records_to_hex():
+    """
+    The records generated in bulk match the ones from bytes_to_ihex.
+    """
+    data = bytes(bytearray(range(256))) + b"tail"
+    for record_type in (0x00, 0x0D):
+        expected = uflash.bytes_to_ihex(0x38C10, data, record_type == 0x0D)
+        expected = "\n".join(expected.split("\n")[1:]) + "\n"
+
+        result = uflash._data_records_to_hex(0x8C10, record_type, data)
+
+        assert result == expected.encode("ascii")
+    assert uflash._data_records_to_hex(0, 0, b"") == b""
+    assert uflash._data_records_to_hex(0, 0, b"\x01", 16) == b":0100000001FE\n"
+
+
 def test_unhexlify():
     """
     Ensure that we can get the script back out using unhexlify and that the
@@ -252,11 +421,36 @@ def test_find_microbit_posix_exists():
     """
     with open("tests/mount_exists.txt", "rb") as fixture_file:
         fixture = fixture_file.read()
-        with mock.patch("os.name", "posix"):
+        with mock.patch("os.name", "posix"), mock.patch(
+            "uflash._MOUNTINFO_PATH", "tests/does_not_exist.txt"
+        ):
             with mock.patch("uflash.check_output", return_value=fixture):
                 assert uflash.find_microbit() == "/media/ntoll/MICROBIT"
 
 
+def test_find_microbit_posix_numbered():
+    """
+    Simulate being on OSX, where a call to "mount" lists two micro:bit
+    devices, the second labelled with a counter after a space, alongside
+    volumes that only look a bit like micro:bits.
+    """
+    fixture = (
+        b"/dev/disk1s1 on / (apfs, local, journaled)\n"
+        b"/dev/disk2 on /Volumes/MICROBIT (msdos, local, nodev, nosuid)\n"
+        b"/dev/disk3 on /Volumes/MICROBIT 1 (msdos, local, nodev, nosuid)\n"
+        b"/dev/disk4 on /Volumes/NOT MICROBITS (msdos, local, nodev)\n"
+        b"/dev/disk5 on /Volumes/MYMICROBIT (msdos, local, nodev)\n"
+    )
+    with mock.patch("os.name", "posix"), mock.patch(
+        "uflash._MOUNTINFO_PATH", "tests/does_not_exist.txt"
+    ):
+        with mock.patch("uflash.check_output", return_value=fixture):
+            assert uflash._find_microbit_volumes() == [
+                "/Volumes/MICROBIT",
+                "/Volumes/MICROBIT 1",
+            ]
+
+
 def test_find_microbit_posix_missing():
     """
     Simulate being on os.name == 'posix' and a call to "mount" returns a
@@ -264,11 +458,204 @@ def test_find_microbit_posix_missing():
     """
     with open("tests/mount_missing.txt", "rb") as fixture_file:
         fixture = fixture_file.read()
-        with mock.patch("os.name", "posix"):
+        with mock.patch("os.name", "posix"), mock.patch(
+            "uflash._MOUNTINFO_PATH", "tests/does_not_exist.txt"
+        ):
             with mock.patch("uflash.check_output", return_value=fixture):
                 assert uflash.find_microbit() is None
 
 
+def test_find_microbit_mountinfo_exists():
+    """
+    Simulate being on Linux, where the mount table lists two micro:bit
+    devices (the second labelled with a counter), without calling "mount".
+    """
+    with mock.patch("os.name", "posix"), mock.patch(
+        "uflash._MOUNTINFO_PATH", "tests/mountinfo_exists.txt"
+    ), mock.patch("uflash.check_output") as mock_check_output:
+        assert uflash.find_microbit() == "/media/ntoll/MICROBIT"
+        assert uflash._find_microbit_volumes() == [
+            "/media/ntoll/MICROBIT",
+            "/media/ntoll/MICROBIT1",
+        ]
+    assert mock_check_output.call_count == 0
+
+
+def test_find_microbit_mountinfo_missing():
+    """
+    Simulate being on Linux, where the mount table has no micro:bit devices.
+    """
+    with mock.patch("os.name", "posix"), mock.patch(
+        "uflash._MOUNTINFO_PATH", "tests/mountinfo_missing.txt"
+    ), mock.patch("uflash.check_output") as mock_check_output:
+        assert uflash.find_microbit() is None
+    assert mock_check_output.call_count == 0
+
+
+def test_mountinfo_volumes():
+    """
+    The mount points in the mount table are unescaped.
+    """
+    with mock.patch("uflash._MOUNTINFO_PATH", "tests/mountinfo_missing.txt"):
+        assert uflash._mountinfo_volumes() == [
+            b"/proc",
+            b"/sys",
+            b"/dev",
+            b"/",
+            b"/media/ntoll/USB STICK",
+        ]
+    with mock.patch("uflash._MOUNTINFO_PATH", "tests/does_not_exist.txt"):
+        assert uflash._mountinfo_volumes() is None
+
+
+def make_microbits(tmpdir, details):
+    """
+    Creates a mount table listing a micro:bit in tmpdir for each of the given
+    DETAILS.TXT contents (None to leave it out). Returns the mount table path
+    and the micro:bit paths.
+    """
+    paths = []
+    lines = ["23 28 0:22 / /proc rw,relatime - proc proc rw"]
+    for i, text in enumerate(details):
+        volume = tmpdir.mkdir("mb{}".format(i)).mkdir("MICROBIT")
+        if text is not None:
+            volume.join("DETAILS.TXT").write(text)
+        paths.append(str(volume))
+        lines.append(
+            "147 28 8:17 / {} rw - vfat /dev/sdb rw".format(
+                str(volume).replace(" ", "\\040")
+            )
+        )
+    mountinfo = tmpdir.join("mountinfo")
+    mountinfo.write("\n".join(lines) + "\n")
+    return str(mountinfo), paths
+
+
+def test_find_all_microbits(tmpdir):
+    """
+    Every micro:bit in the mount table is found, with the device ID and board
+    version from its DETAILS.TXT file (when there is one).
+    """
+    mountinfo, paths = make_microbits(
+        tmpdir,
+        [
+            "# DAPLink Firmware - see https://mbed.com/daplink\n"
+            "Unique ID: 9900000037024e450034200b0000002b0000000097969901\n"
+            "HIC ID: 97969901\n",
+            "Unique ID: 9904360250144e45002b600e000000270000000097969901\n",
+            "Version: 0249\n",
+            None,
+        ],
+    )
+    with mock.patch("os.name", "posix"), mock.patch(
+        "uflash._MOUNTINFO_PATH", mountinfo
+    ):
+        assert uflash.find_all_microbits() == [
+            uflash.Microbit(
+                paths[0], "9900000037024e450034200b0000002b0000000097969901", 1
+            ),
+            uflash.Microbit(
+                paths[1], "9904360250144e45002b600e000000270000000097969901", 2
+            ),
+            uflash.Microbit(paths[2], None, None),
+            uflash.Microbit(paths[3], None, None),
+        ]
+        assert uflash.find_microbit() == paths[0]
+
+
+def test_find_all_microbits_unknown_board(tmpdir):
+    """
+    A device ID that isn't from a known micro:bit board has no version.
+    """
+    mountinfo, paths = make_microbits(tmpdir, ["Unique ID: 1234abcd\n"])
+    with mock.patch("os.name", "posix"), mock.patch(
+        "uflash._MOUNTINFO_PATH", mountinfo
+    ):
+        assert uflash.find_all_microbits() == [
+            uflash.Microbit(paths[0], "1234abcd", None)
+        ]
+
+
+def test_find_all_microbits_cached(tmpdir):
+    """
+    The micro:bits found are cached until the mount table watcher reports a
+    change, and the cached list can't be changed by the caller.
+    """
+    mountinfo, paths = make_microbits(tmpdir, [None])
+    with mock.patch("os.name", "posix"), mock.patch(
+        "uflash._MOUNTINFO_PATH", mountinfo
+    ), mock.patch(
+        "uflash._find_microbit_volumes", wraps=uflash._find_microbit_volumes
+    ) as mock_volumes:
+        microbits = uflash.find_all_microbits()
+        microbits.append("foo")
+        assert uflash.find_all_microbits() == [
+            uflash.Microbit(paths[0], None, None)
+        ]
+        assert uflash.find_microbit() == paths[0]
+        assert mock_volumes.call_count == 1
+        # Simulate the kernel flagging a change to the mount table.
+        mock_poll = mock.MagicMock()
+        mock_poll.poll.return_value = [(3, select.POLLPRI | select.POLLERR)]
+        uflash._MICROBITS_CACHE["watcher"] = (None, mock_poll)
+        assert uflash.find_microbit() == paths[0]
+        assert mock_volumes.call_count == 2
+        # The change was only reported once, but the stale list was dropped.
+        mock_poll.poll.return_value = []
+        assert uflash.find_all_microbits() == [
+            uflash.Microbit(paths[0], None, None)
+        ]
+        assert mock_volumes.call_count == 3
+
+
+def test_find_microbit_skips_details(tmpdir):
+    """
+    Finding a single micro:bit doesn't read DETAILS.TXT from the devices
+    unless they have already been cached.
+    """
+    mountinfo, paths = make_microbits(tmpdir, [None, None])
+    with mock.patch("os.name", "posix"), mock.patch(
+        "uflash._MOUNTINFO_PATH", mountinfo
+    ), mock.patch(
+        "uflash._microbit_details", return_value=(None, None)
+    ) as mock_details:
+        assert uflash.find_microbit() == paths[0]
+        assert mock_details.call_count == 0
+        assert len(uflash.find_all_microbits()) == 2
+        assert uflash.find_microbit() == paths[0]
+        assert mock_details.call_count == 2
+
+
+def test_find_all_microbits_not_cached():
+    """
+    Without a way to watch the mount table, every call looks for the
+    micro:bits again.
+    """
+    with mock.patch(
+        "uflash._MOUNTINFO_PATH", "tests/does_not_exist.txt"
+    ), mock.patch(
+        "uflash._find_microbit_volumes", return_value=[]
+    ) as mock_volumes:
+        assert uflash.find_all_microbits() == []
+        assert uflash.find_all_microbits() == []
+        assert uflash._MICROBITS_CACHE == {"watcher": None}
+        assert mock_volumes.call_count == 2
+
+
+def test_mount_table_watcher():
+    """
+    The mount table watcher is only available where the mount table and poll
+    are.
+    """
+    with mock.patch("uflash._MOUNTINFO_PATH", "tests/mountinfo_missing.txt"):
+        mountinfo, watcher = uflash._mount_table_watcher()
+        mountinfo.close()
+        with mock.patch("uflash.select", spec=[]):
+            assert uflash._mount_table_watcher() is None
+    with mock.patch("uflash._MOUNTINFO_PATH", "tests/does_not_exist.txt"):
+        assert uflash._mount_table_watcher() is None
+
+
 def test_find_microbit_nt_exists():
     """
     Simulate being on os.name == 'nt' and a disk with a volume name 'MICROBIT'
@@ -373,6 +760,41 @@ def test_save_hex():
         assert written_file.read() == hex_file
 
 
+def test_save_hex_chunks():
+    """
+    Ensure a list of bytes-like hex chunks is written in order.
+    """
+    path_to_hex = os.path.join(tempfile.gettempdir(), "microbit.hex")
+    runtime = uflash._get_runtime_hex()
+    chunks = uflash._embed_fs_uhex_chunks(runtime, TEST_SCRIPT)
+
+    uflash.save_hex(chunks, path_to_hex)
+
+    with open(path_to_hex) as written_file:
+        assert written_file.read() == uflash.embed_fs_uhex(
+            uflash.get_runtime(), TEST_SCRIPT
+        )
+
+
+def test_write_chunks_partial_writes():
+    """
+    Partially written chunks are continued until everything is written, also
+    when os.writev is not available.
+    """
+    chunks = [b"abc", memoryview(b"0123456789")[2:8], b"", b"xyz"]
+
+    def partial_writev(fd, buffers):
+        return os.write(fd, buffers[0][:2])
+
+    for writev in (partial_writev, None):
+        path = os.path.join(tempfile.gettempdir(), "chunks.hex")
+        with mock.patch("os.writev", writev, create=True):
+            with open(path, "wb") as output:
+                uflash._write_chunks(output.fileno(), chunks)
+        with open(path, "rb") as written_file:
+            assert written_file.read() == b"abc234567xyz"
+
+
 def test_save_hex_no_hex():
     """
     The function raises a ValueError if no hex content is provided.
@@ -403,7 +825,7 @@ def test_flash_no_args():
         with mock.patch("uflash.save_hex") as mock_save:
             uflash.flash()
             assert mock_save.call_count == 1
-            assert mock_save.call_args[0][0] == uflash._RUNTIME
+            assert join_chunks(mock_save.call_args[0][0]) == uflash._RUNTIME
             expected_path = os.path.join("foo", "micropython.hex")
             assert mock_save.call_args[0][1] == expected_path
 
@@ -424,7 +846,7 @@ def test_flash_has_python_no_path_to_microbit():
                 py_code = py_file.read()
             assert py_code
             expected_hex = uflash.embed_fs_uhex(uflash._RUNTIME, py_code)
-            assert mock_save.call_args[0][0] == expected_hex
+            assert join_chunks(mock_save.call_args[0][0]) == expected_hex
             expected_path = os.path.join("foo", "micropython.hex")
             assert mock_save.call_args[0][1] == expected_path
 
@@ -443,15 +865,91 @@ def test_flash_with_path_to_multiple_microbits():
         assert py_code
         expected_hex = uflash.embed_fs_uhex(uflash._RUNTIME, py_code)
 
-        assert mock_save.call_args_list[0][0][0] == expected_hex
+        assert join_chunks(mock_save.call_args_list[0][0][0]) == expected_hex
         expected_path = os.path.join("test_path1", "micropython.hex")
         assert mock_save.call_args_list[0][0][1] == expected_path
 
-        assert mock_save.call_args_list[1][0][0] == expected_hex
+        assert join_chunks(mock_save.call_args_list[1][0][0]) == expected_hex
         expected_path = os.path.join("test_path2", "micropython.hex")
         assert mock_save.call_args_list[1][0][1] == expected_path
 
 
+def test_flash_in_parallel():
+    """
+    Flashing several micro:bits at the same time writes the same hex chunks
+    to each of them and returns the paths written.
+    """
+    paths = ["test_path{}".format(i) for i in range(5)]
+    with mock.patch("uflash.save_hex") as mock_save:
+        result = uflash.flash("tests/example.py", paths, max_workers=3)
+
+    expected_paths = [os.path.join(p, "micropython.hex") for p in paths]
+    assert result == expected_paths
+    assert mock_save.call_count == 5
+    assert sorted(c[0][1] for c in mock_save.call_args_list) == expected_paths
+    hex_chunks = mock_save.call_args_list[0][0][0]
+    for call in mock_save.call_args_list:
+        assert call[0][0] is hex_chunks
+
+
+def test_read_script(tmpdir):
+    """
+    Python scripts are read as bytes, and must have a .py extension.
+    """
+    tmpdir.join("a.py").write_binary(b"print('a')\r\n")
+    assert uflash._read_script(str(tmpdir.join("a.py"))) == b"print('a')\r\n"
+    with pytest.raises(ValueError):
+        uflash._read_script(str(tmpdir.join("a.txt")))
+
+
+def test_raise_flash_errors():
+    """
+    The error of a single device is raised as is, the errors of several as a
+    FlashError, and nothing is raised without errors.
+    """
+    error = IOError("boom")
+    uflash._raise_flash_errors(["a.hex"], {})
+    with pytest.raises(IOError) as ex:
+        uflash._raise_flash_errors(["a.hex"], {"a.hex": error})
+    assert ex.value is error
+    with pytest.raises(uflash.FlashError) as ex:
+        uflash._raise_flash_errors(["a.hex", "b.hex"], {"b.hex": error})
+    assert ex.value.errors == {"b.hex": error}
+
+
+def test_flash_errors_dont_stop_other_devices():
+    """
+    A micro:bit failing to flash doesn't stop the rest, and a FlashError with
+    all the failures is raised at the end.
+    """
+    paths = ["test_path1", "bad1", "test_path2", "bad2"]
+    bad_paths = [os.path.join(p, "micropython.hex") for p in paths[1::2]]
+
+    def save_hex(hex_file, path):
+        if path in bad_paths:
+            raise IOError("boom " + path)
+
+    for workers in (1, 4):
+        with mock.patch("uflash.save_hex", side_effect=save_hex) as mock_save:
+            with pytest.raises(uflash.FlashError) as ex:
+                uflash.flash("tests/example.py", paths, max_workers=workers)
+        assert mock_save.call_count == 4
+        assert sorted(ex.value.errors) == bad_paths
+        assert str(ex.value.errors[bad_paths[0]]) == "boom " + bad_paths[0]
+        assert isinstance(ex.value, IOError)
+        assert "Unable to flash 2 of the micro:bits: " in str(ex.value)
+
+
+def test_flash_single_device_error():
+    """
+    When flashing a single micro:bit its original exception is raised.
+    """
+    with mock.patch("uflash.save_hex", side_effect=ValueError("boom")):
+        with pytest.raises(ValueError) as ex:
+            uflash.flash("tests/example.py", ["test_path"])
+    assert ex.value.args[0] == "boom"
+
+
 def test_flash_with_path_to_microbit():
     """
     Flash the referenced path to the micro:bit with a hex file generated from
@@ -465,7 +963,7 @@ def test_flash_with_path_to_microbit():
             py_code = py_file.read()
         assert py_code
         expected_hex = uflash.embed_fs_uhex(uflash._RUNTIME, py_code)
-        assert mock_save.call_args[0][0] == expected_hex
+        assert join_chunks(mock_save.call_args[0][0]) == expected_hex
         expected_path = os.path.join("test_path", "micropython.hex")
         assert mock_save.call_args[0][1] == expected_path
 
@@ -484,11 +982,262 @@ def test_flash_with_keepname():
             py_code = py_file.read()
         assert py_code
         expected_hex = uflash.embed_fs_uhex(uflash._RUNTIME, py_code)
-        assert mock_save.call_args[0][0] == expected_hex
+        assert join_chunks(mock_save.call_args[0][0]) == expected_hex
         expected_path = os.path.join("test_path", "example.hex")
         assert mock_save.call_args[0][1] == expected_path
 
 
+def test_timing_callbacks(tmpdir):
+    """
+    Timing callbacks are called with the name and duration of each stage of
+    flashing, until they are removed.
+    """
+    tmpdir.join("a.py").write("print('a')\n")
+    timings = []
+
+    def callback(stage, duration):
+        timings.append((stage, duration))
+
+    uflash.add_timing_callback(callback)
+    try:
+        with mock.patch("uflash.find_microbit", return_value=str(tmpdir)):
+            uflash.flash(str(tmpdir.join("a.py")))
+    finally:
+        uflash.remove_timing_callback(callback)
+    assert [stage for stage, _ in timings] == [
+        "read_script",
+        "script_to_fs",
+        "embed_fs_uhex",
+        "encode",
+        "script_to_fs",
+        "embed_fs_uhex",
+        "encode",
+        "embed_fs_uhex",
+        "find_microbit",
+        "write",
+        "fsync",
+    ]
+    assert all(duration >= 0 for _, duration in timings)
+    del timings[:]
+    uflash.save_hex("foo", str(tmpdir.join("b.hex")))
+    assert timings == []
+
+
+def test_span_without_observers():
+    """
+    Without observers the stages aren't timed at all.
+    """
+    assert uflash._span("write") is uflash._NO_SPAN
+    with mock.patch("uflash._OBSERVERS", [mock.MagicMock()]):
+        assert isinstance(uflash._span("write"), uflash._Span)
+
+
+def test_save_hex_timings(tmpdir):
+    """
+    Saving a hex string times its encoding as well as writing it out.
+    """
+    callback = mock.MagicMock()
+    with mock.patch("uflash._OBSERVERS", []):
+        uflash.add_timing_callback(callback)
+        uflash.save_hex("foo", str(tmpdir.join("a.hex")))
+    assert [call[0][0] for call in callback.call_args_list] == [
+        "encode",
+        "write",
+        "fsync",
+    ]
+
+
+def test_observers(tmpdir):
+    """
+    Observers registered with add_observer are called with the events of
+    every flash, including cache hits and the bytes written to each device.
+    """
+    tmpdir.join("a.py").write("print('a')\n")
+    devices = [str(tmpdir.mkdir("one")), str(tmpdir.mkdir("two"))]
+    events = []
+
+    def observer(event, data):
+        events.append((event, data))
+
+    uflash.add_observer(observer)
+    try:
+        uflash.flash(str(tmpdir.join("a.py")), devices)
+        uflash.flash(str(tmpdir.join("a.py")), devices[:1])
+    finally:
+        uflash.remove_observer(observer)
+    assert uflash._OBSERVERS == []
+    names = [event for event, _ in events]
+    assert names.count("cache_miss") == 1
+    assert names.count("cache_hit") == 1
+    assert names.index("cache_miss") < names.index("cache_hit")
+    assert ("cache_hit", {"cache": "memory"}) in events
+    hex_paths = [os.path.join(device, "micropython.hex") for device in devices]
+    hex_size = os.path.getsize(hex_paths[0])
+    writes = [data for event, data in events if event == "write"]
+    assert writes == [
+        {"path": hex_paths[0], "bytes": hex_size},
+        {"path": hex_paths[1], "bytes": hex_size},
+        {"path": hex_paths[0], "bytes": hex_size},
+    ]
+    assert names[:2] == ["stage_start", "stage_end"]
+    assert events[1][1]["stage"] == "read_script"
+    assert events[1][1]["duration"] >= 0
+    assert "error" not in events[1][1]
+
+
+def test_observers_disk_cache(tmpdir):
+    """
+    A script found in the on-disk hex cache is reported as a disk cache hit.
+    """
+    tmpdir.join("a.py").write("print('a')\n")
+    cache_dir = str(tmpdir.mkdir("cache"))
+    observer = mock.MagicMock()
+    uflash.flash(str(tmpdir.join("a.py")), [str(tmpdir)], cache_dir=cache_dir)
+    uflash.cache_clear()
+    uflash.flash(
+        str(tmpdir.join("a.py")),
+        [str(tmpdir)],
+        cache_dir=cache_dir,
+        observer=observer,
+    )
+    observer.assert_any_call("cache_hit", {"cache": "disk"})
+
+
+def test_flash_observer(tmpdir):
+    """
+    An observer passed to flash() gets the events of that call, including
+    those from the threads flashing the devices and the errors of each
+    device, along with the global observers.
+    """
+    tmpdir.join("a.py").write("print('a')\n")
+    good = str(tmpdir)
+    bad = str(tmpdir.join("missing"))
+    observer = mock.MagicMock()
+    global_observer = mock.MagicMock()
+    uflash.add_observer(global_observer)
+    try:
+        with pytest.raises(uflash.FlashError):
+            uflash.flash(
+                str(tmpdir.join("a.py")),
+                [good, bad],
+                max_workers=2,
+                observer=observer,
+            )
+    finally:
+        uflash.remove_observer(global_observer)
+    assert observer.call_args_list == global_observer.call_args_list
+    events = [call[0] for call in observer.call_args_list]
+    bad_path = os.path.join(bad, "micropython.hex")
+    assert ("error", {"path": bad_path, "error": mock.ANY}) in events
+    good_path = os.path.join(good, "micropython.hex")
+    assert ("write", {"path": good_path, "bytes": mock.ANY}) in events
+    assert uflash._observers() is uflash._OBSERVERS
+    uflash.flash(str(tmpdir.join("a.py")), [good])
+    assert len(observer.call_args_list) == len(events)
+
+
+def test_flash_observer_not_found():
+    """
+    The observer is told if the micro:bit can't be found, and about the
+    stages that fail.
+    """
+    observer = mock.MagicMock()
+    with mock.patch("uflash.find_microbit", return_value=None):
+        with pytest.raises(IOError):
+            uflash.flash(observer=observer)
+    observer.assert_called_with(
+        "error",
+        {"path": None, "error": "Unable to find micro:bit. Is it plugged in?"},
+    )
+    observer.reset_mock()
+    with pytest.raises(ValueError):
+        uflash.flash(python_script=b"x" * (1024 * 1024), observer=observer)
+    stage, data = observer.call_args[0]
+    assert stage == "stage_end"
+    assert data["stage"] == "script_to_fs"
+    assert data["error"].startswith("Python script must be less than")
+
+
+def test_remove_timing_callback_unknown():
+    """
+    Removing a timing callback that isn't registered is an error.
+    """
+    with pytest.raises(ValueError):
+        uflash.remove_timing_callback(mock.MagicMock())
+
+
+def test_json_lines_observer():
+    """
+    The JSON lines observer writes each event as a JSON object on its own
+    line.
+    """
+    output = mock.MagicMock()
+    observer = uflash.JSONLinesObserver(output)
+    with mock.patch("time.time", return_value=1.5):
+        observer("write", {"path": "a.hex", "bytes": 10})
+    output.write.assert_called_once_with(
+        '{"bytes": 10, "event": "write", "path": "a.hex", "time": 1.5}\n'
+    )
+    assert output.flush.call_count == 1
+
+
+@pytest.mark.skipif(
+    uflash._MemoryReport.tracemalloc() is None,
+    reason="The memory report needs Python 3.9 or later",
+)
+def test_memory_report():
+    """
+    The memory report records the peak memory allocated during each stage,
+    including the stages nested in it, and overall.
+    """
+    with mock.patch("sys.stderr", mock.MagicMock()) as output:
+        with uflash._MemoryReport() as report:
+            with uflash._span("write"):
+                with uflash._span("encode"):
+                    data = bytearray(256 * 1024)
+                del data
+            with uflash._span("fsync"):
+                pass
+    assert uflash._OBSERVERS == []
+    assert list(report.peaks) == ["encode", "write", "fsync"]
+    assert report.peaks["encode"] >= 256 * 1024
+    assert report.peaks["write"] >= report.peaks["encode"]
+    assert report.peaks["fsync"] < 256 * 1024
+    assert report.peak >= report.peaks["write"]
+    printed = "".join(call[0][0] for call in output.write.call_args_list)
+    lines = printed.splitlines()
+    assert lines[0] == "Peak memory:"
+    assert [line.split()[0] for line in lines[1:]] == [
+        "encode",
+        "write",
+        "fsync",
+        "total",
+    ]
+    assert lines[1] == "  encode          {:>10.1f} KiB".format(
+        report.peaks["encode"] / 1024.0
+    )
+
+
+def test_timing_report():
+    """
+    The timing report adds up the time of each stage, in milliseconds.
+    """
+    report = uflash._TimingReport()
+    report("write", 0.001)
+    report("fsync", 0.0025)
+    report("write", 0.002)
+    output = mock.MagicMock()
+    with mock.patch("sys.stderr", output):
+        report.print_report()
+    printed = "".join(call[0][0] for call in output.write.call_args_list)
+    assert printed == (
+        "Timings:\n"
+        "  write                3.000 ms\n"
+        "  fsync                2.500 ms\n"
+        "  total                5.500 ms\n"
+    )
+
+
 def test_main_keepname_message(capsys):
     """
     Ensure that the correct message appears when called as from py2hex.
@@ -511,10 +1260,12 @@ def test_flash_with_python_script():
     python_script = b"import this"
     with mock.patch("uflash.save_hex"):
         with mock.patch("uflash.find_microbit", return_value="bar"):
-            with mock.patch("uflash.embed_fs_uhex") as mock_embed_fs_uhex:
+            with mock.patch(
+                "uflash._embed_fs_uhex_chunks"
+            ) as mock_embed_fs_uhex:
                 uflash.flash(python_script=python_script)
                 mock_embed_fs_uhex.assert_called_once_with(
-                    uflash._RUNTIME, python_script
+                    uflash._get_runtime_hex(), python_script, None
                 )
 
 
@@ -555,7 +1306,11 @@ def test_main_no_args():
         with mock.patch("uflash.flash") as mock_flash:
             uflash.main()
             mock_flash.assert_called_once_with(
-                path_to_python=None, paths_to_microbits=[], keepname=False
+                path_to_python=None,
+                paths_to_microbits=[],
+                keepname=False,
+                max_workers=1,
+                low_memory=False,
             )
 
 
@@ -567,7 +1322,11 @@ def test_main_first_arg_python():
     with mock.patch("uflash.flash") as mock_flash:
         uflash.main(argv=["foo.py"])
         mock_flash.assert_called_once_with(
-            path_to_python="foo.py", paths_to_microbits=[], keepname=False
+            path_to_python="foo.py",
+            paths_to_microbits=[],
+            keepname=False,
+            max_workers=1,
+            low_memory=False,
         )
 
 
@@ -700,6 +1459,8 @@ def test_minify_arg(capsys):
             path_to_python="tests/example.py",
             paths_to_microbits=[],
             keepname=False,
+            max_workers=1,
+            low_memory=False,
         )
 
 
@@ -714,6 +1475,8 @@ def test_main_two_args():
             path_to_python="foo.py",
             paths_to_microbits=["/media/foo/bar"],
             keepname=False,
+            max_workers=1,
+            low_memory=False,
         )
 
 
@@ -739,47 +1502,334 @@ def test_main_multiple_microbits():
                 "/media/foo/bob",
             ],
             keepname=False,
+            max_workers=1,
+            low_memory=False,
         )
 
 
-def test_main_watch_flag():
+def test_main_jobs():
     """
-    The watch flag cause a call the correct function.
+    The number of micro:bits to flash at the same time is passed to flash().
     """
-    with mock.patch("uflash.watch_file") as mock_watch_file:
-        uflash.main(argv=["-w"])
-        mock_watch_file.assert_called_once_with(
-            None, uflash.flash, path_to_python=None, paths_to_microbits=[]
+    with mock.patch("uflash.flash", return_value=None) as mock_flash:
+        uflash.main(argv=["foo.py", "/media/foo/bar", "/media/foo/baz", "-j4"])
+        mock_flash.assert_called_once_with(
+            path_to_python="foo.py",
+            paths_to_microbits=["/media/foo/bar", "/media/foo/baz"],
+            keepname=False,
+            max_workers=4,
+            low_memory=False,
         )
 
 
-def test_watch_no_source():
+def test_main_timings(capsys):
     """
-    If there is no source file the watch command should complain.
+    The --timings option prints the time taken by each stage to stderr, even
+    if flashing fails.
     """
-    with pytest.raises(ValueError):
-        uflash.watch_file(None, lambda: "should never be called!")
 
+    def fake_flash(**kwargs):
+        with uflash._span("write"):
+            pass
+        raise IOError("Unable to find micro:bit. Is it plugged in?")
 
-@mock.patch("uflash.time")
-@mock.patch("uflash.os")
-def test_watch_file(mock_os, mock_time):
+    with mock.patch("uflash.flash", side_effect=fake_flash):
+        with pytest.raises(SystemExit):
+            uflash.main(argv=["foo.py", "--timings"])
+    assert uflash._OBSERVERS == []
+    _, stderr = capsys.readouterr()
+    lines = stderr.splitlines()
+    assert lines[0].startswith("Error flashing foo.py")
+    assert lines[1] == "Timings:"
+    assert lines[2].split()[0] == "write"
+    assert lines[3].split()[0] == "total"
+
+
+def test_main_low_memory():
     """
-    Make sure that the callback is called each time the file changes.
+    The --low-memory option is passed to flash(), which is also what watch
+    mode calls with it instead of keeping the runtime ready.
     """
-    # Our function will throw KeyboardInterrupt when called for the 2nd time,
-    # ending the watching gracefully.This will help in testing the
-    # watch_file function.
-    call_count = [0]
+    with mock.patch("uflash.flash", return_value=None) as mock_flash:
+        uflash.main(argv=["foo.py", "/media/foo/bar", "--low-memory"])
+        mock_flash.assert_called_once_with(
+            path_to_python="foo.py",
+            paths_to_microbits=["/media/foo/bar"],
+            keepname=False,
+            max_workers=1,
+            low_memory=True,
+        )
+    with mock.patch("uflash.watch_file") as mock_watch_file:
+        uflash.main(argv=["-w", "tests/example.py", "--low-memory"])
+    scheduler = mock_watch_file.call_args[0][1].__self__
+    assert scheduler.func is uflash.flash
+    assert scheduler.args == ("tests/example.py", [])
+    assert scheduler.kwargs == {"max_workers": 1, "low_memory": True}
 
-    def func():
-        call_count[0] = call_count[0] + 1
-        if call_count[0] == 2:
-            raise KeyboardInterrupt()
 
-    # Instead of modifying any file, let's change the return value of
-    # os.path.getmtime. Start with initial value of 0.
-    mock_os.path.getmtime.return_value = 0
+@pytest.mark.skipif(
+    uflash._MemoryReport.tracemalloc() is None,
+    reason="The memory report needs Python 3.9 or later",
+)
+def test_main_memory_report(tmpdir, capsys):
+    """
+    The --memory-report option prints the peak memory allocated by each
+    stage to stderr, flashing the devices one at a time.
+    """
+    devices = [str(tmpdir.mkdir("one")), str(tmpdir.mkdir("two"))]
+    with mock.patch(
+        "uflash._save_hex_to_all", return_value={}
+    ) as mock_save_all:
+        uflash.main(argv=["tests/example.py"] + devices + ["-j", "2"])
+        assert mock_save_all.call_args[0][2] == 2
+        uflash.main(
+            argv=["tests/example.py"] + devices + ["-j2", "--memory-report"]
+        )
+        assert mock_save_all.call_args[0][2] == 1
+    assert uflash._OBSERVERS == []
+    _, stderr = capsys.readouterr()
+    lines = stderr.splitlines()
+    assert lines[0] == "Peak memory:"
+    assert lines[1].split()[0] == "read_script"
+    assert lines[-1].split()[0] == "total"
+    assert lines[-1].endswith(" KiB")
+
+
+def test_main_watch_flag():
+    """
+    The watch flag cause a call the correct function.
+    """
+    with mock.patch("uflash.watch_file") as mock_watch_file:
+        uflash.main(argv=["-w", "tests/example.py", "--quiet-period", "0.5"])
+    assert mock_watch_file.call_count == 1
+    path, notify = mock_watch_file.call_args[0]
+    assert path == "tests/example.py"
+    scheduler = notify.__self__
+    assert scheduler.paths == ["tests/example.py"]
+    assert scheduler.quiet_period == 0.5
+    assert scheduler.func.path_to_python == "tests/example.py"
+    assert scheduler.func.paths_to_microbits == []
+    assert scheduler.func.max_workers == 1
+
+
+def test_watch_flasher(tmpdir):
+    """
+    The watch flasher writes the same hex as flash() each time it's called,
+    only looking for the micro:bit the first time.
+    """
+    script = tmpdir.join("script.py")
+    script.write("print('hello')\n")
+    microbit = tmpdir.mkdir("MICROBIT")
+    flasher = uflash._WatchFlasher(str(script))
+    with mock.patch(
+        "uflash.find_microbit", return_value=str(microbit)
+    ) as mock_find:
+        assert flasher() == [str(microbit.join("micropython.hex"))]
+        script.write("print('goodbye')\n")
+        assert flasher() == [str(microbit.join("micropython.hex"))]
+        assert mock_find.call_count == 1
+    hex_file = microbit.join("micropython.hex").read()
+    expected = uflash.embed_fs_uhex(uflash._RUNTIME, b"print('goodbye')\n")
+    assert hex_file == expected
+    script.write("")
+    flasher()
+    assert microbit.join("micropython.hex").read() == uflash._RUNTIME
+
+
+def test_watch_flasher_targets(tmpdir):
+    """
+    The watch flasher writes to every given micro:bit.
+    """
+    script = tmpdir.join("script.py")
+    script.write("print('hello')\n")
+    paths = [str(tmpdir.mkdir("a")), str(tmpdir.mkdir("b"))]
+    flasher = uflash._WatchFlasher(str(script), paths, max_workers=2)
+    with mock.patch("uflash.find_microbit") as mock_find:
+        assert flasher() == [os.path.join(p, "micropython.hex") for p in paths]
+    assert mock_find.call_count == 0
+    assert tmpdir.join("a", "micropython.hex").read() == (
+        tmpdir.join("b", "micropython.hex").read()
+    )
+
+
+def test_watch_flasher_errors(tmpdir):
+    """
+    Errors are raised like flash() does, and the micro:bit is looked for again
+    after a failed flash.
+    """
+    script = tmpdir.join("script.py")
+    script.write("print('hello')\n")
+    flasher = uflash._WatchFlasher(str(tmpdir.join("script.txt")))
+    with pytest.raises(ValueError):
+        flasher()
+    flasher = uflash._WatchFlasher(str(script))
+    with mock.patch("uflash.find_microbit", return_value=None):
+        with pytest.raises(IOError) as ex:
+            flasher()
+    assert "Unable to find micro:bit" in str(ex.value)
+    missing = str(tmpdir.join("missing"))
+    with mock.patch("uflash.find_microbit", return_value=missing):
+        with pytest.raises(IOError):
+            flasher()
+    assert flasher.hex_paths is None
+    flasher = uflash._WatchFlasher(str(script), [missing, str(tmpdir)])
+    with pytest.raises(uflash.FlashError) as ex:
+        flasher()
+    assert list(ex.value.errors) == [os.path.join(missing, "micropython.hex")]
+    assert flasher.hex_paths is not None
+
+
+def test_main_watch_flag_no_source():
+    """
+    Watching without a source file is reported as an error.
+    """
+    with pytest.raises(SystemExit), mock.patch("uflash.flash") as mock_flash:
+        uflash.main(argv=["-w"])
+    assert mock_flash.call_count == 0
+
+
+def wait_for(condition, timeout=5):
+    """
+    Waits until the condition function returns True.
+    """
+    end = time.time() + timeout
+    while not condition():
+        assert time.time() < end, "Timed out"
+        time.sleep(0.005)
+
+
+def test_rebuild_scheduler_coalesces(tmpdir):
+    """
+    A burst of changes results in a single call, once things go quiet.
+    """
+    script = tmpdir.join("script.py")
+    script.write("1")
+    func = mock.MagicMock()
+    scheduler = uflash._RebuildScheduler(
+        func, [str(script)], 0.05, args=(1,), kwargs={"foo": "bar"}
+    )
+    for i in range(5):
+        script.write(str(i + 2))
+        scheduler.notify()
+    wait_for(lambda: func.call_count)
+    time.sleep(0.1)
+    scheduler.close()
+    func.assert_called_once_with(1, foo="bar")
+
+
+def test_rebuild_scheduler_one_in_flight(tmpdir):
+    """
+    Changes notified during a call are collapsed into a single follow-up call.
+    """
+    script = tmpdir.join("script.py")
+    script.write("0")
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def func():
+        calls.append(script.read())
+        started.set()
+        release.wait(5)
+
+    scheduler = uflash._RebuildScheduler(func, [str(script)], 0)
+    script.write("1")
+    scheduler.notify()
+    assert started.wait(5)
+    for i in range(3):
+        script.write(str(i + 2))
+        scheduler.notify()
+    release.set()
+    wait_for(lambda: len(calls) == 2)
+    scheduler.close()
+    assert calls == ["1", "4"]
+
+
+def test_rebuild_scheduler_unchanged_content(tmpdir, capsys):
+    """
+    The first change is always flashed, even if the content is the same as
+    when watching started. After that, no call is made if the normalised
+    content hasn't changed since the last successful call.
+    """
+    script = tmpdir.join("script.py")
+    script.write_binary(b"a = 1\nb = 2\n")
+    func = mock.MagicMock()
+    scheduler = uflash._RebuildScheduler(func, [str(script)], 0)
+    scheduler.notify()
+    wait_for(lambda: func.call_count == 1)
+    script.write_binary(b"a = 1\r\nb = 2\r\n")
+    scheduler.notify()
+    time.sleep(0.05)
+    assert func.call_count == 1
+    func.side_effect = IOError("No micro:bit")
+    script.write_binary(b"a = 2\n")
+    scheduler.notify()
+    wait_for(lambda: func.call_count == 2)
+    func.side_effect = None
+    scheduler.notify()
+    wait_for(lambda: func.call_count == 3)
+    scheduler.notify()
+    time.sleep(0.05)
+    scheduler.close()
+    assert func.call_count == 3
+    _, stderr = capsys.readouterr()
+    assert "Error: No micro:bit" in stderr
+
+
+def test_rebuild_scheduler_missing_file(tmpdir):
+    """
+    The call is always made if the paths can't be read.
+    """
+    func = mock.MagicMock()
+    scheduler = uflash._RebuildScheduler(func, [str(tmpdir.join("x"))], 0)
+    scheduler.notify()
+    wait_for(lambda: func.call_count == 1)
+    scheduler.notify()
+    wait_for(lambda: func.call_count == 2)
+    scheduler.close()
+
+
+def test_rebuild_scheduler_close():
+    """
+    Closing drops pending calls, and works if nothing was ever notified.
+    """
+    func = mock.MagicMock()
+    uflash._RebuildScheduler(func, [], 0).close()
+    scheduler = uflash._RebuildScheduler(func, [], 10)
+    scheduler.notify()
+    scheduler.close()
+    assert func.call_count == 0
+
+
+def test_watch_no_source():
+    """
+    If there is no source file the watch command should complain.
+    """
+    with pytest.raises(ValueError):
+        uflash.watch_file(None, lambda: "should never be called!")
+
+
+@mock.patch("uflash._Inotify", side_effect=OSError("No inotify"))
+@mock.patch("uflash.time")
+@mock.patch("uflash.os")
+def test_watch_file(mock_os, mock_time, mock_inotify):
+    """
+    Make sure that the callback is called each time the file changes (when
+    inotify isn't available and the modification time is polled).
+    """
+    # Our function will throw KeyboardInterrupt when called for the 2nd time,
+    # ending the watching gracefully.This will help in testing the
+    # watch_file function.
+    call_count = [0]
+
+    def func():
+        call_count[0] = call_count[0] + 1
+        if call_count[0] == 2:
+            raise KeyboardInterrupt()
+
+    # Instead of modifying any file, let's change the return value of
+    # os.path.getmtime. Start with initial value of 0.
+    mock_os.path.getmtime.return_value = 0
 
     t = threading.Thread(target=uflash.watch_file, args=("path/to/file", func))
     t.start()
@@ -793,6 +1843,249 @@ def test_watch_file(mock_os, mock_time):
     assert call_count[0] == 2
 
 
+@pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="inotify is Linux only"
+)
+def test_watch_file_inotify(tmpdir):
+    """
+    With inotify, the callback is called each time the file is saved, either
+    in place or by renaming another file over it, but not when other files in
+    the same directory change.
+    """
+    script = tmpdir.join("script.py")
+    script.write("1")
+    calls = []
+
+    def func(value):
+        calls.append(script.read())
+        if len(calls) == 2:
+            raise KeyboardInterrupt()
+
+    t = threading.Thread(
+        target=uflash.watch_file, args=(str(script), func, "value")
+    )
+    t.start()
+    time.sleep(0.05)
+    tmpdir.join("other.py").write("other")
+    script.write("2")
+    time.sleep(0.05)
+    assert calls == ["2"]
+    tmpdir.join("script.py.tmp").write("3")
+    os.rename(str(tmpdir.join("script.py.tmp")), str(script))
+    t.join(5)
+    assert not t.is_alive()
+    assert calls == ["2", "3"]
+
+
+def test_inotify_unavailable():
+    """
+    An OSError is raised if inotify can't be used.
+    """
+    with mock.patch("sys.platform", "darwin"):
+        with pytest.raises(OSError):
+            uflash._Inotify([])
+    if sys.platform.startswith("linux"):
+        with pytest.raises(OSError):
+            uflash._Inotify(["tests/does_not_exist"])
+
+
+@pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="inotify is Linux only"
+)
+def test_inotify_undecodable_name(tmpdir):
+    """
+    A file with a name that isn't valid in the filesystem encoding doesn't
+    stop the changes from being read.
+    """
+    inotify = uflash._Inotify([str(tmpdir)])
+    try:
+        path = os.path.join(str(tmpdir).encode("utf-8"), b"caf\xe9.py")
+        with open(path, "wb") as bad_file:
+            bad_file.write(b"x = 1\n")
+        tmpdir.join("script.py").write("x = 2\n")
+        paths = []
+        while len(paths) < 2:
+            changes = inotify.read(5)
+            assert changes
+            paths.extend(changes)
+    finally:
+        inotify.close()
+    assert paths[1] == str(tmpdir.join("script.py"))
+
+
+def make_project(tmpdir):
+    """
+    Creates a project directory with a main script, a helper module in a
+    package, a hidden directory and a text file.
+    """
+    project = tmpdir.mkdir("project")
+    project.join("main.py").write("import helper\n")
+    project.join("notes.txt").write("notes")
+    project.mkdir("lib").join("helper.py").write("x = 1\n")
+    project.mkdir(".git").join("hook.py").write("")
+    return project
+
+
+def test_watched_files(tmpdir):
+    """
+    Directories match all their (non-hidden) Python files, and glob patterns
+    whatever files they match. Missing files are left out.
+    """
+    project = make_project(tmpdir)
+    files = uflash._watched_files(
+        [str(project), str(project.join("*.txt")), str(tmpdir.join("x.py"))]
+    )
+    assert sorted(files) == [
+        str(project.join("lib", "helper.py")),
+        str(project.join("main.py")),
+        str(project.join("notes.txt")),
+    ]
+    assert files[str(project.join("main.py"))] == os.path.getmtime(
+        str(project.join("main.py"))
+    )
+
+
+def test_is_watched(tmpdir):
+    """
+    Paths are matched against files, directories and glob patterns.
+    """
+    project = str(make_project(tmpdir))
+    main_py = os.path.join(project, "main.py")
+    helper_py = os.path.join(project, "lib", "helper.py")
+    notes = os.path.join(project, "notes.txt")
+    hook = os.path.join(project, ".git", "hook.py")
+    assert uflash._is_watched(main_py, [main_py])
+    assert not uflash._is_watched(helper_py, [main_py])
+    assert uflash._is_watched(helper_py, [project])
+    assert not uflash._is_watched(notes, [project])
+    assert not uflash._is_watched(hook, [project])
+    assert not uflash._is_watched(project + "2.py", [project])
+    assert uflash._is_watched(notes, [main_py, os.path.join(project, "*.txt")])
+    assert not uflash._is_watched(main_py, [os.path.join(project, "*.txt")])
+
+
+def test_watch_paths_no_paths():
+    """
+    There must be something to watch.
+    """
+    with pytest.raises(ValueError):
+        uflash._watch_paths([], lambda changed: None)
+
+
+@pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="inotify is Linux only"
+)
+def test_watch_paths_inotify(tmpdir):
+    """
+    With inotify, the function is called with the files that changed in the
+    watched directories, including new files.
+    """
+    project = make_project(tmpdir)
+    calls = []
+
+    def func(changed):
+        calls.append(changed)
+        if len(calls) == 2:
+            raise KeyboardInterrupt()
+
+    t = threading.Thread(
+        target=uflash._watch_paths,
+        args=([str(project.join("main.py")), str(project)], func),
+    )
+    t.start()
+    time.sleep(0.05)
+    project.join("notes.txt").write("more notes")
+    project.join("lib", "helper.py").write("x = 2\n")
+    time.sleep(0.05)
+    project.join("lib", "new.py").write("y = 1\n")
+    t.join(5)
+    assert not t.is_alive()
+    assert calls == [
+        [str(project.join("lib", "helper.py"))],
+        [str(project.join("lib", "new.py"))],
+    ]
+
+
+@mock.patch("uflash._Inotify", side_effect=OSError("No inotify"))
+def test_watch_paths_polling(mock_inotify, tmpdir):
+    """
+    Without inotify, the function is called with the files whose
+    modification time changed, or that are new.
+    """
+    project = make_project(tmpdir)
+    calls = []
+    ticks = [0]
+
+    def sleep(seconds):
+        ticks[0] += 1
+        if ticks[0] == 2:
+            os.utime(str(project.join("lib", "helper.py")), (1, 1))
+        elif ticks[0] == 3:
+            project.join("lib", "new.py").write("y = 1\n")
+        elif ticks[0] == 4:
+            raise KeyboardInterrupt()
+
+    with mock.patch("uflash.time") as mock_time:
+        mock_time.sleep.side_effect = sleep
+        uflash._watch_paths([str(project)], calls.append)
+    assert calls == [
+        [str(project.join("lib", "helper.py"))],
+        [str(project.join("lib", "new.py"))],
+    ]
+
+
+def test_main_watch_path():
+    """
+    The --watch-path option watches the source file and the given paths.
+    """
+    with mock.patch("uflash._watch_paths") as mock_watch_paths:
+        uflash.main(
+            argv=[
+                "tests/example.py",
+                "--watch-path",
+                "lib",
+                "--watch-path",
+                "*.py",
+            ]
+        )
+    patterns, notify = mock_watch_paths.call_args[0]
+    assert patterns == ["tests/example.py", "lib", "*.py"]
+    assert notify.__self__.func.path_to_python == "tests/example.py"
+
+
+def test_main_watch_path_no_source(capsys):
+    """
+    The --watch-path option needs a source file to flash.
+    """
+    with pytest.raises(SystemExit):
+        uflash.main(argv=["--watch-path", "lib"])
+    _, stderr = capsys.readouterr()
+    assert "Please specify a file to flash" in stderr
+
+
+def test_rebuild_scheduler_changed_paths(tmpdir, capsys):
+    """
+    Paths notified as changed are checked for changes too, and reported
+    once something has been flashed.
+    """
+    project = make_project(tmpdir)
+    main_py = str(project.join("main.py"))
+    helper_py = str(project.join("lib", "helper.py"))
+    func = mock.MagicMock()
+    scheduler = uflash._RebuildScheduler(func, [main_py], 0)
+    scheduler.notify([helper_py])
+    wait_for(lambda: func.call_count == 1)
+    scheduler.notify([helper_py])
+    time.sleep(0.05)
+    assert func.call_count == 1
+    project.join("lib", "helper.py").write("x = 2\n")
+    scheduler.notify([helper_py])
+    wait_for(lambda: func.call_count == 2)
+    scheduler.close()
+    stdout, _ = capsys.readouterr()
+    assert stdout == "Changed: {}\n".format(helper_py)
+
+
 def test_py2hex_one_arg():
     """
     Test a simple call to main().
@@ -803,6 +2096,8 @@ def test_py2hex_one_arg():
             path_to_python="tests/example.py",
             paths_to_microbits=["tests"],
             keepname=True,
+            cache_dir=None,
+            low_memory=False,
         )
 
 
@@ -818,6 +2113,8 @@ def test_py2hex_minify_arg(capsys):
             path_to_python="tests/example.py",
             paths_to_microbits=["tests"],
             keepname=True,
+            cache_dir=None,
+            low_memory=False,
         )
 
 
@@ -831,9 +2128,393 @@ def test_py2hex_outdir_arg():
             path_to_python="tests/example.py",
             paths_to_microbits=["/tmp"],
             keepname=True,
+            cache_dir=None,
+            low_memory=False,
         )
 
 
+def test_py2hex_cache_dir_arg():
+    """
+    Test the cache directory is passed on to flash.
+    """
+    with mock.patch("uflash.flash") as mock_flash:
+        uflash.py2hex(argv=["tests/example.py", "--cache-dir", "/tmp/cache"])
+        mock_flash.assert_called_once_with(
+            path_to_python="tests/example.py",
+            paths_to_microbits=["tests"],
+            keepname=True,
+            cache_dir="/tmp/cache",
+            low_memory=False,
+        )
+
+
+def test_py2hex_jobs(tmpdir, capsys):
+    """
+    Several scripts are hexified by a pool of worker processes, reporting the
+    results in order and the errors of each file, without stopping the rest.
+    """
+    sources = []
+    for name in ("a", "b", "c"):
+        source = tmpdir.join(name + ".py")
+        source.write("print('{}')\n".format(name))
+        sources.append(str(source))
+    sources.insert(1, str(tmpdir.join("missing.py")))
+    outdir = tmpdir.mkdir("out")
+    with pytest.raises(SystemExit) as ex:
+        uflash.py2hex(argv=sources + ["-o", str(outdir), "--jobs", "2"])
+    assert ex.value.code == 1
+    stdout, stderr = capsys.readouterr()
+    assert stdout == "".join(
+        "Hexifying {}.py as: {}\n".format(name, outdir.join(name + ".hex"))
+        for name in ("a", "b", "c")
+    )
+    assert stderr.startswith("Error hexifying {}: ".format(sources[1]))
+    assert sorted(os.listdir(str(outdir))) == ["a.hex", "b.hex", "c.hex"]
+    for name in ("a", "b", "c"):
+        expected = uflash.embed_fs_uhex(
+            uflash._RUNTIME, "print('{}')\n".format(name).encode("ascii")
+        )
+        assert outdir.join(name + ".hex").read() == expected
+
+
+def test_py2hex_jobs_default(tmpdir):
+    """
+    By default there is a worker process per CPU, all writing to the
+    directory of the first script if there's no output directory.
+    """
+    sources = [str(tmpdir.join("a.py")), str(tmpdir.join("b.py"))]
+    with mock.patch("uflash._cpu_count", return_value=4), mock.patch(
+        "uflash._py2hex_all", return_value=[]
+    ) as mock_all:
+        uflash.py2hex(argv=sources + ["--cache-dir", "cache"])
+    mock_all.assert_called_once_with(
+        [
+            (sources[0], str(tmpdir), "cache"),
+            (sources[1], str(tmpdir), "cache"),
+        ],
+        4,
+    )
+
+
+def test_py2hex_jobs_serial():
+    """
+    With a single job the scripts are flashed one after the other.
+    """
+    with mock.patch("uflash.flash") as mock_flash, mock.patch(
+        "uflash._py2hex_all"
+    ) as mock_all:
+        uflash.py2hex(argv=["tests/example.py", "tests/example.py", "-j", "1"])
+    assert mock_flash.call_count == 2
+    assert mock_all.call_count == 0
+
+
+@pytest.mark.parametrize("option", ["-j1", "--timings", "--low-memory"])
+def test_py2hex_serial_errors(tmpdir, capsys, option):
+    """
+    Hexifying the scripts one after the other, a file that can't be hexified
+    is reported without stopping the rest, and py2hex then exits with an
+    error status.
+    """
+    missing = str(tmpdir.join("missing.py"))
+    source = tmpdir.join("a.py")
+    source.write("print('a')\n")
+    with pytest.raises(SystemExit) as ex:
+        uflash.py2hex(argv=[missing, str(source), option])
+    assert ex.value.code == 1
+    stdout, stderr = capsys.readouterr()
+    assert stderr.startswith("Error hexifying {}: ".format(missing))
+    assert stdout == "Hexifying a.py as: {}\n".format(tmpdir.join("a.hex"))
+    assert tmpdir.join("a.hex").read() == uflash.embed_fs_uhex(
+        uflash._RUNTIME, b"print('a')\n"
+    )
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_py2hex_incremental(tmpdir, capsys, jobs):
+    """
+    In incremental mode only the scripts whose hex file isn't up to date (as
+    recorded in the manifest) are hexified, leaving the rest untouched.
+    """
+    sources = []
+    for name in ("a", "b"):
+        source = tmpdir.join(name + ".py")
+        source.write_binary("print('{}')\n".format(name).encode("ascii"))
+        sources.append(str(source))
+    argv = sources + ["--incremental", "-j", jobs]
+    with open(uflash._RUNTIME_PATH, "rb") as image_file:
+        runtime_image = image_file.read()
+    a_hex, b_hex = tmpdir.join("a.hex"), tmpdir.join("b.hex")
+    uflash.py2hex(argv=argv)
+    manifest = json.loads(tmpdir.join(".uflash-manifest.json").read())
+    assert sorted(manifest["files"]) == ["a.hex", "b.hex"]
+    assert manifest["files"]["a.hex"] == {
+        "source": hashlib.sha256(b"print('a')\n").hexdigest(),
+        "runtime": hashlib.sha256(runtime_image).hexdigest(),
+        "uflash": uflash.get_version(),
+        "size": a_hex.size(),
+    }
+    os.utime(str(a_hex), (1, 1))
+    os.utime(str(b_hex), (1, 1))
+    capsys.readouterr()
+    # Only changing the line endings doesn't change the hex file.
+    tmpdir.join("a.py").write_binary(b"print('a')\r\n")
+    uflash.py2hex(argv=argv)
+    stdout, _ = capsys.readouterr()
+    assert stdout == (
+        "Skipping a.py, {} is up to date\n"
+        "Skipping b.py, {} is up to date\n".format(a_hex, b_hex)
+    )
+    assert a_hex.mtime() == b_hex.mtime() == 1
+    tmpdir.join("b.py").write("print('B')\n")
+    uflash.py2hex(argv=argv)
+    assert a_hex.mtime() == 1
+    assert b_hex.mtime() != 1
+    assert b_hex.read() == uflash.embed_fs_uhex(
+        uflash._RUNTIME, b"print('B')\n"
+    )
+    # A new uflash version, or a missing hex file, means hexifying again.
+    capsys.readouterr()
+    b_hex.remove()
+    with mock.patch("uflash._VERSION", (99, 0, 0)):
+        uflash.py2hex(argv=argv)
+    assert a_hex.mtime() != 1
+    assert b_hex.check()
+    stdout, _ = capsys.readouterr()
+    assert "Skipping" not in stdout
+
+
+def test_py2hex_incremental_low_memory(tmpdir):
+    """
+    In low memory mode, the manifest identifies the runtime by its image, so
+    its hex is never generated.
+    """
+    tmpdir.join("a.py").write("print('a')\n")
+    argv = [str(tmpdir.join("a.py")), "--incremental", "--low-memory"]
+    with mock.patch("uflash._RUNTIME_HEX", None), mock.patch(
+        "uflash._RUNTIME_IMAGE_DIGEST", None
+    ):
+        uflash.py2hex(argv=argv)
+        assert uflash._RUNTIME_HEX is None
+        assert uflash._RUNTIME_IMAGE_DIGEST is not None
+    manifest = json.loads(tmpdir.join(".uflash-manifest.json").read())
+    assert manifest["files"]["a.hex"]["runtime"] == (
+        uflash._runtime_image_digest()
+    )
+
+
+def test_py2hex_incremental_bad_manifest(tmpdir):
+    """
+    An invalid manifest means all the scripts are hexified, and manifest write
+    errors are ignored.
+    """
+    tmpdir.join("a.py").write("print('a')\n")
+    tmpdir.join(".uflash-manifest.json").write("[]")
+    assert uflash._read_manifest(str(tmpdir)) == {}
+    tmpdir.join(".uflash-manifest.json").write('{"files": []}')
+    assert uflash._read_manifest(str(tmpdir)) == {}
+    with mock.patch("tempfile.mkstemp", side_effect=OSError("Read only")):
+        uflash.py2hex(argv=[str(tmpdir.join("a.py")), "--incremental"])
+    assert tmpdir.join("a.hex").check()
+    assert uflash._manifest_entry(str(tmpdir.join("missing.py"))) is None
+    assert not uflash._is_up_to_date(str(tmpdir.join("a.hex")), None, {})
+
+
+def test_py2hex_serve(tmpdir):
+    """
+    Each JSON line request is answered with a JSON line response, in order,
+    with the errors of any request that failed.
+    """
+    tmpdir.join("a.py").write("print('a')\n")
+    tmpdir.join("a.txt").write("print('a')\n")
+    requests = [
+        {"id": 1, "path": str(tmpdir.join("a.py"))},
+        {"id": "two", "source": "print('b')\n", "output": "b.hex"},
+        {"path": str(tmpdir.join("a.py")), "output": str(tmpdir.join("c"))},
+        {"id": 4, "source": "print('d')\n"},
+        {"id": 5, "path": str(tmpdir.join("a.txt"))},
+        {"id": 6, "path": str(tmpdir.join("missing.py"))},
+        {"id": 7},
+        [8],
+    ]
+    lines = [json.dumps(request) for request in requests]
+    lines.insert(1, "")
+    lines.append("{not json")
+    responses = mock.MagicMock()
+    with tmpdir.as_cwd():
+        uflash._py2hex_serve(
+            mock.MagicMock(
+                readline=mock.MagicMock(
+                    side_effect=[line + "\n" for line in lines] + [""]
+                )
+            ),
+            responses,
+        )
+    results = [
+        json.loads(call[0][0]) for call in responses.write.call_args_list
+    ]
+    assert responses.flush.call_count == len(results)
+    assert [(r["id"], r["ok"]) for r in results] == [
+        (1, True),
+        ("two", True),
+        (None, False),
+        (4, False),
+        (5, False),
+        (6, False),
+        (7, False),
+        (None, False),
+        (None, False),
+    ]
+    assert results[0]["output"] == str(tmpdir.join("a.hex"))
+    assert results[1]["output"] == "b.hex"
+    assert results[2]["error"] == "The path to flash must be for a .hex file."
+    assert results[3]["error"] == "An output path is required for source."
+    assert results[4]["error"] == 'Python files must end in ".py".'
+    assert results[6]["error"] == "The request needs a path or source."
+    assert results[7]["error"] == "The request must be a JSON object."
+    assert tmpdir.join("a.hex").read() == uflash.embed_fs_uhex(
+        uflash._RUNTIME, b"print('a')\n"
+    )
+    assert tmpdir.join("b.hex").read() == uflash.embed_fs_uhex(
+        uflash._RUNTIME, b"print('b')\n"
+    )
+
+
+def test_py2hex_serve_arg():
+    """
+    The --serve (or --batch) option answers the requests from stdin on
+    stdout, and can't be given source files.
+    """
+    with mock.patch("uflash._py2hex_serve") as mock_serve:
+        uflash.py2hex(argv=["--serve"])
+        uflash.py2hex(argv=["--batch", "--cache-dir", "cache"])
+    assert mock_serve.call_args_list == [
+        mock.call(sys.stdin, sys.stdout, None, False),
+        mock.call(sys.stdin, sys.stdout, "cache", False),
+    ]
+    with pytest.raises(SystemExit):
+        uflash.py2hex(argv=["--serve", "a.py"])
+
+
+def test_py2hex_stdin_stdout():
+    """
+    A source of "-" reads the script from stdin and writes the hex to stdout,
+    in blocks rather than all at once.
+    """
+    stdin = mock.MagicMock()
+    stdin.buffer.read.return_value = b"print('hi')\n"
+    stdout = mock.MagicMock()
+    with mock.patch("sys.stdin", stdin), mock.patch("sys.stdout", stdout):
+        uflash.py2hex(argv=["-"])
+    blocks = [call[0][0] for call in stdout.buffer.write.call_args_list]
+    assert len(blocks) > 1
+    assert b"".join(blocks).decode("ascii") == uflash.embed_fs_uhex(
+        uflash._RUNTIME, b"print('hi')\n"
+    )
+    assert stdout.buffer.flush.call_count == 1
+
+
+def test_py2hex_stdout(tmpdir):
+    """
+    The --stdout option writes the hex of a script file to stdout, and only
+    works with a single source.
+    """
+    tmpdir.join("a.py").write("print('a')\n")
+    stdout = mock.MagicMock(spec=["write", "flush"])
+    with mock.patch("sys.stdout", stdout):
+        uflash.py2hex(argv=[str(tmpdir.join("a.py")), "--stdout"])
+    hex_file = "".join(
+        call[0][0].decode("ascii") for call in stdout.write.call_args_list
+    )
+    assert hex_file == uflash.embed_fs_uhex(uflash._RUNTIME, b"print('a')\n")
+    assert os.listdir(str(tmpdir)) == ["a.py"]
+    with pytest.raises(ValueError):
+        uflash._py2hex_stream(str(tmpdir.join("a.txt")), stdout)
+    with pytest.raises(SystemExit):
+        uflash.py2hex(argv=["a.py", "b.py", "--stdout"])
+    with pytest.raises(SystemExit):
+        uflash.py2hex(argv=["a.py", "-"])
+
+
+def test_py2hex_file(tmpdir):
+    """
+    A script is hexified without printing anything, and errors are returned.
+    """
+    tmpdir.join("a.py").write("print('a')\n")
+    tmpdir.join("a.txt").write("print('a')\n")
+    assert uflash._py2hex_file(
+        (str(tmpdir.join("a.py")), str(tmpdir), None)
+    ) == (str(tmpdir.join("a.hex")), None)
+    assert uflash._py2hex_file(
+        (str(tmpdir.join("a.txt")), str(tmpdir), None)
+    ) == (str(tmpdir.join("a.hex")), 'Python files must end in ".py".')
+
+
+def test_cpu_count():
+    """
+    The CPU count is 1 if it can't be found out.
+    """
+    assert uflash._cpu_count() >= 1
+    with mock.patch("os.cpu_count", return_value=None, create=True):
+        assert uflash._cpu_count() == 1
+
+
+def test_py2hex_one_script_cpu_count():
+    """
+    The CPU count isn't worked out when there's only one script to hexify.
+    """
+    with mock.patch("uflash._cpu_count") as mock_cpu_count, mock.patch(
+        "uflash.flash"
+    ):
+        uflash.py2hex(argv=["tests/example.py"])
+    assert mock_cpu_count.call_count == 0
+
+
+def test_py2hex_timings(tmpdir, capsys):
+    """
+    The --timings option hexifies every script in the py2hex process and
+    prints the time taken by each stage to stderr.
+    """
+    sources = []
+    for name in ("a", "b"):
+        source = tmpdir.join(name + ".py")
+        source.write("print('{}')\n".format(name))
+        sources.append(str(source))
+    with mock.patch("uflash._py2hex_all") as mock_all:
+        uflash.py2hex(argv=sources + ["--timings", "-j", "4"])
+    assert mock_all.call_count == 0
+    assert uflash._OBSERVERS == []
+    _, stderr = capsys.readouterr()
+    lines = stderr.splitlines()
+    assert lines[0] == "Timings:"
+    assert [line.split()[0] for line in lines[1:]] == [
+        "read_script",
+        "script_to_fs",
+        "embed_fs_uhex",
+        "encode",
+        "write",
+        "fsync",
+        "total",
+    ]
+
+
+def test_py2hex_low_memory(tmpdir):
+    """
+    With the --low-memory option the scripts are hexified one at a time, and
+    the hex is generated from the runtime image as it's written.
+    """
+    sources = [str(tmpdir.join("a.py")), str(tmpdir.join("b.py"))]
+    with mock.patch("uflash.flash") as mock_flash, mock.patch(
+        "uflash._py2hex_all"
+    ) as mock_all:
+        uflash.py2hex(argv=sources + ["--low-memory", "-j", "4"])
+    assert mock_all.call_count == 0
+    assert mock_flash.call_count == 2
+    assert mock_flash.call_args[1]["low_memory"] is True
+    with mock.patch("uflash._py2hex_stream") as mock_stream:
+        uflash.py2hex(argv=["-", "--low-memory"])
+    assert mock_stream.call_args[0][3] is True
+
+
 def test_py2hex_runtime_not_implemented(capsys):
     """
     Raises a NotImplementedError when trying to use the runtime flag with the
@@ -900,6 +2581,27 @@ def test_bytes_to_ihex_inner_extended_linear_address_record():
     assert result == expected_result
 
 
+def test_bytes_to_ihex_unaligned_extended_linear_address_record():
+    """
+    Test bytes_to_ihex when a record starts right before the end of an
+    address range, and with no data at all.
+    """
+    data = b"A" * 20
+    expected_result = "\n".join(
+        [
+            ":020000040003F7",
+            ":10FFFC0041414141414141414141414141414141E5",
+            ":020000040004F6",
+            ":04000C0041414141EC",
+        ]
+    )
+
+    result = uflash.bytes_to_ihex(0x3FFFC, data)
+
+    assert result == expected_result
+    assert uflash.bytes_to_ihex(0x3FFFC, b"") == ":020000040003F7"
+
+
 def test_script_to_fs():
     """
     Test script_to_fs with a random example without anything special about it.
@@ -1087,6 +2789,23 @@ def test_script_to_fs_chunk_boundary():
     assert result_large == expected_result_large, script_large
 
 
+def test_script_to_fs_last_chunk_full():
+    """
+    Test script_to_fs adds an empty chunk when a script fills the last byte of
+    a chunk that isn't the first one.
+    """
+    script = b"A" * (117 + 126)
+
+    result = uflash.script_to_fs(script, uflash._MICROBIT_ID_V1)
+
+    lines = result.split("\n")
+    # Header with a 0 end offset, 3 chunks of 8 records each and scratch page
+    assert lines[1] == ":108C0000FE00076D61696E2E70794141414141411D"
+    assert len(lines) == 1 + (3 * 8) + 2
+    assert lines[16] == ":108CF00041414141414141414141414141414103A2"
+    assert lines[17] == ":108D000002FFFFFFFFFFFFFFFFFFFFFFFFFFFFFF70"
+
+
 def test_script_to_fs_script_too_long():
     """
     Test script_to_fs when the script is too long and won't fit.
@@ -1286,9 +3005,618 @@ def test_embed_fs_uhex_extra_uicr_jump_record():
     assert uhex_esa_record_alignment == (len(uhex_esa_with_fs) % 512)
 
 
+def test_uhex_splice_index():
+    """
+    The sections, filesystem injection points and device IDs are found once
+    per Universal Hex and then reused.
+    """
+    uhex = "\n".join(TEST_UNIVERSAL_HEX_LIST)
+    lines_len = [len(line) + 1 for line in TEST_UNIVERSAL_HEX_LIST]
+    v2_start = sum(lines_len[:14])
+    expected = (
+        (0, sum(lines_len[:TEST_UHEX_V1_INSERTION_INDEX]), v2_start, "9900"),
+        (
+            v2_start,
+            sum(lines_len[:TEST_UHEX_V2_INSERTION_INDEX]),
+            len(uhex),
+            "9903",
+        ),
+    )
+
+    with mock.patch.dict(uflash._SPLICE_INDEX_CACHE, clear=True):
+        index = uflash._uhex_splice_index(uhex)
+        assert index == expected
+        assert uflash._SPLICE_INDEX_CACHE == {id(uhex): (uhex, expected)}
+        assert uflash._uhex_splice_index(uhex) is index
+        # Equal copies are looked up by identity, not hashed and compared.
+        copy = "".join(list(uhex))
+        assert uflash._uhex_splice_index(copy) == index
+        assert uflash._uhex_splice_index(copy) is not index
+
+
+def test_embed_fs_uhex_chunks():
+    """
+    The chunks form the same Universal Hex as embed_fs_uhex, with the
+    unmodified parts being views into the original bytes.
+    """
+    uhex = "\n".join(TEST_UNIVERSAL_HEX_LIST)
+    uhex_bytes = uhex.encode("ascii")
+
+    with mock.patch("uflash._FS_START_ADDR_V1", 0x38C00), mock.patch(
+        "uflash._FS_END_ADDR_V1", 0x3F800
+    ):
+        chunks = uflash._embed_fs_uhex_chunks(uhex_bytes, TEST_SCRIPT_FS)
+        expected = uflash.embed_fs_uhex(uhex, TEST_SCRIPT_FS)
+
+    assert len(chunks) == 6
+    assert join_chunks(chunks) == expected
+    for chunk in chunks[::3] + chunks[2::3]:
+        assert chunk.obj is uhex_bytes
+    assert join_chunks(uflash._embed_fs_uhex_chunks(uhex_bytes)) == uhex
+
+
+def test_iter_hex():
+    """
+    The generated blocks form the Universal Hex with the embedded script and
+    all have the requested size, except the last one.
+    """
+    expected = uflash.embed_fs_uhex(uflash.get_runtime(), TEST_SCRIPT)
+    for chunk_size in (512, 4096):
+        blocks = list(uflash.iter_hex(TEST_SCRIPT, chunk_size))
+
+        assert b"".join(blocks).decode("ascii") == expected
+        assert all(len(block) == chunk_size for block in blocks[:-1])
+        assert 0 < len(blocks[-1]) <= chunk_size
+        assert all(isinstance(block, bytes) for block in blocks)
+
+
+def test_iter_hex_no_script():
+    """
+    Without a script the blocks form the unmodified runtime.
+    """
+    blocks = uflash.iter_hex()
+
+    assert b"".join(blocks).decode("ascii") == uflash.get_runtime()
+
+
+def test_iter_hex_small_chunks():
+    """
+    Blocks spanning several hex chunks are put together in order.
+    """
+    chunks = [b"a" * 100, b"b" * 100, b"c" * 400, b"d" * 1000]
+    with mock.patch("uflash._embed_fs_uhex_chunks", return_value=chunks):
+        blocks = list(uflash.iter_hex(TEST_SCRIPT))
+
+    assert [len(block) for block in blocks] == [512, 512, 512, 64]
+    assert b"".join(blocks) == b"".join(chunks)
+
+
+def test_iter_hex_bad_chunk_size():
+    """
+    The chunk size must be a multiple of the Universal Hex block size.
+    """
+    for chunk_size in (0, 100, -512):
+        with pytest.raises(ValueError) as ex:
+            uflash.iter_hex(TEST_SCRIPT, chunk_size)
+        assert "multiple of 512" in ex.value.args[0]
+
+
+def test_iter_hex_script_too_big():
+    """
+    A script that doesn't fit in the filesystem is reported when iter_hex is
+    called, before any blocks are generated.
+    """
+    with pytest.raises(ValueError):
+        uflash.iter_hex(b"x" * (1024 * 1024))
+
+
+def test_hex_cache_key():
+    """
+    The hex cache key depends on the Universal Hex and the normalised script.
+    """
+    uhex = "\n".join(TEST_UNIVERSAL_HEX_LIST)
+    key = uflash._hex_cache_key(uhex, TEST_SCRIPT_FS)
+
+    assert len(key) == 64
+    assert key == uflash._hex_cache_key(uhex.encode("ascii"), TEST_SCRIPT_FS)
+    assert key == uflash._hex_cache_key(
+        uhex, TEST_SCRIPT_FS.replace(b"\n", b"\r\n")
+    )
+    assert key != uflash._hex_cache_key(uhex, TEST_SCRIPT)
+    assert key != uflash._hex_cache_key(uhex + "\n", TEST_SCRIPT_FS)
+    with mock.patch("uflash._FS_START_ADDR_V1", 0x39000):
+        assert key != uflash._hex_cache_key(uhex, TEST_SCRIPT_FS)
+
+
+def test_embed_fs_uhex_chunks_cache_dir(tmpdir):
+    """
+    With a cache directory the filesystem records are generated once, and
+    then read from the cache.
+    """
+    cache_dir = str(tmpdir.join("cache"))
+    uhex = "\n".join(TEST_UNIVERSAL_HEX_LIST).encode("ascii")
+    expected = join_chunks(uflash._embed_fs_uhex_chunks(uhex, TEST_SCRIPT))
+    uflash.cache_clear()
+
+    miss = uflash._embed_fs_uhex_chunks(uhex, TEST_SCRIPT, cache_dir)
+    key = uflash._hex_cache_key(uhex, TEST_SCRIPT)
+    assert os.listdir(cache_dir) == [key + uflash._HEX_CACHE_SUFFIX]
+    uflash.cache_clear()
+    with mock.patch("uflash.script_to_fs") as mock_script_to_fs:
+        hit = uflash._embed_fs_uhex_chunks(uhex, TEST_SCRIPT, cache_dir)
+    assert mock_script_to_fs.call_count == 0
+    assert join_chunks(miss) == expected
+    assert join_chunks(hit) == expected
+
+
+def test_embed_fs_uhex_chunks_memo():
+    """
+    Repeated scripts reuse the filesystem records from the in-process cache.
+    """
+    uhex = "\n".join(TEST_UNIVERSAL_HEX_LIST).encode("ascii")
+
+    first = uflash._embed_fs_uhex_chunks(uhex, TEST_SCRIPT)
+    with mock.patch("uflash.script_to_fs") as mock_script_to_fs:
+        second = uflash._embed_fs_uhex_chunks(uhex, TEST_SCRIPT)
+    assert mock_script_to_fs.call_count == 0
+    assert join_chunks(first) == join_chunks(second)
+    assert first[1] is second[1]
+    info = uflash.cache_info()
+    assert info["hits"] == 1
+    assert info["misses"] == 1
+    assert info["entries"] == 1
+    assert info["size"] == len(first[1]) + len(first[4])
+
+
+def test_embed_fs_uhex_memo():
+    """
+    Embedding the same script into the runtime again, as Mu does with
+    embed_fs_uhex(), reuses the filesystem records from the in-process cache.
+    """
+    first = uflash.embed_fs_uhex(uflash._RUNTIME, TEST_SCRIPT)
+    with mock.patch("uflash.script_to_fs") as mock_script_to_fs:
+        second = uflash.embed_fs_uhex(uflash._RUNTIME, TEST_SCRIPT)
+    assert mock_script_to_fs.call_count == 0
+    assert first == second
+    info = uflash.cache_info()
+    assert info["hits"] == 1
+    assert info["misses"] == 1
+    chunks = uflash._embed_fs_uhex_chunks(uflash._RUNTIME_HEX, TEST_SCRIPT)
+    assert join_chunks(chunks) == first
+    assert uflash.cache_info()["hits"] == 2
+
+
+def test_hex_memo_key():
+    """
+    The in-process cache identifies the Universal Hex without hashing it, so
+    a one-off flash doesn't hash the runtime, and the bundled runtime has the
+    same key as a string or bytes.
+    """
+    uhex = "\n".join(TEST_UNIVERSAL_HEX_LIST).encode("ascii")
+    with mock.patch(
+        "uflash._hex_cache_key", wraps=uflash._hex_cache_key
+    ) as mock_cache_key:
+        uflash._embed_fs_uhex_chunks(uhex, TEST_SCRIPT)
+        uflash._embed_fs_uhex_chunks(uflash._get_runtime_hex(), TEST_SCRIPT)
+    assert mock_cache_key.call_count == 0
+    key = uflash._hex_memo_key(uhex, TEST_SCRIPT)
+    crlf_script = TEST_SCRIPT.replace(b"\n", b"\r\n")
+    assert key == uflash._hex_memo_key(uhex, crlf_script)
+    assert key != uflash._hex_memo_key(uhex, b"x = 1")
+    assert key != uflash._hex_memo_key(bytes(bytearray(uhex)), TEST_SCRIPT)
+    assert uflash._hex_memo_key(
+        uflash._get_runtime_hex(), TEST_SCRIPT
+    ) == uflash._hex_memo_key(uflash.get_runtime(), TEST_SCRIPT)
+
+
+def test_embed_fs_uhex_chunks_disk_cache_hit_memo(tmpdir):
+    """
+    Entries read from the on-disk cache are added to the in-process cache.
+    """
+    uhex = "\n".join(TEST_UNIVERSAL_HEX_LIST).encode("ascii")
+    uflash._embed_fs_uhex_chunks(uhex, TEST_SCRIPT, str(tmpdir))
+    uflash.cache_clear()
+
+    with mock.patch("uflash._hex_cache_get", return_value=[b"a", b"b"]):
+        chunks = uflash._embed_fs_uhex_chunks(uhex, TEST_SCRIPT, str(tmpdir))
+        assert chunks[1] == b"a"
+    chunks = uflash._embed_fs_uhex_chunks(uhex, TEST_SCRIPT, str(tmpdir))
+    assert chunks[1] == b"a"
+    assert uflash.cache_info()["hits"] == 1
+
+
+def test_cache_configure():
+    """
+    The in-process cache evicts the least recently used entries to fit in its
+    maximum number of entries and size, and can be disabled.
+    """
+    defaults = uflash.cache_info()
+    try:
+        uflash.cache_configure(max_entries=2)
+        uflash._hex_memo_put("a", [b"a" * 10])
+        uflash._hex_memo_put("b", [b"b" * 10])
+        uflash._hex_memo_get("a")
+        uflash._hex_memo_put("c", [b"c" * 10])
+        assert list(uflash._HEX_MEMO) == ["a", "c"]
+        uflash.cache_configure(max_size=15)
+        assert list(uflash._HEX_MEMO) == ["c"]
+        assert uflash.cache_info()["size"] == 10
+        uflash.cache_configure(max_entries=0)
+        assert uflash.cache_info()["entries"] == 0
+        uflash.cache_clear()
+        uhex = "\n".join(TEST_UNIVERSAL_HEX_LIST).encode("ascii")
+        uflash._embed_fs_uhex_chunks(uhex, TEST_SCRIPT)
+        info = uflash.cache_info()
+        assert (info["entries"], info["hits"], info["misses"]) == (0, 0, 0)
+    finally:
+        uflash.cache_configure(
+            defaults["max_entries"], defaults["max_size"]
+        )
+    assert uflash.cache_info()["max_entries"] == defaults["max_entries"]
+    assert uflash.cache_info()["max_size"] == defaults["max_size"]
+
+
+def test_hex_cache_get_invalid_entry(tmpdir):
+    """
+    Missing or corrupted entries are cache misses.
+    """
+    cache_dir = str(tmpdir)
+    assert uflash._hex_cache_get(cache_dir, "missing", 2) is None
+    tmpdir.join("corrupted" + uflash._HEX_CACHE_SUFFIX).write(b"foo")
+    assert uflash._hex_cache_get(cache_dir, "corrupted", 2) is None
+    tmpdir.join("valid" + uflash._HEX_CACHE_SUFFIX).write(b"foo\0bar")
+    assert uflash._hex_cache_get(cache_dir, "valid", 2) == [b"foo", b"bar"]
+
+
+def test_hex_cache_put_error(tmpdir):
+    """
+    Errors writing to the cache are ignored.
+    """
+    cache_dir = tmpdir.join("not_a_dir")
+    cache_dir.write(b"")
+
+    uflash._hex_cache_put(str(cache_dir), "key", [b"foo", b"bar"])
+
+    assert cache_dir.read() == ""
+
+
+def test_write_atomically_error(tmpdir):
+    """
+    The temporary file is removed if it can't be written or renamed, so the
+    hex cache and py2hex manifest don't leave files behind when the disk is
+    full.
+    """
+    with mock.patch(
+        "os.replace", side_effect=OSError("No space left"), create=True
+    ), mock.patch("os.rename", side_effect=OSError("No space left")):
+        with pytest.raises(OSError):
+            uflash._write_atomically(str(tmpdir.join("foo")), b"foo")
+        uflash._hex_cache_put(str(tmpdir), "key", [b"foo", b"bar"])
+        uflash._write_manifest(str(tmpdir), {})
+    assert tmpdir.listdir() == []
+    uflash._write_atomically(str(tmpdir.join("foo")), b"foo")
+    assert tmpdir.listdir() == [tmpdir.join("foo")]
+    assert tmpdir.join("foo").read_binary() == b"foo"
+
+
+def test_hex_cache_evict(tmpdir):
+    """
+    The least recently used entries are removed until the cache fits in its
+    maximum size.
+    """
+    for i, name in enumerate(["old", "recent", "new"]):
+        entry = tmpdir.join(name + uflash._HEX_CACHE_SUFFIX)
+        entry.write(b"0" * 100)
+        entry.setmtime(1000 + i)
+    # Recently used, so should be kept
+    uflash._hex_cache_get(str(tmpdir), "old", 1)
+    tmpdir.join("other.txt").write(b"0" * 1000)
+
+    uflash._hex_cache_evict(str(tmpdir), 250)
+
+    assert sorted(os.listdir(str(tmpdir))) == [
+        "new" + uflash._HEX_CACHE_SUFFIX,
+        "old" + uflash._HEX_CACHE_SUFFIX,
+        "other.txt",
+    ]
+    with mock.patch("uflash._HEX_CACHE_MAX_SIZE", 0):
+        uflash._hex_cache_evict(str(tmpdir))
+    assert os.listdir(str(tmpdir)) == ["other.txt"]
+
+
+def test_uhex_digest():
+    """
+    The digest of a Universal Hex is cached by its identity, and is the same
+    for it as a string or as bytes.
+    """
+    uhex = "\n".join(TEST_UNIVERSAL_HEX_LIST)
+    expected = hashlib.sha256(uhex.encode("ascii")).hexdigest()
+
+    with mock.patch.dict(uflash._UHEX_DIGEST_CACHE, clear=True):
+        assert uflash._uhex_digest(uhex) == expected
+        assert uflash._UHEX_DIGEST_CACHE == {id(uhex): (uhex, expected)}
+        assert uflash._uhex_digest(uhex.encode("ascii")) == expected
+        with mock.patch("hashlib.sha256") as mock_sha256:
+            assert uflash._uhex_digest(uhex) == expected
+        assert mock_sha256.call_count == 0
+
+
+def test_uhex_splice_index_cache_size():
+    """
+    The cache of splice indexes doesn't grow past its maximum size.
+    """
+    uhex = "\n".join(TEST_UNIVERSAL_HEX_LIST)
+
+    with mock.patch.dict(uflash._SPLICE_INDEX_CACHE, clear=True):
+        for i in range(uflash._SPLICE_INDEX_CACHE_SIZE + 1):
+            uflash._uhex_splice_index(uhex + (":00000001FF\n" * i))
+        assert len(uflash._SPLICE_INDEX_CACHE) == 1
+
+
+def test_embed_fs_uhex_runtime():
+    """
+    Embedding a script into the runtime twice gives the same result, with the
+    filesystem placed before the UICR of each section.
+    """
+    runtime = uflash.get_runtime()
+
+    with mock.patch.dict(uflash._SPLICE_INDEX_CACHE, clear=True):
+        first = uflash.embed_fs_uhex(runtime, TEST_SCRIPT)
+        second = uflash.embed_fs_uhex(runtime, TEST_SCRIPT)
+
+    assert first == second
+    assert len(first) % 512 == len(runtime) % 512
+    assert first.count(":020000040000FA\n:0400000A") == 2
+    fs_v1 = uflash.pad_hex_string(
+        uflash.script_to_fs(TEST_SCRIPT, uflash._MICROBIT_ID_V1)
+    )
+    fs_v2 = uflash.pad_hex_string(
+        uflash.script_to_fs(TEST_SCRIPT, uflash._MICROBIT_ID_V2)
+    )
+    assert first.find(fs_v1) < first.find(":020000041000EA")
+    assert first.rfind(fs_v2) < first.rfind(":020000041000EA")
+
+
 def test_embed_fs_uhex_empty_code():
     uhex = "\n".join(TEST_UNIVERSAL_HEX_LIST)
 
     identical_uhex = uflash.embed_fs_uhex(uhex, "")
 
     assert identical_uhex == uhex
+
+
+def test_iter_runtime_image(tmpdir):
+    """
+    The runtime image is read entry by entry, with the data of each segment
+    in blocks of whole records (or skipped), and it must be valid.
+    """
+    image = uflash._pack_runtime_image("\n".join(TEST_UNIVERSAL_HEX_LIST))
+    image_path = tmpdir.join("runtime.bin")
+    image_path.write_binary(image)
+    with open(str(image_path), "rb") as image_file:
+        entries = list(uflash._iter_runtime_image(image_file, 20))
+    hex_records = []
+    for entry in entries:
+        if isinstance(entry, tuple):
+            record_type, record_size, address, data = entry
+            assert len(data) <= 20
+            hex_records.append(
+                uflash._data_records_to_hex(
+                    address, record_type, data, record_size
+                )
+            )
+        else:
+            hex_records.append(
+                b":" + binascii.hexlify(entry).upper() + b"\n"
+            )
+    assert b"".join(hex_records) == uflash._runtime_image_to_hex(
+        memoryview(image)
+    )
+    with open(str(image_path), "rb") as image_file:
+        segments = [
+            entry
+            for entry in uflash._iter_runtime_image(image_file)
+            if isinstance(entry, tuple)
+        ]
+    assert segments
+    assert all(isinstance(segment[3], int) for segment in segments)
+    image_path.write_binary(b"BAD" + image)
+    with open(str(image_path), "rb") as image_file:
+        with pytest.raises(ValueError):
+            list(uflash._iter_runtime_image(image_file))
+    image_path.write_binary(uflash._RUNTIME_IMAGE_MAGIC + b"\x07")
+    with open(str(image_path), "rb") as image_file:
+        with pytest.raises(ValueError):
+            list(uflash._iter_runtime_image(image_file))
+
+
+def test_data_records_hex_len():
+    """
+    The length of the hex records of some data is worked out without encoding
+    it.
+    """
+    for data_len in (0, 1, 15, 16, 17, 100):
+        for record_size in (1, 16, 32):
+            data = b"\xAB" * data_len
+            assert uflash._data_records_hex_len(data_len, record_size) == len(
+                uflash._data_records_to_hex(0, 0, data, record_size)
+            )
+
+
+def test_runtime_image_splice_index(tmpdir):
+    """
+    The splice index worked out from the runtime image is the same as the
+    one of its hex, and the image must be of a Universal Hex.
+    """
+    assert uflash._runtime_image_splice_index(
+        uflash._RUNTIME_PATH
+    ) == uflash._uhex_splice_index(uflash._get_runtime_hex())
+    uhex = "\n".join(TEST_UNIVERSAL_HEX_LIST)
+    image_path = tmpdir.join("runtime.bin")
+    image_path.write_binary(uflash._pack_runtime_image(uhex))
+    assert uflash._runtime_image_splice_index(
+        str(image_path)
+    ) == uflash._uhex_splice_index(uhex)
+    section = uhex[: uhex.find(":020000040000FA", 1)]
+    image_path.write_binary(uflash._pack_runtime_image(section))
+    with pytest.raises(ValueError):
+        uflash._runtime_image_splice_index(str(image_path))
+
+
+def test_iter_low_memory_hex():
+    """
+    The hex generated from the runtime image block by block is the same as
+    the one embedding the script into the runtime, without ever loading the
+    runtime.
+    """
+    expected = [
+        b"".join(uflash._embed_fs_uhex_chunks(uflash._get_runtime_hex(), code))
+        for code in (None, TEST_SCRIPT)
+    ]
+    with mock.patch("uflash._RUNTIME_HEX", None):
+        assert b"".join(uflash._iter_low_memory_hex()) == expected[0]
+        chunks = list(uflash._iter_low_memory_hex(TEST_SCRIPT))
+        assert uflash._RUNTIME_HEX is None
+    assert b"".join(chunks) == expected[1]
+    assert max(len(chunk) for chunk in chunks) < 16 * 1024
+
+
+def test_iter_hex_low_memory():
+    """
+    The blocks of iter_hex are the same in low memory mode.
+    """
+    assert list(uflash.iter_hex(TEST_SCRIPT, 4096, low_memory=True)) == list(
+        uflash.iter_hex(TEST_SCRIPT, 4096)
+    )
+
+
+def test_flash_single_streamed(tmpdir):
+    """
+    A single hex is streamed from the runtime image, without building the
+    runtime hex, and is the same as the one built from it. Several devices
+    share the runtime hex instead.
+    """
+    script = b"print('a')\n"
+    expected = uflash.embed_fs_uhex(uflash._RUNTIME, script)
+    with mock.patch("uflash._RUNTIME_HEX", None):
+        hex_paths = uflash.flash(
+            python_script=script, paths_to_microbits=[str(tmpdir)]
+        )
+        assert uflash._RUNTIME_HEX is None
+        with open(hex_paths[0]) as hex_file:
+            assert hex_file.read() == expected
+        with mock.patch("uflash.find_microbit", return_value=str(tmpdir)):
+            uflash.flash()
+        assert uflash._RUNTIME_HEX is None
+        with open(hex_paths[0]) as hex_file:
+            assert hex_file.read() == uflash._RUNTIME
+        devices = [str(tmpdir.mkdir("one")), str(tmpdir.mkdir("two"))]
+        uflash.flash(python_script=script, paths_to_microbits=devices)
+        assert uflash._RUNTIME_HEX is not None
+
+
+def test_flash_single_streamed_script_too_big(tmpdir):
+    """
+    A script too big for the filesystem is found out before the streamed hex
+    is written.
+    """
+    with mock.patch("uflash._RUNTIME_HEX", None):
+        with pytest.raises(ValueError):
+            uflash.flash(
+                python_script=b"x" * (1024 * 1024),
+                paths_to_microbits=[str(tmpdir)],
+            )
+    assert tmpdir.listdir() == []
+
+
+def test_py2hex_builds_runtime_once(tmpdir):
+    """
+    Hexifying several scripts one at a time builds the runtime hex once for
+    all of them, rather than streaming it for each one.
+    """
+    tmpdir.join("a.py").write("print('a')\n")
+    tmpdir.join("b.py").write("print('b')\n")
+    with mock.patch("uflash._RUNTIME_HEX", None):
+        uflash.py2hex(
+            argv=[str(tmpdir.join("a.py")), str(tmpdir.join("b.py")), "-j1"]
+        )
+        assert uflash._RUNTIME_HEX is not None
+    for name in ("a", "b"):
+        assert tmpdir.join(name + ".hex").read() == uflash.embed_fs_uhex(
+            uflash._RUNTIME, "print('{}')\n".format(name).encode("ascii")
+        )
+
+
+def test_flash_low_memory(tmpdir):
+    """
+    In low memory mode the hex is streamed to each of the devices, and is
+    the same as the one flashed normally.
+    """
+    tmpdir.join("a.py").write("print('a')\n")
+    devices = [str(tmpdir.mkdir("one")), str(tmpdir.mkdir("two"))]
+    observer = mock.MagicMock()
+    with mock.patch("uflash._RUNTIME_HEX", None):
+        hex_paths = uflash.flash(
+            str(tmpdir.join("a.py")),
+            devices,
+            observer=observer,
+            low_memory=True,
+        )
+        assert uflash._RUNTIME_HEX is None
+    expected = uflash.embed_fs_uhex(uflash._RUNTIME, b"print('a')\n")
+    for hex_path in hex_paths:
+        with open(hex_path) as hex_file:
+            assert hex_file.read() == expected
+        observer.assert_any_call(
+            "write", {"path": hex_path, "bytes": len(expected)}
+        )
+
+
+def test_flash_low_memory_stages(tmpdir):
+    """
+    A low memory flash reports the runtime generation and the streamed
+    writes as a single stage each, however many chunks the hex has.
+    """
+    observer = mock.MagicMock()
+    uflash.flash(
+        paths_to_microbits=[str(tmpdir)],
+        python_script=b"print('hello')",
+        low_memory=True,
+        observer=observer,
+    )
+    events = [c[0] for c in observer.call_args_list]
+    for stage in ("runtime", "write"):
+        assert events.count(("stage_start", {"stage": stage})) == 1
+        ends = [
+            e for e in events if e[0] == "stage_end" and e[1]["stage"] == stage
+        ]
+        assert len(ends) == 1
+    assert len(events) < 30
+
+
+def test_py2hex_serve_low_memory(tmpdir):
+    """
+    The scripts requested can be hexified in low memory mode too.
+    """
+    requests = mock.MagicMock(
+        readline=mock.MagicMock(
+            side_effect=[
+                json.dumps(
+                    {
+                        "source": "print('a')\n",
+                        "output": str(tmpdir.join("a.hex")),
+                    }
+                )
+                + "\n",
+                "",
+            ]
+        )
+    )
+    with mock.patch("uflash._RUNTIME_HEX", None):
+        with mock.patch("uflash._py2hex_worker_init") as mock_init:
+            uflash._py2hex_serve(requests, mock.MagicMock(), low_memory=True)
+        assert mock_init.call_count == 0
+        assert uflash._RUNTIME_HEX is None
+    assert tmpdir.join("a.hex").read() == uflash.embed_fs_uhex(
+        uflash._RUNTIME, b"print('a')\n"
+    )
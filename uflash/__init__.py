@@ -0,0 +1,3313 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains functions for turning a Python script into a .hex file
+and flashing it onto a BBC micro:bit.
+
+Copyright (c) 2015-2020 Nicholas H.Tollervey and others.
+
+See the LICENSE file for more information, or visit:
+
+https://opensource.org/licenses/MIT
+"""
+
+from __future__ import print_function
+
+import argparse
+import binascii
+import collections
+import ctypes
+import mmap
+import os
+import re
+import select
+import struct
+import sys
+from subprocess import check_output
+import threading
+import time
+
+
+#: The help text to be shown by uflash  when requested.
+_HELP_TEXT = """
+Flash Python onto the BBC micro:bit or extract Python from a .hex file.
+
+If no path to the micro:bit is provided uflash will attempt to autodetect the
+correct path to the device. If no path to the Python script is provided uflash
+will flash the unmodified MicroPython firmware onto the device. Use the -e flag
+to recover a Python script from a hex file. Use the -r flag to specify a custom
+version of the MicroPython runtime.
+
+Documentation is here: https://uflash.readthedocs.io/en/latest/
+"""
+
+_PY2HEX_HELP_TEXT = """
+A simple utility script intended for creating hexified versions of MicroPython
+scripts on the local filesystem _NOT_ the microbit.  Does not autodetect a
+microbit.  Accepts multiple input scripts and optionally one output directory.
+"""
+
+#: MAJOR, MINOR, RELEASE, STATUS [alpha, beta, final], VERSION of uflash
+_VERSION = (
+    2,
+    0,
+    0,
+)
+
+#: The version number reported by the bundled MicroPython in os.uname().
+MICROPYTHON_V1_VERSION = "1.0.1"
+MICROPYTHON_V2_VERSION = "2.0.0"
+
+#: (Deprecated) The magic start address in flash memory to extract script.
+_SCRIPT_ADDR = 0x3E000
+
+#: Filesystem boundaries, this might change with different MicroPython builds.
+_MICROBIT_ID_V1 = "9900"
+_FS_START_ADDR_V1 = 0x38C00
+# UICR value 0x40000 - 0x400 (scratch page) - 0x400 (mag page) = 0x3F800
+_FS_END_ADDR_V1 = 0x3F800
+
+_MICROBIT_ID_V2 = "9903"
+_FS_START_ADDR_V2 = 0x6D000
+# Flash region value 0x73000 - 0x1000 (scratch page) = 0x72000
+_FS_END_ADDR_V2 = 0x72000
+
+_MAX_SIZE = min(
+    _FS_END_ADDR_V2 - _FS_START_ADDR_V2, _FS_END_ADDR_V1 - _FS_START_ADDR_V1
+)
+
+#: Path to the MicroPython runtime image bundled with this package.
+_RUNTIME_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "firmware.bin"
+)
+
+#: The runtime hex as ASCII bytes, generated on demand by _get_runtime_hex().
+_RUNTIME_HEX = None
+
+#: The runtime image format, see _pack_runtime_image() for the details.
+_RUNTIME_IMAGE_MAGIC = b"UFRT\x01"
+_RUNTIME_IMAGE_RECORD = 0x00
+_RUNTIME_IMAGE_DATA = 0x01
+_RUNTIME_IMAGE_DATA_HEADER = ">BBHI"
+_DATA_RECORD_TYPES = (0x00, 0x0D)
+
+#: In low memory mode, the most bytes of runtime data read from the image (and
+#: turned into hex records) at a time.
+_LOW_MEMORY_BLOCK_SIZE = 4096
+#: The same, when a single hex is streamed from the image, see _hex_chunks.
+_STREAM_BLOCK_SIZE = 64 * 1024
+
+#: The SHA-256 digest of the runtime image, see _runtime_image_digest().
+_RUNTIME_IMAGE_DIGEST = None
+
+#: The Linux mount table, read instead of running the "mount" command.
+_MOUNTINFO_PATH = "/proc/self/mountinfo"
+
+#: The micro:bit board versions, by the first four digits of the device ID.
+_MICROBIT_BOARD_VERSIONS = {
+    "9900": 1,
+    "9901": 1,
+    "9903": 2,
+    "9904": 2,
+    "9905": 2,
+    "9906": 2,
+}
+
+#: Cache of the micro:bits found by find_all_microbits(), along with the
+#: poll object that tells when the mount table has changed.
+_MICROBITS_CACHE = {}
+
+#: Cache of the Universal Hex sections splice index, see _uhex_splice_index.
+#: Like the digest cache below, it's keyed by the identity of each Universal
+#: Hex (see _identity_cache_get) and only holds a couple of them: the bundled
+#: runtime as a string and as bytes.
+_SPLICE_INDEX_CACHE = {}
+_SPLICE_INDEX_CACHE_SIZE = 2
+
+#: Cache of the Universal Hex SHA-256 digests, see _uhex_digest.
+_UHEX_DIGEST_CACHE = {}
+
+#: The on-disk hex cache entries file suffix and maximum total size in bytes.
+_HEX_CACHE_SUFFIX = ".fs.hex"
+_HEX_CACHE_MAX_SIZE = 64 * 1024 * 1024
+
+#: The py2hex manifest of up to date hex files, kept in the output directory.
+_PY2HEX_MANIFEST = ".uflash-manifest.json"
+
+#: In-process least recently used cache of generated filesystem hex records,
+#: see cache_info(), cache_clear() and cache_configure().
+_HEX_MEMO = collections.OrderedDict()
+#: The tokens identifying the Universal Hexes in its keys, see _hex_memo_key.
+_HEX_MEMO_RUNTIMES = {}
+_HEX_MEMO_LOCK = threading.Lock()
+_HEX_MEMO_STATS = {"hits": 0, "misses": 0, "size": 0}
+_HEX_MEMO_MAX_ENTRIES = 32
+_HEX_MEMO_MAX_SIZE = 4 * 1024 * 1024
+
+#: The inotify(7) events watched for (a file written and closed, or moved
+#: into a watched directory) and the layout of each event header.
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_INOTIFY_EVENT_HEADER = "iIII"
+
+#: The default number of seconds without changes before a watched script is
+#: flashed, so a burst of saves results in a single flash.
+_WATCH_QUIET_PERIOD = 0.1
+
+#: The observers of every flash, called with each event (see add_observer).
+_OBSERVERS = []
+
+#: Per thread, the observers of the flash() call in progress (the global
+#: observers plus the one passed to it) if any.
+_OBSERVING = threading.local()
+
+#: The clock used to time the stages.
+_timer = getattr(time, "perf_counter", time.time)
+
+#: Translation table to turn a byte sum into an Intel Hex checksum.
+_CHECKSUM_TABLE = bytes(bytearray((-i) & 0xFF for i in range(256)))
+
+
+#: A micro:bit found by find_all_microbits(). The device_id and version
+#: (1 or 2) are None if they can't be read from the device.
+Microbit = collections.namedtuple("Microbit", ["path", "device_id", "version"])
+
+
+class FlashError(IOError):
+    """
+    Raised by flash() when the hex file could not be written to some of the
+    micro:bit devices. The errors attribute is a dictionary with the hex path
+    of each device that failed mapped to the exception raised.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(FlashError, self).__init__(
+            "Unable to flash {} of the micro:bits: {}".format(
+                len(errors),
+                ", ".join(
+                    "{} ({!s})".format(path, error)
+                    for path, error in sorted(errors.items())
+                ),
+            )
+        )
+
+
+class _Span(object):
+    """
+    Times the stage run inside its with block, notifying the observers when it
+    starts and ends (with the seconds it took, and the error if it failed).
+    """
+
+    def __init__(self, stage, observers):
+        self.stage = stage
+        self.observers = observers
+
+    def __enter__(self):
+        _notify(self.observers, "stage_start", stage=self.stage)
+        self.start = _timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = _timer() - self.start
+        if exc_type is None:
+            _notify(
+                self.observers,
+                "stage_end",
+                stage=self.stage,
+                duration=duration,
+            )
+        else:
+            _notify(
+                self.observers,
+                "stage_end",
+                stage=self.stage,
+                duration=duration,
+                error="{!s}".format(exc_value),
+            )
+
+
+class _NoSpan(object):
+    """
+    Stands in for a _Span when there are no observers, so the stages aren't
+    timed at all.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def close(self, error=None):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _AccumulatedSpan(object):
+    """
+    Times a stage run in many small steps, such as generating the runtime hex
+    block by block as it's written. The observers are notified once: the
+    stage starts when the span is created and ends when it's closed, with the
+    duration adding up the time spent within the with blocks of its steps.
+    """
+
+    def __init__(self, stage, observers):
+        self.stage = stage
+        self.observers = observers
+        self.duration = 0
+        _notify(self.observers, "stage_start", stage=self.stage)
+
+    def __enter__(self):
+        self.start = _timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration += _timer() - self.start
+
+    def close(self, error=None):
+        """
+        Ends the stage, which failed if there's an error.
+        """
+        data = {"stage": self.stage, "duration": self.duration}
+        if error is not None:
+            data["error"] = "{!s}".format(error)
+        _notify(self.observers, "stage_end", **data)
+
+
+def _observers():
+    """
+    Returns the observers of the flash in progress in this thread.
+    """
+    return getattr(_OBSERVING, "observers", _OBSERVERS)
+
+
+class _Observing(object):
+    """
+    Adds the observers to those of everything done by the current thread in
+    its with block (for flash's observer argument).
+    """
+
+    def __init__(self, observers):
+        self.observers = observers
+
+    def __enter__(self):
+        self.previous = getattr(_OBSERVING, "observers", None)
+        _OBSERVING.observers = self.observers
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.previous is None:
+            del _OBSERVING.observers
+        else:
+            _OBSERVING.observers = self.previous
+
+
+def _span(stage):
+    """
+    Returns a context manager timing the named stage if there are any
+    observers, otherwise one that does nothing.
+    """
+    observers = _observers()
+    return _Span(stage, observers) if observers else _NO_SPAN
+
+
+def _accumulated_span(stage):
+    """
+    Returns an _AccumulatedSpan of the named stage if there are any
+    observers, otherwise a span that does nothing.
+    """
+    observers = _observers()
+    return _AccumulatedSpan(stage, observers) if observers else _NO_SPAN
+
+
+def _notify(observers, event, **data):
+    """
+    Calls each of the observers with the event and its data.
+    """
+    for observer in list(observers):
+        observer(event, data)
+
+
+def add_observer(observer):
+    """
+    Registers an observer of every flash: a function called with the name of
+    each event that happens and a dictionary with its data. The events are:
+
+    * "stage_start", with the "stage" name, when a stage starts. The stages
+      are "find_microbit", "read_script", "runtime" (generating the runtime
+      hex), "script_to_fs", "embed_fs_uhex", "encode", "write" and "fsync",
+      and some of them happen more than once (for example, "script_to_fs"
+      runs for every section of the Universal Hex).
+    * "stage_end", with the "stage" name and its "duration" in seconds, when
+      the stage ends. If it failed, the "error" message is included.
+    * "write", with the "path" of the hex file and the number of "bytes"
+      written to it, when a hex file has been written.
+    * "cache_hit", with the "cache" ("memory" or "disk") the filesystem of
+      the script was found in, or "cache_miss" if it had to be generated.
+    * "error", with the "error" message and the "path" of the hex file (None
+      if the failure wasn't writing to a device), when flashing fails.
+
+    Observers are called in the thread that caused the event, which isn't
+    always the caller's (devices can be flashed in parallel, see flash).
+
+    When there are no observers the events aren't even created.
+    """
+    _OBSERVERS.append(observer)
+
+
+def remove_observer(observer):
+    """
+    Unregisters an observer added with add_observer().
+    """
+    _OBSERVERS.remove(observer)
+
+
+class _TimingCallback(object):
+    """
+    Observer calling a timing callback with the name and duration of each
+    stage, see add_timing_callback().
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def __call__(self, event, data):
+        if event == "stage_end":
+            self.callback(data["stage"], data["duration"])
+
+
+def add_timing_callback(callback):
+    """
+    Registers a function to be called with the name and duration (in seconds)
+    of each stage of creating and flashing a hex file, as it ends. This is a
+    shortcut for the "stage_end" events of an observer, see add_observer().
+    """
+    add_observer(_TimingCallback(callback))
+
+
+def remove_timing_callback(callback):
+    """
+    Unregisters a function added with add_timing_callback().
+    """
+    for observer in _OBSERVERS:
+        if (
+            isinstance(observer, _TimingCallback)
+            and observer.callback is callback
+        ):
+            remove_observer(observer)
+            return
+    raise ValueError("The timing callback isn't registered.")
+
+
+class JSONLinesObserver(object):
+    """
+    An observer (see add_observer) writing each event as a line of JSON to
+    the output text file, for metrics pipelines to consume. Each line is an
+    object with the "event" name, the "time" it happened (in seconds since
+    the epoch) and the event's data.
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.lock = threading.Lock()
+
+    def __call__(self, event, data):
+        import json
+        record = dict(data, event=event, time=time.time())
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with self.lock:
+            self.output.write(line)
+            self.output.flush()
+
+
+class _TimingReport(object):
+    """
+    A timing callback adding up the time taken by each stage. Used as a
+    context manager, it's registered for the duration of the with block and
+    afterwards prints the timings to stderr.
+    """
+
+    def __init__(self):
+        self.timings = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __call__(self, stage, duration):
+        with self.lock:
+            self.timings[stage] = self.timings.get(stage, 0) + duration
+
+    def __enter__(self):
+        add_timing_callback(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        remove_timing_callback(self)
+        self.print_report()
+
+    def print_report(self, output=None):
+        """
+        Prints the milliseconds taken by each stage, and in total, to the
+        output file (stderr by default).
+        """
+        output = output or sys.stderr
+        print("Timings:", file=output)
+        for stage, duration in self.timings.items():
+            print(
+                "  {:<16}{:>10.3f} ms".format(stage, duration * 1000),
+                file=output,
+            )
+        print(
+            "  {:<16}{:>10.3f} ms".format(
+                "total", sum(self.timings.values()) * 1000
+            ),
+            file=output,
+        )
+
+
+class _MemoryReport(object):
+    """
+    An observer recording the peak memory allocated during each stage (as
+    traced by tracemalloc) over the memory allocated when it started. Used as
+    a context manager, it traces the memory allocations and is registered for
+    the duration of the with block, and afterwards prints the peaks to
+    stderr.
+
+    Stages running at the same time in different threads share their peaks,
+    so the devices should be flashed one at a time.
+    """
+
+    def __init__(self):
+        self.peaks = collections.OrderedDict()
+        self.peak = 0
+        self.stages = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def tracemalloc():
+        """
+        Returns the tracemalloc module, or None if it can't report the peak
+        of each stage (it needs Python 3.9 or later).
+        """
+        try:
+            import tracemalloc
+        except ImportError:  # pragma: no cover
+            return None
+        if not hasattr(tracemalloc, "reset_peak"):  # pragma: no cover
+            return None
+        return tracemalloc
+
+    def __call__(self, event, data):
+        if event not in ("stage_start", "stage_end"):
+            return
+        tracemalloc = self.tracemalloc()
+        with self.lock:
+            current, peak = tracemalloc.get_traced_memory()
+            self.peak = max(self.peak, peak)
+            # The peak is reset for every stage, so the stages in progress
+            # keep the highest peak seen while they run.
+            for stage in self.stages:
+                stage[1] = max(stage[1], peak)
+            if event == "stage_start":
+                self.stages.append([current, current])
+            elif self.stages:
+                start, stage_peak = self.stages.pop()
+                self.peaks[data["stage"]] = max(
+                    self.peaks.get(data["stage"], 0), stage_peak - start
+                )
+            tracemalloc.reset_peak()
+
+    def __enter__(self):
+        self.tracemalloc().start()
+        add_observer(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        remove_observer(self)
+        tracemalloc = self.tracemalloc()
+        self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        self.print_report()
+
+    def print_report(self, output=None):
+        """
+        Prints the peak KiB allocated by each stage, and overall, to the
+        output file (stderr by default).
+        """
+        output = output or sys.stderr
+        print("Peak memory:", file=output)
+        for stage, peak in self.peaks.items():
+            print(
+                "  {:<16}{:>10.1f} KiB".format(stage, peak / 1024.0),
+                file=output,
+            )
+        print(
+            "  {:<16}{:>10.1f} KiB".format("total", self.peak / 1024.0),
+            file=output,
+        )
+
+
+def _reports(parser, args):
+    """
+    Returns the reports (see _TimingReport and _MemoryReport) asked for by
+    the --timings and --memory-report command line arguments.
+    """
+    reports = []
+    if args.memory_report:
+        if not _MemoryReport.tracemalloc():  # pragma: no cover
+            parser.error("--memory-report needs Python 3.9 or later")
+        reports.append(_MemoryReport())
+    if args.timings:
+        reports.append(_TimingReport())
+    return reports
+
+
+def _run_reported(reports, func, *args):
+    """
+    Calls func with the args within the with blocks of all the reports, so
+    each of them is printed once it returns (or fails).
+    """
+    if reports:
+        with reports[0]:
+            return _run_reported(reports[1:], func, *args)
+    return func(*args)
+
+
+def get_version():
+    """
+    Returns a string representation of the version information of this project.
+    """
+    return ".".join([str(i) for i in _VERSION])
+
+
+def get_runtime():
+    """
+    Returns a string representation of the MicroPython runtime hex.
+
+    The runtime is only generated from the bundled firmware.bin image the
+    first time it is needed (not on import), after that the same string is
+    returned.
+    """
+    runtime = globals().get("_RUNTIME")
+    if runtime is None:
+        runtime = strfunc(_get_runtime_hex())
+        globals()["_RUNTIME"] = runtime
+    return runtime
+
+
+def _get_runtime_hex():
+    """
+    Returns the MicroPython runtime hex as ASCII encoded bytes, ready to be
+    written to a file.
+
+    Like get_runtime(), it is only generated from the bundled image the first
+    time it is needed and the same bytes object is shared by all callers.
+    """
+    global _RUNTIME_HEX
+    if _RUNTIME_HEX is None:
+        with _span("runtime"):
+            image = _load_runtime_image(_RUNTIME_PATH)
+            _RUNTIME_HEX = _runtime_image_to_hex(image)
+    return _RUNTIME_HEX
+
+
+def _pack_runtime_image(universal_hex_str):
+    """
+    Converts a string of Universal (or Intel) Hex records into the compact
+    binary runtime image bundled with uflash.
+
+    The image starts with _RUNTIME_IMAGE_MAGIC and is followed by entries in
+    the same order as the hex records, each opening with a tag byte:
+
+    * _RUNTIME_IMAGE_RECORD: A non-data record (Extended Linear Address,
+      Block Start, padding, End Of File, etc) stored as its raw bytes, the
+      first byte being the record data length.
+    * _RUNTIME_IMAGE_DATA: A segment of contiguous data records packed as
+      record type, record size, start address (the 2 LSB), segment length
+      (see _RUNTIME_IMAGE_DATA_HEADER) followed by the segment data.
+
+    So each Universal Hex section (V1 and V2) is kept as its address to bytes
+    segments, with only the records in between stored verbatim.
+
+    Will raise a ValueError if the hex records cannot be reproduced exactly
+    from the image (for example, lowercase hex or Windows line endings).
+    """
+    entries = [_RUNTIME_IMAGE_MAGIC]
+    segment = None
+    for line in universal_hex_str.split("\n")[:-1]:
+        record = bytearray(binascii.unhexlify(line[1:]))
+        record_size = record[0]
+        address = (record[1] << 8) | record[2]
+        record_type = record[3]
+        if record_type in _DATA_RECORD_TYPES and record_size:
+            if (
+                segment
+                and segment["type"] == record_type
+                and segment["last_size"] == segment["size"]
+                and segment["address"] + len(segment["data"]) == address
+            ):
+                # Continues the current segment.
+                segment["data"] += record[4:-1]
+                segment["last_size"] = record_size
+                continue
+            segment = {
+                "type": record_type,
+                "size": record_size,
+                "last_size": record_size,
+                "address": address,
+                "data": record[4:-1],
+            }
+            entries.append(segment)
+        else:
+            segment = None
+            entries.append(
+                struct.pack("B", _RUNTIME_IMAGE_RECORD) + bytes(record)
+            )
+    image = b"".join(
+        entry
+        if isinstance(entry, bytes)
+        else struct.pack(
+            ">B" + _RUNTIME_IMAGE_DATA_HEADER[1:],
+            _RUNTIME_IMAGE_DATA,
+            entry["type"],
+            entry["size"],
+            entry["address"],
+            len(entry["data"]),
+        )
+        + bytes(entry["data"])
+        for entry in entries
+    )
+    if strfunc(_runtime_image_to_hex(memoryview(image))) != universal_hex_str:
+        raise ValueError("The hex records cannot be packed losslessly.")
+    return image
+
+
+def _data_records_to_hex(address, record_type, data, record_size=16):
+    """
+    Encodes the data (bytes) into consecutive Intel Hex data records of the
+    given type, each with record_size bytes of data (except the last one),
+    starting at the 16 bit address. All records must fit within the same
+    0x10000 address range.
+
+    Returns the bytes of the ASCII records, each followed by a new line.
+
+    Instead of encoding one record at a time, the binary records are laid out
+    together with extended slices and hexlified in one go. The checksums are
+    calculated in bulk as well, by adding the record byte "columns" as big
+    integers with a 16 bit slot per record (so the sums never carry over).
+    """
+    if len(data) < record_size:
+        record_size = len(data)
+        if not record_size:
+            return b""
+    count = len(data) // record_size
+    remainder = len(data) - (count * record_size)
+    stride = record_size + 5
+    records = bytearray(stride * count)
+    records[0::stride] = bytearray([record_size]) * count
+    addresses = struct.pack(
+        ">{}H".format(count),
+        *range(address, address + (record_size * count), record_size)
+    )
+    records[1::stride] = addresses[0::2]
+    records[2::stride] = addresses[1::2]
+    records[3::stride] = bytearray([record_type]) * count
+    for j in range(record_size):
+        records[4 + j :: stride] = data[j : count * record_size : record_size]
+    total = 0
+    column = bytearray(2 * count)
+    # int.from_bytes (Python 3) avoids going through hex digits.
+    from_bytes = getattr(int, "from_bytes", None)
+    for j in range(stride - 1):
+        column[1::2] = records[j::stride]
+        if from_bytes:
+            total += from_bytes(column, "big")
+        else:  # pragma: no cover
+            total += int(binascii.hexlify(column), 16)
+    if from_bytes:
+        sums = total.to_bytes(2 * count, "big")
+    else:  # pragma: no cover
+        sums = binascii.unhexlify("{:0{}X}".format(total, 4 * count))
+    records[stride - 1 :: stride] = sums[1::2].translate(_CHECKSUM_TABLE)
+    # Now the ASCII records, with the colon start code and a new line.
+    hex_records = binascii.hexlify(records).upper()
+    line_len = (stride * 2) + 2
+    lines = bytearray(line_len * count)
+    lines[0::line_len] = b":" * count
+    lines[line_len - 1 :: line_len] = b"\n" * count
+    for j in range(stride * 2):
+        lines[1 + j :: line_len] = hex_records[j :: stride * 2]
+    if remainder:
+        lines += _data_records_to_hex(
+            address + (count * record_size),
+            record_type,
+            data[count * record_size :],
+            remainder,
+        )
+    return bytes(lines)
+
+
+def _load_runtime_image(path):
+    """
+    Returns a read-only memoryview of the runtime image found at path.
+
+    The file is memory mapped where possible, so only the pages of the image
+    that are actually used get loaded (and they are shared between processes).
+    """
+    with open(path, "rb") as image_file:
+        try:
+            image = memoryview(
+                mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ)
+            )
+        except (TypeError, ValueError, EnvironmentError):
+            # No memory map support for this file (or memoryview of an mmap in
+            # Python 2), so just read it.
+            image = memoryview(image_file.read())
+    if image[: len(_RUNTIME_IMAGE_MAGIC)].tobytes() != _RUNTIME_IMAGE_MAGIC:
+        raise ValueError("Unknown runtime image format: {}".format(path))
+    return image
+
+
+def _runtime_image_to_hex(image):
+    """
+    Serialises a runtime image (see _pack_runtime_image) back into the bytes
+    of the exact Universal Hex it was created from.
+    """
+    output = []
+    header_size = struct.calcsize(_RUNTIME_IMAGE_DATA_HEADER)
+    i = len(_RUNTIME_IMAGE_MAGIC)
+    image_len = len(image)
+    while i < image_len:
+        tag = bytearray(image[i : i + 1])[0]
+        i += 1
+        if tag == _RUNTIME_IMAGE_RECORD:
+            record_len = bytearray(image[i : i + 1])[0] + 5
+            output.append(b":")
+            output.append(binascii.hexlify(image[i : i + record_len]).upper())
+            output.append(b"\n")
+            i += record_len
+        elif tag == _RUNTIME_IMAGE_DATA:
+            (record_type, record_size, address, data_len) = struct.unpack(
+                _RUNTIME_IMAGE_DATA_HEADER, image[i : i + header_size]
+            )
+            i += header_size
+            output.append(
+                _data_records_to_hex(
+                    address,
+                    record_type,
+                    image[i : i + data_len].tobytes(),
+                    record_size,
+                )
+            )
+            i += data_len
+        else:
+            raise ValueError("Corrupted runtime image.")
+    return b"".join(output)
+
+
+def _iter_runtime_image(image_file, block_size=None):
+    """
+    Generates the entries of a runtime image (see _pack_runtime_image) as they
+    are read from the binary image_file, so the image is never all in memory.
+
+    Non-data records are generated as their raw bytes and data segments as
+    (record type, record size, address, data) tuples, with the data read in
+    blocks of up to block_size bytes (a whole number of records), each with
+    its own address. If the block_size is None the data is skipped instead of
+    read, and each segment is generated with the length of its data.
+    """
+    if image_file.read(len(_RUNTIME_IMAGE_MAGIC)) != _RUNTIME_IMAGE_MAGIC:
+        raise ValueError("Unknown runtime image format.")
+    header_size = struct.calcsize(_RUNTIME_IMAGE_DATA_HEADER)
+    while True:
+        tag = image_file.read(1)
+        if not tag:
+            return
+        tag = bytearray(tag)[0]
+        if tag == _RUNTIME_IMAGE_RECORD:
+            record = image_file.read(1)
+            record += image_file.read(bytearray(record)[0] + 4)
+            yield record
+        elif tag == _RUNTIME_IMAGE_DATA:
+            (record_type, record_size, address, data_len) = struct.unpack(
+                _RUNTIME_IMAGE_DATA_HEADER, image_file.read(header_size)
+            )
+            if block_size is None:
+                image_file.seek(data_len, os.SEEK_CUR)
+                yield record_type, record_size, address, data_len
+                continue
+            step = max(block_size // record_size, 1) * record_size
+            for i in range(0, data_len, step):
+                yield (
+                    record_type,
+                    record_size,
+                    address + i,
+                    image_file.read(min(step, data_len - i)),
+                )
+        else:
+            raise ValueError("Corrupted runtime image.")
+
+
+def _data_records_hex_len(data_len, record_size):
+    """
+    Returns the length of the hex records _data_records_to_hex() encodes
+    data_len bytes of data into, without encoding them.
+    """
+    count, remainder = divmod(data_len, record_size)
+    # Each record is a colon, its bytes as hex and a new line.
+    hex_len = count * ((record_size + 5) * 2 + 2)
+    if remainder:
+        hex_len += (remainder + 5) * 2 + 2
+    return hex_len
+
+
+def _runtime_image_splice_index(path):
+    """
+    Same as _uhex_splice_index(), but for the Universal Hex of the runtime
+    image at path, which is worked out from the non-data records of the image
+    without generating the hex.
+
+    Will raise a ValueError if the runtime isn't a Universal Hex.
+    """
+    records = []
+    offset = 0
+    with open(path, "rb") as image_file:
+        for entry in _iter_runtime_image(image_file):
+            if isinstance(entry, tuple):
+                offset += _data_records_hex_len(entry[3], entry[1])
+            else:
+                record = b":" + binascii.hexlify(entry).upper() + b"\n"
+                records.append((offset, record))
+                offset += len(record)
+    # As in _uhex_splice_index, each section starts with an Extended Linear
+    # Address record followed by a Block Start record, and the fs goes right
+    # before the last UICR Extended Linear Address record of the section
+    # (and the address records to 0x0000 that may come before it).
+    ela_record = b":020000040000FA\n"
+    esa_record = b":020000020000FC\n"
+    uicr_record = b":020000041000EA\n"
+    bounds = None
+    for (i, record), (next_i, next_record) in zip(records, records[1:]):
+        if (
+            i
+            and record == ela_record
+            and next_i == i + len(record)
+            and next_record.startswith(b":0400000A")
+        ):
+            bounds = (0, i, offset)
+            break
+    if not bounds:
+        raise ValueError("The runtime isn't a Universal Hex.")
+    index = []
+    for start, end in zip(bounds, bounds[1:]):
+        section = [(i, record) for i, record in records if start <= i < end]
+        device_ids = [
+            strfunc(record[9:13])
+            for _, record in section
+            if record.startswith(b":0400000A")
+        ]
+        uicrs = [
+            j for j, (_, record) in enumerate(section) if record == uicr_record
+        ]
+        if uicrs:
+            j = uicrs[-1]
+            for address_record in (ela_record, esa_record):
+                if (
+                    j
+                    and section[j - 1][1] == address_record
+                    and section[j - 1][0] + len(address_record)
+                    == section[j][0]
+                ):
+                    j -= 1
+            fs_i = section[j][0]
+        else:
+            fs_i = end - 1
+        index.append((start, fs_i, end, device_ids[0]))
+    return tuple(index)
+
+
+def _iter_low_memory_hex(python_code=None, block_size=None, fs_hexes=None):
+    """
+    Generates the MicroPython runtime Universal Hex, with the Python script
+    (in bytes format) embedded into its filesystem, as chunks of ASCII bytes
+    encoded as the runtime image is read block by block.
+
+    Unlike _embed_fs_uhex_chunks(), neither the runtime image nor its hex are
+    ever kept in memory (nor cached), only the hex of one block of up to
+    block_size (by default _LOW_MEMORY_BLOCK_SIZE) bytes of runtime data and
+    the filesystem records of one section at a time. Unless the filesystem
+    records of every section are given as fs_hexes (see _fs_hex).
+    """
+    splices = []
+    if python_code:
+        index = _runtime_image_splice_index(_RUNTIME_PATH)
+        splices = [
+            (fs_i, device_id, fs_hexes[i] if fs_hexes else None)
+            for i, (_, fs_i, _, device_id) in enumerate(index)
+        ]
+    offset = 0
+    # A single "runtime" stage for the whole hex, timing each block.
+    runtime_span = _accumulated_span("runtime")
+    error = None
+    try:
+        with open(_RUNTIME_PATH, "rb") as image_file:
+            entries = _iter_runtime_image(
+                image_file, block_size or _LOW_MEMORY_BLOCK_SIZE
+            )
+            while True:
+                with runtime_span:
+                    entry = next(entries, None)
+                    if entry is None:
+                        break
+                    if isinstance(entry, tuple):
+                        record_type, record_size, address, data = entry
+                        chunk = _data_records_to_hex(
+                            address, record_type, data, record_size
+                        )
+                    else:
+                        chunk = b":" + binascii.hexlify(entry).upper() + b"\n"
+                while splices and splices[0][0] < offset + len(chunk):
+                    fs_i, device_id, fs_hex = splices.pop(0)
+                    if fs_i > offset:
+                        yield chunk[: fs_i - offset]
+                        chunk = chunk[fs_i - offset :]
+                        offset = fs_i
+                    yield fs_hex or _fs_hex(python_code, device_id)
+                offset += len(chunk)
+                yield chunk
+    except Exception as ex:
+        error = ex
+        raise
+    finally:
+        runtime_span.close(error)
+
+
+class _LowMemoryHex(object):
+    """
+    The hex file of a Python script (in bytes format) for save_hex(), which
+    streams it from the runtime image each time it's iterated over (see
+    _iter_low_memory_hex, which takes the other arguments), for each of the
+    devices it's saved to.
+    """
+
+    def __init__(self, python_code=None, block_size=None, fs_hexes=None):
+        self.python_code = python_code
+        self.block_size = block_size
+        self.fs_hexes = fs_hexes
+
+    def __iter__(self):
+        return _iter_low_memory_hex(
+            self.python_code, self.block_size, self.fs_hexes
+        )
+
+
+def strfunc(raw):
+    """
+    Compatibility for 2 & 3 str()
+    """
+    return str(raw) if sys.version_info[0] == 2 else str(raw, "utf-8")
+
+
+def _normalise_script(script):
+    """
+    Returns the Python script (in bytes format) with its line endings
+    converted, in case the file was created on Windows.
+    """
+    script = script.replace(b"\r\n", b"\n")
+    return script.replace(b"\r", b"\n")
+
+
+def script_to_fs(script, microbit_version_id):
+    """
+    Convert a Python script (in bytes format) into Intel Hex records, which
+    location is configured within the micro:bit MicroPython filesystem and the
+    data is encoded in the filesystem format.
+
+    For more info:
+    https://github.com/bbcmicrobit/micropython/blob/v1.0.1/source/microbit/filesystem.c
+    """
+    if not script:
+        return ""
+    script = _normalise_script(script)
+
+    # Find fs boundaries based on micro:bit version ID
+    if microbit_version_id == _MICROBIT_ID_V1:
+        fs_start_address = _FS_START_ADDR_V1
+        fs_end_address = _FS_END_ADDR_V1
+        universal_data_record = False
+    elif microbit_version_id == _MICROBIT_ID_V2:
+        fs_start_address = _FS_START_ADDR_V2
+        fs_end_address = _FS_END_ADDR_V2
+        universal_data_record = True
+    else:
+        raise ValueError(
+            "Incompatible micro:bit ID found: {}".format(microbit_version_id)
+        )
+
+    chunk_size = 128  # Filesystem chunks configure in MP to 128 bytes
+    chunk_data_size = 126  # 1st & last bytes are the prev/next chunk pointers
+    fs_size = fs_end_address - fs_start_address
+    # Total file size depends on data and filename length, as uFlash only
+    # supports a single file with a known name (main.py) we can calculate it
+    main_py_max_size = ((fs_size / chunk_size) * chunk_data_size) - 9
+    if len(script) >= main_py_max_size:
+        raise ValueError(
+            "Python script must be less than {} bytes.".format(
+                main_py_max_size
+            )
+        )
+
+    # First file chunk opens with:
+    # 0xFE - First byte indicates a file start
+    # 0x?? - Second byte stores offset where the file ends in the last chunk
+    # 0x07 - Third byte is the filename length (7 letters for main.py)
+    # Followed by UFT-8 encoded filename (in this case "main.py")
+    # Followed by the UFT-8 encoded file data until end of chunk data
+    header = b"\xFE\xFF\x07\x6D\x61\x69\x6E\x2E\x70\x79"
+    first_chunk_data_size = chunk_size - len(header) - 1
+
+    # Work out how many chunks are needed and how full the last one is
+    if len(script) <= first_chunk_data_size:
+        chunk_count = 1
+        last_chunk_len = len(header) + len(script)
+    else:
+        extra_data_size = len(script) - first_chunk_data_size
+        chunk_count = 1 + -(-extra_data_size // chunk_data_size)
+        last_chunk_len = 1 + extra_data_size
+        last_chunk_len -= (chunk_count - 2) * chunk_data_size
+    # Calculate the end of file offset that goes into the header
+    last_chunk_offset = (last_chunk_len - 1) % chunk_data_size
+    # Weird edge case: If we have a 0 offset we need a empty chunk at the end
+    if last_chunk_offset == 0:
+        chunk_count += 1
+
+    # Build all the filesystem chunks in place, unused bytes are left as 0xFF
+    data = bytearray(b"\xff") * (chunk_count * chunk_size)
+    script = memoryview(script)
+    data[: len(header)] = header
+    data[1] = last_chunk_offset
+    chunk_data = script[:first_chunk_data_size]
+    data[len(header) : len(header) + len(chunk_data)] = chunk_data
+    script_i = first_chunk_data_size
+    for chunk_index in range(1, chunk_count):
+        chunk_i = chunk_index * chunk_size
+        # The previous chunk tail points to this one (indexes start at 1)
+        data[chunk_i - 1] = chunk_index + 1
+        # This chunk head points to the previous
+        data[chunk_i] = chunk_index
+        chunk_data = script[script_i : script_i + chunk_data_size]
+        data[chunk_i + 1 : chunk_i + 1 + len(chunk_data)] = chunk_data
+        script_i += chunk_data_size
+
+    # For Python2 compatibility we need to explicitly convert to bytes
+    data = bytes(data)
+    fs_ihex = bytes_to_ihex(fs_start_address, data, universal_data_record)
+    # Add this byte after the fs flash area to configure the scratch page there
+    scratch_ihex = bytes_to_ihex(
+        fs_end_address, b"\xfd", universal_data_record
+    )
+    # Remove scratch Extended Linear Address record if we are in the same range
+    ela_record_len = 16
+    if fs_ihex[:ela_record_len] == scratch_ihex[:ela_record_len]:
+        scratch_ihex = scratch_ihex[ela_record_len:]
+    return fs_ihex + "\n" + scratch_ihex + "\n"
+
+
+def pad_hex_string(hex_records_str, alignment=512):
+    """
+    Adds padding records to a string of Intel Hex records to align the total
+    size to the provided alignment value.
+
+    The Universal Hex format needs each section (a section contains the
+    micro:bit V1 or V2 data) to be aligned to a 512 byte boundary, as this is
+    the common USB block size (or a multiple of this value).
+
+    As a Universal/Intel Hex string only contains ASCII characters, the string
+    length must be multiple of 512, and padding records should be added to fit
+    this rule.
+    """
+    padding_needed = len(hex_records_str) % alignment
+    if padding_needed:
+        # As the padding record data is all "0xFF", the checksum is always 0xF4
+        max_data_chars = 32
+        max_padding_record = ":{:02x}00000C{}F4\n".format(
+            max_data_chars // 2, "F" * max_data_chars
+        )
+        min_padding_record = ":0000000CF4\n"
+        # As there is minimum record length we need to add it to the count
+        chars_needed = alignment - (
+            (len(hex_records_str) + len(min_padding_record)) % alignment
+        )
+        # Add as many full padding records as we can fit
+        while chars_needed >= len(max_padding_record):
+            hex_records_str += max_padding_record
+            chars_needed -= len(max_padding_record)
+        # Due to the string length of the smallest padding record we might
+        #
+        if chars_needed > max_data_chars:
+            chars_to_fit = chars_needed - (len(min_padding_record) * 2)
+            second_to_last_record = ":{:02x}00000C{}F4\n".format(
+                chars_to_fit // 2, "F" * chars_to_fit
+            )
+            hex_records_str += second_to_last_record
+            chars_needed -= len(second_to_last_record)
+        hex_records_str += ":{:02x}00000C{}F4\n".format(
+            chars_needed // 2, "F" * chars_needed
+        )
+    return hex_records_str
+
+
+def embed_fs_uhex(universal_hex_str, python_code=None):
+    """
+    Given a string representing a MicroPython Universal Hex, it will embed a
+    Python script encoded into the MicroPython filesystem for each of the
+    Universal Hex sections, as the Universal Hex will contain a section for
+    micro:bit V1 and a section for micro:bit V2.
+
+    More information about the Universal Hex format:
+    https://github.com/microbit-foundation/spec-universal-hex
+
+    Returns a string of the Universal Hex with the embedded filesystem.
+
+    Will raise a ValueError if the Universal Hex doesn't follow the expected
+    format.
+
+    If the python_code is missing, it will return the unmodified
+    universal_hex_str.
+    """
+    if not python_code:
+        return universal_hex_str
+    index = _uhex_splice_index(universal_hex_str)
+    # With the device IDs we can encode the fs into hex records to inject,
+    # or take them from the in-process cache (see cache_configure).
+    fs_hexes = _fs_hexes(
+        universal_hex_str,
+        [device_id for _, _, _, device_id in index],
+        python_code,
+    )
+    output = []
+    with _span("embed_fs_uhex"):
+        for (start, fs_i, end, _), fs_hex in zip(index, fs_hexes):
+            output.append(universal_hex_str[start:fs_i])
+            output.append(fs_hex.decode("ascii"))
+            output.append(universal_hex_str[fs_i:end])
+        return "".join(output)
+
+
+def _embed_fs_uhex_chunks(universal_hex, python_code=None, cache_dir=None):
+    """
+    Same as embed_fs_uhex(), but takes the ASCII bytes of a Universal Hex
+    and, instead of building a new hex, returns a list of bytes-like chunks
+    that concatenated form the Universal Hex with the embedded filesystem.
+
+    The unmodified parts of the Universal Hex are memoryview slices of the
+    original bytes, so only the filesystem records are newly allocated and the
+    chunks can be written out without ever copying the runtime.
+
+    The filesystem records are kept in an in-process cache (see
+    cache_configure) and, if a cache_dir is provided, are also looked up in
+    (or added to) the on-disk hex cache in that directory.
+    """
+    hex_view = memoryview(universal_hex)
+    if not python_code:
+        return [hex_view]
+    index = _uhex_splice_index(universal_hex)
+    fs_hexes = _fs_hexes(
+        universal_hex,
+        [device_id for _, _, _, device_id in index],
+        python_code,
+        cache_dir,
+    )
+    chunks = []
+    with _span("embed_fs_uhex"):
+        for (start, fs_i, end, _), fs_hex in zip(index, fs_hexes):
+            chunks.append(hex_view[start:fs_i])
+            chunks.append(fs_hex)
+            chunks.append(hex_view[fs_i:end])
+    return chunks
+
+
+def _fs_hexes(universal_hex, device_ids, python_code, cache_dir=None):
+    """
+    Returns a list with the padded filesystem hex records (as ASCII bytes) of
+    the Python script (in bytes format) for each of the device IDs of the
+    Universal Hex sections, taken from the hex caches if possible.
+    """
+    fs_hexes = None
+    observers = _observers()
+    if _HEX_MEMO_MAX_ENTRIES:
+        memo_key = _hex_memo_key(universal_hex, python_code)
+        fs_hexes = _hex_memo_get(memo_key)
+        if fs_hexes is not None and observers:
+            _notify(observers, "cache_hit", cache="memory")
+    if fs_hexes is None and cache_dir:
+        # Only the on-disk cache needs the runtime to be hashed.
+        cache_key = _hex_cache_key(universal_hex, python_code)
+        fs_hexes = _hex_cache_get(cache_dir, cache_key, len(device_ids))
+        if fs_hexes is not None:
+            if _HEX_MEMO_MAX_ENTRIES:
+                _hex_memo_put(memo_key, fs_hexes)
+            if observers:
+                _notify(observers, "cache_hit", cache="disk")
+    if fs_hexes is None and observers and (cache_dir or _HEX_MEMO_MAX_ENTRIES):
+        _notify(observers, "cache_miss")
+    if fs_hexes is None:
+        fs_hexes = [
+            _fs_hex(python_code, device_id) for device_id in device_ids
+        ]
+        if _HEX_MEMO_MAX_ENTRIES:
+            _hex_memo_put(memo_key, fs_hexes)
+        if cache_dir:
+            _hex_cache_put(cache_dir, cache_key, fs_hexes)
+    return fs_hexes
+
+
+def _fs_hex(python_code, device_id):
+    """
+    Returns the padded filesystem hex records (as ASCII bytes) of the Python
+    script (in bytes format) for the Universal Hex section of the device ID.
+    """
+    with _span("script_to_fs"):
+        fs_hex = script_to_fs(python_code, device_id)
+    with _span("embed_fs_uhex"):
+        fs_hex = pad_hex_string(fs_hex)
+    with _span("encode"):
+        return fs_hex.encode("ascii")
+
+
+def iter_hex(
+    python_code=None, chunk_size=512, cache_dir=None, low_memory=False
+):
+    """
+    Generates the MicroPython runtime Universal Hex, with the Python script
+    (in bytes format) embedded into its filesystem, as consecutive blocks of
+    ASCII bytes of chunk_size length (the last one can be shorter).
+
+    The chunk_size must be a multiple of 512, the Universal Hex block size, or
+    a ValueError is raised.
+
+    The blocks are cut from the shared runtime bytes and the filesystem
+    records as they are consumed, so the full hex is never built in memory.
+    If low_memory is True, not even the runtime is kept in memory, as the
+    blocks are generated from the runtime image as it's read (see
+    _iter_low_memory_hex).
+
+    The chunk_size is checked, and the hex prepared, when iter_hex is called
+    rather than when the first block is generated. So errors (except, in low
+    memory mode, a script too big for the filesystem) are raised before the
+    caller starts sending out the hex.
+    """
+    if chunk_size <= 0 or chunk_size % 512:
+        raise ValueError("The chunk size must be a multiple of 512.")
+    chunks = _hex_chunks(python_code, cache_dir, low_memory)
+    return _iter_blocks(chunks, chunk_size)
+
+
+def _iter_blocks(chunks, chunk_size):
+    """
+    Generates consecutive blocks of chunk_size bytes (the last one can be
+    shorter) from the bytes-like chunks, see iter_hex.
+    """
+    pending = bytearray()
+    for chunk in chunks:
+        view = memoryview(chunk)
+        if pending:
+            # Complete the block started by the previous chunk(s).
+            needed = chunk_size - len(pending)
+            pending += view[:needed]
+            view = view[needed:]
+            if len(pending) < chunk_size:
+                continue
+            yield bytes(pending)
+            pending = bytearray()
+        whole_blocks_len = len(view) - (len(view) % chunk_size)
+        for i in range(0, whole_blocks_len, chunk_size):
+            yield view[i : i + chunk_size].tobytes()
+        pending += view[whole_blocks_len:]
+    if pending:
+        yield bytes(pending)
+
+
+def _hex_chunks(
+    python_code=None, cache_dir=None, low_memory=False, single=False
+):
+    """
+    Returns the chunks of the runtime hex, with the Python script (in bytes
+    format) embedded into its filesystem, for save_hex(). If low_memory is
+    True they are generated from the runtime image as they are written (see
+    _LowMemoryHex), otherwise they share the runtime bytes (see
+    _embed_fs_uhex_chunks).
+
+    If the hex is only written once (single is True), and the runtime hex
+    hasn't been built yet, it's streamed from the runtime image in blocks of
+    _STREAM_BLOCK_SIZE as well. Building the whole runtime hex takes as long
+    as streaming it, so it only pays off if it's reused (as it is by
+    long-running processes flashing again, or several devices), and
+    otherwise just takes up memory.
+    """
+    if low_memory:
+        return _LowMemoryHex(python_code)
+    if single and _RUNTIME_HEX is None and not cache_dir:
+        # The filesystem records are made first, so any errors (such as the
+        # script being too big) are raised before the hex is written.
+        fs_hexes = None
+        if python_code:
+            fs_hexes = [
+                _fs_hex(python_code, device_id)
+                for _, _, _, device_id in _runtime_image_splice_index(
+                    _RUNTIME_PATH
+                )
+            ]
+        return _LowMemoryHex(python_code, _STREAM_BLOCK_SIZE, fs_hexes)
+    return _embed_fs_uhex_chunks(_get_runtime_hex(), python_code, cache_dir)
+
+
+def _hex_cache_key(universal_hex, python_code):
+    """
+    Returns the on-disk hex cache key for a Python script (in bytes format)
+    embedded into the given Universal Hex (as a string or ASCII bytes).
+
+    The key is a SHA-256 digest of the uflash version, the filesystem layout,
+    the Universal Hex and the script with normalised line endings, as that is
+    all the generated hex depends on.
+    """
+    import hashlib
+    key = hashlib.sha256(
+        "{} {:X} {:X} {:X} {:X}\n".format(
+            get_version(),
+            _FS_START_ADDR_V1,
+            _FS_END_ADDR_V1,
+            _FS_START_ADDR_V2,
+            _FS_END_ADDR_V2,
+        ).encode("ascii")
+    )
+    key.update(_uhex_digest(universal_hex).encode("ascii"))
+    key.update(_normalise_script(python_code))
+    return key.hexdigest()
+
+
+def _hex_memo_key(universal_hex, python_code):
+    """
+    Returns the in-process cache key for a Python script (in bytes format)
+    embedded into the given Universal Hex (as a string or ASCII bytes).
+
+    Unlike the on-disk cache key (see _hex_cache_key) the Universal Hex isn't
+    hashed, it's identified by a token kept for the object itself (see
+    _identity_cache_get), so a one-off flash doesn't pay for hashing the
+    runtime. The bundled runtime has the same token as a string or bytes.
+    """
+    if universal_hex is _RUNTIME_HEX or universal_hex is globals().get(
+        "_RUNTIME"
+    ):
+        token = "runtime"
+    else:
+        token = _identity_cache_get(_HEX_MEMO_RUNTIMES, universal_hex)
+        if token is None:
+            token = object()
+            _identity_cache_put(_HEX_MEMO_RUNTIMES, universal_hex, token)
+    return token, _normalise_script(python_code)
+
+
+def cache_info():
+    """
+    Returns a dictionary with the statistics of the in-process cache of
+    generated hex records: the number of cache "hits" and "misses", the
+    current number of "entries" and their "size" in bytes, and the configured
+    "max_entries" and "max_size".
+    """
+    with _HEX_MEMO_LOCK:
+        return {
+            "hits": _HEX_MEMO_STATS["hits"],
+            "misses": _HEX_MEMO_STATS["misses"],
+            "entries": len(_HEX_MEMO),
+            "size": _HEX_MEMO_STATS["size"],
+            "max_entries": _HEX_MEMO_MAX_ENTRIES,
+            "max_size": _HEX_MEMO_MAX_SIZE,
+        }
+
+
+def cache_clear():
+    """
+    Empties the in-process cache of generated hex records and resets its
+    statistics.
+    """
+    with _HEX_MEMO_LOCK:
+        _HEX_MEMO.clear()
+        _HEX_MEMO_STATS.update(hits=0, misses=0, size=0)
+
+
+def cache_configure(max_entries=None, max_size=None):
+    """
+    Sets the maximum number of entries and/or total size in bytes of the
+    in-process cache of generated hex records, evicting the least recently
+    used entries if needed. A max_entries of 0 disables the cache.
+    """
+    global _HEX_MEMO_MAX_ENTRIES, _HEX_MEMO_MAX_SIZE
+    with _HEX_MEMO_LOCK:
+        if max_entries is not None:
+            _HEX_MEMO_MAX_ENTRIES = max_entries
+        if max_size is not None:
+            _HEX_MEMO_MAX_SIZE = max_size
+        _hex_memo_trim()
+
+
+def _hex_memo_get(key):
+    """
+    Returns the filesystem hex records in the in-process cache for the key,
+    or None if they aren't cached.
+    """
+    with _HEX_MEMO_LOCK:
+        fs_hexes = _HEX_MEMO.get(key)
+        if fs_hexes is None:
+            _HEX_MEMO_STATS["misses"] += 1
+        else:
+            _HEX_MEMO_STATS["hits"] += 1
+            # Move it to the end, as the most recently used.
+            del _HEX_MEMO[key]
+            _HEX_MEMO[key] = fs_hexes
+        return fs_hexes
+
+
+def _hex_memo_put(key, fs_hexes):
+    """
+    Adds the filesystem hex records to the in-process cache for the key.
+    """
+    with _HEX_MEMO_LOCK:
+        if key in _HEX_MEMO:
+            return
+        _HEX_MEMO[key] = fs_hexes
+        _HEX_MEMO_STATS["size"] += sum(len(fs_hex) for fs_hex in fs_hexes)
+        _hex_memo_trim()
+
+
+def _hex_memo_trim():
+    """
+    Evicts the least recently used entries of the in-process cache until it is
+    within its limits. Must be called with the _HEX_MEMO_LOCK held.
+    """
+    while _HEX_MEMO and (
+        len(_HEX_MEMO) > _HEX_MEMO_MAX_ENTRIES
+        or _HEX_MEMO_STATS["size"] > _HEX_MEMO_MAX_SIZE
+    ):
+        _, fs_hexes = _HEX_MEMO.popitem(last=False)
+        _HEX_MEMO_STATS["size"] -= sum(len(fs_hex) for fs_hex in fs_hexes)
+
+
+def _uhex_digest(universal_hex):
+    """
+    Returns the SHA-256 hex digest of a Universal Hex (as a string or ASCII
+    bytes), cached like the splice index so each runtime is only hashed once.
+    """
+    digest = _identity_cache_get(_UHEX_DIGEST_CACHE, universal_hex)
+    if digest is None:
+        import hashlib
+
+        if hasattr(universal_hex, "encode"):
+            digest = hashlib.sha256(universal_hex.encode("ascii"))
+        else:
+            digest = hashlib.sha256(universal_hex)
+        digest = digest.hexdigest()
+        _identity_cache_put(_UHEX_DIGEST_CACHE, universal_hex, digest)
+    return digest
+
+
+def _identity_cache_get(cache, obj):
+    """
+    Returns the value cached for the object itself (not just an equal one) in
+    the cache, or None if there isn't one.
+
+    The cache is keyed by id(), so a lookup never hashes or compares the
+    megabytes of a runtime, and holds the object with its value so the id
+    can't be reused by another object.
+    """
+    entry = cache.get(id(obj))
+    if entry is not None and entry[0] is obj:
+        return entry[1]
+    return None
+
+
+def _identity_cache_put(cache, obj, value):
+    """
+    Caches the value for the object (see _identity_cache_get). As strings and
+    bytes can't be weakly referenced, the cache keeps them alive, so it's
+    emptied once it has _SPLICE_INDEX_CACHE_SIZE entries.
+    """
+    if len(cache) >= _SPLICE_INDEX_CACHE_SIZE:
+        cache.clear()
+    cache[id(obj)] = (obj, value)
+
+
+def _hex_cache_get(cache_dir, key, sections):
+    """
+    Returns the list of filesystem hex records (one bytes object for each of
+    the Universal Hex sections) stored in the on-disk hex cache for the key,
+    or None if there isn't a valid entry.
+
+    A hit updates the entry modification time, which is what the least
+    recently used eviction in _hex_cache_evict() goes by.
+    """
+    path = os.path.join(cache_dir, key + _HEX_CACHE_SUFFIX)
+    try:
+        with open(path, "rb") as entry_file:
+            entry = entry_file.read()
+        os.utime(path, None)
+    except EnvironmentError:
+        return None
+    fs_hexes = entry.split(b"\0")
+    if len(fs_hexes) != sections:
+        return None
+    return fs_hexes
+
+
+def _hex_cache_put(cache_dir, key, fs_hexes):
+    """
+    Stores the list of filesystem hex records in the on-disk hex cache for the
+    key, and then evicts old entries if the cache got too big.
+
+    Entries are written to a temporary file that is then renamed, so
+    processes sharing the cache never read a partially written entry. The
+    cache is only an optimisation, so any errors are ignored.
+    """
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        _write_atomically(
+            os.path.join(cache_dir, key + _HEX_CACHE_SUFFIX),
+            b"\0".join(fs_hexes),
+        )
+    except EnvironmentError:
+        return
+    _hex_cache_evict(cache_dir)
+
+
+def _write_atomically(path, data):
+    """
+    Writes the data to the path via a temporary file in the same directory
+    that is then renamed, so the file is never partially written. The
+    temporary file is removed if the write or rename fails.
+    """
+    import tempfile
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(data)
+        getattr(os, "replace", os.rename)(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except EnvironmentError:  # pragma: no cover
+            pass
+        raise
+
+
+def _hex_cache_evict(cache_dir, max_size=None):
+    """
+    Deletes the least recently used entries of the on-disk hex cache until it
+    takes no more than max_size bytes (_HEX_CACHE_MAX_SIZE by default).
+    """
+    if max_size is None:
+        max_size = _HEX_CACHE_MAX_SIZE
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(_HEX_CACHE_SUFFIX):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except EnvironmentError:
+            # Evicted by another process.
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except EnvironmentError:
+            pass
+        total_size -= size
+
+
+def _uhex_splice_index(universal_hex_str):
+    """
+    Given a string (or ASCII bytes) representing a MicroPython Universal Hex,
+    returns a tuple with an entry per section (V1 and V2) containing the
+    section start index, the index where the filesystem has to be injected,
+    the section end index and the micro:bit device ID, in that order.
+
+    As the runtime doesn't change between calls, the result is cached (keyed
+    by the identity of the Universal Hex, see _identity_cache_get) so that
+    each runtime is only scanned once.
+    """
+    index = _identity_cache_get(_SPLICE_INDEX_CACHE, universal_hex_str)
+    if index is not None:
+        return index
+    cache_key = universal_hex_str
+    if not isinstance(universal_hex_str, str):
+        universal_hex_str = strfunc(universal_hex_str)
+    # First let's separate the Universal Hex into the individual sections,
+    # Each section starts with an Extended Linear Address record (:02000004...)
+    # followed by s Block Start record (:0400000A...)
+    # We only expect two sections, one for V1 and one for V2
+    section_start = ":020000040000FA\n:0400000A"
+    second_section_i = universal_hex_str[len(section_start) :].find(
+        section_start
+    ) + len(section_start)
+    uhex_sections = [
+        (0, universal_hex_str[:second_section_i]),
+        (second_section_i, universal_hex_str[second_section_i:]),
+    ]
+
+    index = []
+    for section_i, section in uhex_sections:
+        # Block Start record starts like this, followed by device ID (4 chars)
+        block_start_record_start = ":0400000A"
+        block_start_record_i = section.find(block_start_record_start)
+        device_id_i = block_start_record_i + len(block_start_record_start)
+        device_id = section[device_id_i : device_id_i + 4]
+        # In all Sections the fs will be placed at the end of the hex, right
+        # before the UICR, this is for compatibility with all DAPLink versions.
+        # V1 memory layout in sequential order: MicroPython + fs + UICR
+        # V2: SoftDevice + MicroPython + regions table + fs + bootloader + UICR
+        # V2 can manage the hex out of order, but some DAPLink versions in V1
+        # need the hex contents to be in order. So in V1 the fs can never go
+        # after the UICR (flash starts at address 0x0, UICR at 0x1000_0000),
+        # but placing it before should be compatible with all versions.
+        # We find the UICR records in the hex file by looking for an Extended
+        # Linear Address record with value 0x1000 (:020000041000EA).
+        uicr_i = section.rfind(":020000041000EA")
+        # In some cases an Extended Linear/Segmented Address record to 0x0000
+        # is present as part of UICR address jump, so take it into account.
+        ela_record = ":020000040000FA\n"
+        if section[:uicr_i].endswith(ela_record):
+            uicr_i -= len(ela_record)
+        esa_record = ":020000020000FC\n"
+        if section[:uicr_i].endswith(esa_record):
+            uicr_i -= len(esa_record)
+        if uicr_i < 0:
+            # Same as slicing the section with a negative index.
+            uicr_i += len(section)
+        # Now we know where to inject the fs hex block
+        index.append(
+            (
+                section_i,
+                section_i + uicr_i,
+                section_i + len(section),
+                device_id,
+            )
+        )
+    index = tuple(index)
+    _identity_cache_put(_SPLICE_INDEX_CACHE, cache_key, index)
+    return index
+
+
+def bytes_to_ihex(addr, data, universal_data_record=False):
+    """
+    Converts a byte array (of type bytes) into string of Intel Hex records from
+    a given address.
+
+    In the Intel Hex format each data record contains only the 2 LSB of the
+    address. To set the 2 MSB a Extended Linear Address record is needed first.
+    As we don't know where in a Intel Hex file this will be injected, it
+    creates a Extended Linear Address record at the top.
+
+    This function can also be used to generate data records for a Universal
+    Hex, in that case the micro:bit V1 data is exactly the same as a normal
+    Intel Hex, but the V2 data uses a new record type (0x0D) to encode the
+    data, so the `universal_data_record` argument is used to select the
+    record type.
+    """
+
+    # If the data is meant to go into a Universal Hex V2 section, then the
+    # record type needs to be 0x0D instead of 0x00 (V1 section still uses 0x00)
+    r_type = 0x0D if universal_data_record else 0x00
+    output = []
+    i = 0
+    while i < len(data) or not output:
+        # Every 0x10000 address range needs an Extended Linear Address record
+        current_ela = (addr >> 16) & 0xFFFF
+        output.append(
+            _data_records_to_hex(0x0000, 0x04, struct.pack(">H", current_ela))
+        )
+        # Now the Intel Hex data records starting within this address range,
+        # all encoded in one go
+        records_in_range = -(-(((addr | 0xFFFF) + 1) - addr) // 16)
+        chunk = data[i : i + (records_in_range * 16)]
+        output.append(_data_records_to_hex(addr & 0xFFFF, r_type, chunk))
+        addr += len(chunk)
+        i += len(chunk)
+    return strfunc(b"".join(output)[:-1])
+
+
+def unhexlify(blob):
+    """
+    Takes a hexlified script and turns it back into a string of Python code.
+
+    IMPORTANT!
+    Although this function is no longer used in the uflash cli commands,
+    it is called by extract_script, which is maintained for Mu access.
+    """
+    lines = blob.split("\n")[1:]
+    output = []
+    for line in lines:
+        # Discard the address, length etc. and reverse the hexlification
+        output.append(binascii.unhexlify(line[9:-2]))
+    # Check the header is correct ("MP<size>")
+    if output[0][0:2].decode("utf-8") != u"MP":
+        return ""
+    # Strip off header
+    output[0] = output[0][4:]
+    # and strip any null bytes from the end
+    output[-1] = output[-1].strip(b"\x00")
+    script = b"".join(output)
+    try:
+        result = script.decode("utf-8")
+        return result
+    except UnicodeDecodeError:
+        # Return an empty string because in certain rare circumstances (where
+        # the source hex doesn't include any embedded Python code) this
+        # function may be passed in "raw" bytes from MicroPython.
+        return ""
+
+
+def extract_script(embedded_hex):
+    """
+    Given a hex file containing the MicroPython runtime and an embedded Python
+    script, will extract the original Python script.
+    Returns a string containing the original embedded script.
+
+    IMPORTANT!
+    Although this function is no longer used, it is maintained here for Mu.
+    """
+    hex_lines = embedded_hex.split("\n")
+    script_addr_high = hex((_SCRIPT_ADDR >> 16) & 0xFFFF)[2:].upper().zfill(4)
+    script_addr_low = hex(_SCRIPT_ADDR & 0xFFFF)[2:].upper().zfill(4)
+    start_script = None
+    within_range = False
+    # Look for the script start address
+    for loc, val in enumerate(hex_lines):
+        if val[0:9] == ":02000004":
+            # Reached an extended address record, check if within script range
+            within_range = val[9:13].upper() == script_addr_high
+        elif (
+            within_range
+            and val[0:3] == ":10"
+            and val[3:7].upper() == script_addr_low
+        ):
+            start_script = loc
+            break
+    if start_script:
+        # Find the end of the script
+        end_script = None
+        for loc, val in enumerate(hex_lines[start_script:]):
+            if val[9:41] == "FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF":
+                end_script = loc + start_script
+                break
+        # Pass the extracted hex through unhexlify
+        return unhexlify(
+            "\n".join(
+                hex_lines[start_script - 1 : end_script if end_script else -6]
+            )
+        )
+    return ""
+
+
+def find_microbit():
+    """
+    Returns a path on the filesystem that represents the plugged in BBC
+    micro:bit that is to be flashed. If no micro:bit is found, it returns
+    None.
+
+    Works on Linux, OSX and Windows. Will raise a NotImplementedError
+    exception if run on any other operating system.
+    """
+    microbits = _cached_microbits()
+    if microbits is None:
+        # Only the path is needed, so don't read DETAILS.TXT from the devices.
+        paths = _find_microbit_volumes()
+        return paths[0] if paths else None
+    return microbits[0].path if microbits else None
+
+
+def find_all_microbits():
+    """
+    Returns a list with a Microbit(path, device_id, version) named tuple for
+    every plugged in BBC micro:bit (which will be empty if there are none).
+
+    On Linux the result is cached until the mount table changes, which the
+    kernel signals by flagging /proc/self/mountinfo with POLLPRI, so repeated
+    calls don't scan the devices again. Elsewhere every call scans them.
+
+    Works on Linux, OSX and Windows. Will raise a NotImplementedError
+    exception if run on any other operating system.
+    """
+    cached = _cached_microbits()
+    if cached is not None:
+        return list(cached)
+    microbits = [
+        Microbit(path, *_microbit_details(path))
+        for path in _find_microbit_volumes()
+    ]
+    if _MICROBITS_CACHE["watcher"] is not None:
+        _MICROBITS_CACHE["microbits"] = microbits
+    return list(microbits)
+
+
+def _cached_microbits():
+    """
+    Returns the cached list of Microbit named tuples found by
+    find_all_microbits, or None if there isn't one or the mount table has
+    changed since (which drops it from the cache).
+    """
+    if "watcher" not in _MICROBITS_CACHE:
+        _MICROBITS_CACHE["watcher"] = _mount_table_watcher()
+    watcher = _MICROBITS_CACHE["watcher"]
+    if watcher is None:
+        return None
+    # The kernel only reports each change once, so the stale list has to go.
+    if any(
+        events & (select.POLLPRI | select.POLLERR)
+        for _, events in watcher[1].poll(0)
+    ):
+        _MICROBITS_CACHE.pop("microbits", None)
+    return _MICROBITS_CACHE.get("microbits")
+
+
+def _mount_table_watcher():
+    """
+    Returns an (open file, poll object) tuple watching the Linux mount table
+    for changes, or None if that isn't possible (i.e. not on Linux).
+    """
+    if not hasattr(select, "poll"):
+        return None
+    try:
+        mountinfo = open(_MOUNTINFO_PATH, "rb")
+    except EnvironmentError:
+        return None
+    # The kernel flags any change to the mount table made since the file was
+    # opened (clearing the flag each time it's reported).
+    watcher = select.poll()
+    watcher.register(mountinfo, select.POLLPRI | select.POLLERR)
+    return mountinfo, watcher
+
+
+def _microbit_details(path):
+    """
+    Returns a (device ID, board version) tuple for the micro:bit mounted at
+    the given path, read from its DETAILS.TXT file. Either is None if it
+    can't be worked out.
+    """
+    try:
+        with open(os.path.join(path, "DETAILS.TXT"), "rb") as details:
+            match = re.search(
+                br"^Unique ID:\s*([0-9A-Fa-f]+)", details.read(), re.M
+            )
+    except EnvironmentError:
+        return None, None
+    if not match:
+        return None, None
+    device_id = match.group(1).decode("ascii")
+    return device_id, _MICROBIT_BOARD_VERSIONS.get(device_id[:4])
+
+
+def _mountinfo_volumes():
+    """
+    Returns a list with the mount point (in bytes) of every volume in the
+    Linux mount table, or None if it can't be read (i.e. not on Linux).
+
+    Reading /proc/self/mountinfo is a lot cheaper than running the "mount"
+    command, and its paths are unambiguous as whitespace and backslashes are
+    escaped as octal (for example, a space is "\\040").
+    """
+    try:
+        with open(_MOUNTINFO_PATH, "rb") as mountinfo:
+            lines = mountinfo.read().splitlines()
+    except EnvironmentError:
+        return None
+    # The mount point is the 5th field of each line.
+    return [
+        re.sub(
+            br"\\([0-7]{3})",
+            lambda match: struct.pack("B", int(match.group(1), 8)),
+            line.split(b" ")[4],
+        )
+        for line in lines
+        if line.count(b" ") >= 4
+    ]
+
+
+def _find_microbit_volumes():
+    """
+    Returns a list with the path of every plugged in BBC micro:bit found on
+    the filesystem (which will be empty if there are none).
+
+    Works on Linux, OSX and Windows. Will raise a NotImplementedError
+    exception if run on any other operating system.
+    """
+    microbits = []
+    # Check what sort of operating system we're on.
+    if os.name == "posix":
+        # 'posix' means we're on Linux or OSX (Mac).
+        mounted_volumes = _mountinfo_volumes()
+        if mounted_volumes is None:
+            # Call the unix "mount" command to list the mounted volumes. Its
+            # lines look like "<device> on <path> type <type> (<options>)" on
+            # Linux, and "<device> on <path> (<type>, <options>)" on OSX,
+            # where the path can contain spaces.
+            mount_output = check_output("mount").splitlines()
+            mounted_volumes = [
+                match.group(1)
+                for match in (
+                    re.match(br".+? on (.+?)(?: type \S+)? \(", line)
+                    for line in mount_output
+                )
+                if match
+            ]
+        for volume in mounted_volumes:
+            # Further devices are labelled with a counter, for example
+            # MICROBIT1 by udisks2 on Linux or "MICROBIT 1" on OSX.
+            if re.search(br"/MICROBIT ?\d*$", volume):
+                # Return strings not bytes.
+                microbits.append(volume.decode("utf-8"))
+    elif os.name == "nt":
+        # 'nt' means we're on Windows.
+
+        def get_volume_name(disk_name):
+            """
+            Each disk or external device connected to windows has an attribute
+            called "volume name". This function returns the volume name for
+            the given disk/device.
+
+            Code from http://stackoverflow.com/a/12056414
+            """
+            vol_name_buf = ctypes.create_unicode_buffer(1024)
+            ctypes.windll.kernel32.GetVolumeInformationW(
+                ctypes.c_wchar_p(disk_name),
+                vol_name_buf,
+                ctypes.sizeof(vol_name_buf),
+                None,
+                None,
+                None,
+                None,
+                0,
+            )
+            return vol_name_buf.value
+
+        #
+        # In certain circumstances, volumes are allocated to USB
+        # storage devices which cause a Windows popup to raise if their
+        # volume contains no media. Wrapping the check in SetErrorMode
+        # with SEM_FAILCRITICALERRORS (1) prevents this popup.
+        #
+        old_mode = ctypes.windll.kernel32.SetErrorMode(1)
+        try:
+            for disk in "ABCDEFGHIJKLMNOPQRSTUVWXYZ":
+                path = "{}:\\".format(disk)
+                #
+                # Don't bother looking if the drive isn't removable
+                #
+                if ctypes.windll.kernel32.GetDriveTypeW(path) != 2:
+                    continue
+                if (
+                    os.path.exists(path)
+                    and get_volume_name(path) == "MICROBIT"
+                ):
+                    microbits.append(path)
+        finally:
+            ctypes.windll.kernel32.SetErrorMode(old_mode)
+    else:
+        # No support for unknown operating systems.
+        raise NotImplementedError('OS "{}" not supported.'.format(os.name))
+    return microbits
+
+
+def save_hex(hex_file, path):
+    """
+    Given a string representation of a hex file, this function copies it to
+    the specified path thus causing the device mounted at that point to be
+    flashed.
+
+    The hex_file can also be a list of bytes-like chunks (as returned by
+    _embed_fs_uhex_chunks), which are written in order without joining them,
+    or any other iterable of chunks (such as a _LowMemoryHex), which are
+    written one by one as they are generated.
+
+    If the hex_file is empty it will raise a ValueError.
+
+    If the filename at the end of the path does not end in '.hex' it will raise
+    a ValueError.
+    """
+    if not hex_file:
+        raise ValueError("Cannot flash an empty .hex file.")
+    if not path.endswith(".hex"):
+        raise ValueError("The path to flash must be for a .hex file.")
+    if hasattr(hex_file, "encode"):
+        with _span("encode"):
+            hex_file = [hex_file.encode("ascii")]
+    with open(path, "wb") as output:
+        if isinstance(hex_file, list):
+            with _span("write"):
+                _write_chunks(output.fileno(), hex_file)
+            size = sum(len(chunk) for chunk in hex_file)
+        else:
+            size = 0
+            # A single "write" stage for all the chunks, timing each write.
+            write_span = _accumulated_span("write")
+            error = None
+            try:
+                for chunk in hex_file:
+                    with write_span:
+                        _write_chunks(output.fileno(), [chunk])
+                    size += len(chunk)
+            except Exception as ex:
+                error = ex
+                raise
+            finally:
+                write_span.close(error)
+        with _span("fsync"):
+            os.fsync(output.fileno())
+    observers = _observers()
+    if observers:
+        _notify(observers, "write", path=path, bytes=size)
+
+
+def _write_chunks(fd, chunks):
+    """
+    Writes all the bytes-like chunks, in order, to the file descriptor.
+
+    Uses a single os.writev() call where available (it only needs repeating
+    for partial writes), otherwise writes the chunks one after the other.
+    """
+    chunks = [memoryview(chunk) for chunk in chunks]
+    writev = getattr(os, "writev", None)
+    while chunks:
+        if writev:
+            written = writev(fd, chunks)
+        else:
+            written = os.write(fd, chunks[0])
+        # Discard what has been written, including part of a chunk.
+        while chunks and written >= len(chunks[0]):
+            written -= len(chunks[0])
+            chunks.pop(0)
+        if written:
+            chunks[0] = chunks[0][written:]
+
+
+def _read_script(path_to_python):
+    """
+    Returns the content (in bytes format) of the Python file at the path.
+
+    Will raise a ValueError if the path doesn't end in ".py".
+    """
+    if not path_to_python.endswith(".py"):
+        raise ValueError('Python files must end in ".py".')
+    with _span("read_script"):
+        with open(path_to_python, "rb") as python_file:
+            return python_file.read()
+
+
+def _raise_flash_errors(hex_paths, errors):
+    """
+    Raises the errors of flashing the hex paths (see _save_hex_to_all), if
+    any: the original exception if there's a single device, otherwise a
+    FlashError with the errors of each device.
+    """
+    if len(hex_paths) == 1 and errors:
+        raise errors[hex_paths[0]]
+    elif errors:
+        raise FlashError(errors)
+
+
+def flash(
+    path_to_python=None,
+    paths_to_microbits=None,
+    python_script=None,
+    keepname=False,
+    cache_dir=None,
+    max_workers=1,
+    observer=None,
+    low_memory=False,
+):
+    """
+    Given a path to or source of a Python file will attempt to create a hex
+    file and then flash it onto the referenced BBC micro:bit.
+
+    If the path_to_python & python_script are unspecified it will simply flash
+    the unmodified MicroPython runtime onto the device.
+
+    If used, the python_script argument should be a bytes object representing
+    a UTF-8 encoded string. For example::
+
+        script = "from microbit import *\\ndisplay.scroll('Hello, World!')"
+        uflash.flash(python_script=script.encode('utf-8'))
+
+    If paths_to_microbits is unspecified it will attempt to find the device's
+    path on the filesystem automatically.
+
+    If keepname is True the original filename (excluding the
+    extension) will be preserved.
+
+    If cache_dir is specified, generated hex records are cached in (and
+    reused from) that directory, see _embed_fs_uhex_chunks.
+
+    When flashing several micro:bits, up to max_workers of them are written
+    to at the same time, all sharing the same hex data. A device failing
+    doesn't stop the others from being flashed, and afterwards a FlashError
+    is raised with the details of each failure (with a single device, its
+    original exception is raised instead).
+
+    If an observer is specified, it's called with the events of this flash
+    as well as the observers registered with add_observer().
+
+    If low_memory is True the hex file is generated from the runtime image
+    block by block as it's written to each device (see _iter_low_memory_hex),
+    so the memory used stays small and bounded, at the cost of generating it
+    again for every device (and not using the hex caches).
+
+    Returns the list of paths to the hex files written.
+
+    If the automatic discovery fails, then it will raise an IOError.
+    """
+    if observer is not None:
+        with _Observing(_observers() + [observer]):
+            return flash(
+                path_to_python,
+                paths_to_microbits,
+                python_script,
+                keepname,
+                cache_dir,
+                max_workers,
+                low_memory=low_memory,
+            )
+    # Check for the correct version of Python.
+    if not (
+        (sys.version_info[0] == 3 and sys.version_info[1] >= 3)
+        or (sys.version_info[0] == 2 and sys.version_info[1] >= 7)
+    ):
+        raise RuntimeError("Will only run on Python 2.7, or 3.3 and later.")
+    # Grab the Python script (if needed).
+    if path_to_python:
+        (script_path, script_name) = os.path.split(path_to_python)
+        (script_name_root, script_name_ext) = os.path.splitext(script_name)
+        python_script = _read_script(path_to_python)
+
+    # Generate the resulting hex file (as chunks sharing the runtime bytes,
+    # or streamed from the runtime image if it's only written once, as only
+    # one micro:bit is ever found).
+    micropython_hex = _hex_chunks(
+        python_script,
+        cache_dir,
+        low_memory,
+        single=not paths_to_microbits or len(paths_to_microbits) == 1,
+    )
+    # Find the micro:bit.
+    if not paths_to_microbits:
+        with _span("find_microbit"):
+            found_microbit = find_microbit()
+        if found_microbit:
+            paths_to_microbits = [found_microbit]
+    # Attempt to write the hex file to the micro:bit.
+    if paths_to_microbits:
+        hex_paths = []
+        for path in paths_to_microbits:
+            if keepname and path_to_python:
+                hex_file_name = script_name_root + ".hex"
+                hex_path = os.path.join(path, hex_file_name)
+            else:
+                hex_path = os.path.join(path, "micropython.hex")
+            if path_to_python:
+                if not keepname:
+                    print("Flashing {} to: {}".format(script_name, hex_path))
+                else:
+                    print("Hexifying {} as: {}".format(script_name, hex_path))
+            else:
+                print("Flashing Python to: {}".format(hex_path))
+            hex_paths.append(hex_path)
+        errors = _save_hex_to_all(micropython_hex, hex_paths, max_workers)
+        _raise_flash_errors(hex_paths, errors)
+        return hex_paths
+    else:
+        error = "Unable to find micro:bit. Is it plugged in?"
+        _notify(_observers(), "error", path=None, error=error)
+        raise IOError(error)
+
+
+class _WatchFlasher(object):
+    """
+    Flashes the Python script at path_to_python each time it's called (as
+    watch mode does on every change), keeping everything that doesn't change
+    between flashes ready: the runtime split around the filesystem of each
+    section (as memoryview slices of the runtime bytes) and the hex paths of
+    the micro:bits. So each flash only generates the filesystem records and
+    writes the result out.
+
+    If paths_to_microbits is unspecified the micro:bit is found on the first
+    flash, and again after a flash fails (in case it has been replaced).
+    """
+
+    def __init__(self, path_to_python, paths_to_microbits=None, max_workers=1):
+        self.path_to_python = path_to_python
+        self.paths_to_microbits = paths_to_microbits
+        self.max_workers = max_workers
+        self.universal_hex = _get_runtime_hex()
+        hex_view = memoryview(self.universal_hex)
+        self.sections = [
+            (hex_view[start:fs_i], hex_view[fs_i:end], device_id)
+            for start, fs_i, end, device_id in _uhex_splice_index(
+                self.universal_hex
+            )
+        ]
+        self.hex_paths = None
+
+    def __call__(self):
+        python_script = _read_script(self.path_to_python)
+        if python_script:
+            fs_hexes = _fs_hexes(
+                self.universal_hex,
+                [device_id for _, _, device_id in self.sections],
+                python_script,
+            )
+            chunks = []
+            for (prefix, suffix, _), fs_hex in zip(self.sections, fs_hexes):
+                chunks.extend((prefix, fs_hex, suffix))
+        else:
+            chunks = [memoryview(self.universal_hex)]
+        if self.hex_paths is None:
+            paths_to_microbits = self.paths_to_microbits
+            if not paths_to_microbits:
+                with _span("find_microbit"):
+                    found_microbit = find_microbit()
+                if not found_microbit:
+                    raise IOError(
+                        "Unable to find micro:bit. Is it plugged in?"
+                    )
+                paths_to_microbits = [found_microbit]
+            self.hex_paths = [
+                os.path.join(path, "micropython.hex")
+                for path in paths_to_microbits
+            ]
+        script_name = os.path.basename(self.path_to_python)
+        for hex_path in self.hex_paths:
+            print("Flashing {} to: {}".format(script_name, hex_path))
+        hex_paths = self.hex_paths
+        errors = _save_hex_to_all(chunks, hex_paths, self.max_workers)
+        if errors and not self.paths_to_microbits:
+            self.hex_paths = None
+        _raise_flash_errors(hex_paths, errors)
+        return hex_paths
+
+
+def _save_hex_to_all(hex_file, hex_paths, max_workers=1):
+    """
+    Saves the same hex_file to each of the hex_paths (see save_hex), writing
+    up to max_workers of them at the same time.
+
+    Returns a dictionary with the hex paths that could not be written mapped
+    to the exception raised, as a failure doesn't stop the rest from being
+    written.
+    """
+    errors = {}
+    observers = _observers()
+
+    def save(hex_path):
+        try:
+            with _Observing(observers):
+                save_hex(hex_file, hex_path)
+        except Exception as ex:
+            errors[hex_path] = ex
+            if observers:
+                _notify(observers, "error", path=hex_path, error=str(ex))
+
+    workers = min(max_workers or 1, len(hex_paths))
+    if workers > 1:
+        # Only imported when needed, as it slows down importing uflash.
+        try:
+            from concurrent.futures import ThreadPoolExecutor
+        except ImportError:  # pragma: no cover
+            # Python 2 (without the futures backport) flashes one at a time.
+            workers = 1
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(save, hex_paths))
+    else:
+        for hex_path in hex_paths:
+            save(hex_path)
+    return errors
+
+
+class _Inotify(object):
+    """
+    A minimal wrapper around the Linux inotify(7) API (called via ctypes) that
+    reports the files written to, or moved into, the watched directories.
+
+    Raises an OSError if inotify isn't available.
+    """
+
+    def __init__(self, directories):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux.")
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(self._libc, "inotify_init"):
+            raise OSError("inotify isn't supported by this C library.")
+        self.fd = self._libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Unable to start inotify.")
+        self._directories = {}
+        try:
+            for directory in directories:
+                self.add_watch(directory)
+        except OSError:
+            self.close()
+            raise
+
+    def add_watch(self, directory):
+        """
+        Starts watching the files in the given directory.
+        """
+        encoded = directory
+        if not isinstance(encoded, bytes):
+            encoded = encoded.encode(sys.getfilesystemencoding())
+        wd = self._libc.inotify_add_watch(
+            self.fd, ctypes.c_char_p(encoded), _IN_CLOSE_WRITE | _IN_MOVED_TO
+        )
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), directory)
+        self._directories[wd] = directory
+
+    def read(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for files to change,
+        and returns a list with their paths, which will be empty if there were
+        no changes in that time.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        header_size = struct.calcsize(_INOTIFY_EVENT_HEADER)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, _, _, length = struct.unpack_from(
+                _INOTIFY_EVENT_HEADER, data, offset
+            )
+            offset += header_size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if not isinstance(name, str):
+                # Like os.listdir, undecodable bytes are kept as surrogates,
+                # and any name that still can't be decoded isn't watched.
+                try:
+                    name = os.fsdecode(name)
+                except UnicodeDecodeError:  # pragma: no cover
+                    continue
+            if wd in self._directories and name:
+                paths.append(os.path.join(self._directories[wd], name))
+        return paths
+
+    def close(self):
+        """
+        Stops watching all the directories.
+        """
+        os.close(self.fd)
+
+
+class _RebuildScheduler(object):
+    """
+    Calls func(*args, **kwargs) in a background thread once notify() hasn't
+    been called for quiet_period seconds, so a burst of changes results in a
+    single call.
+
+    There's at most one call in flight: changes notified while func is running
+    are collapsed into a single follow-up call. Calls are skipped if the
+    normalised content of the given paths (and of any paths passed to
+    notify) hasn't changed since the last successful one (for example, if the
+    file was saved without changes). Otherwise the files that changed are
+    reported before func is called.
+    """
+
+    def __init__(self, func, paths, quiet_period, args=(), kwargs=None):
+        self.func = func
+        self.paths = paths
+        self.quiet_period = quiet_period
+        self.args = args
+        self.kwargs = kwargs or {}
+        self._clock = getattr(time, "monotonic", time.time)
+        self._condition = threading.Condition()
+        self._changed_at = None
+        self._changed_paths = set()
+        self._pending = False
+        self._closed = False
+        self._thread = None
+        # Nothing has been flashed yet, so the first change is never skipped.
+        self._digests = {}
+
+    @staticmethod
+    def _content_digests(paths):
+        """
+        Returns a dictionary with the absolute path of each of the paths mapped
+        to the SHA-256 digest of its normalised content (or None if it can't
+        be read).
+        """
+        import hashlib
+        digests = {}
+        for path in paths:
+            try:
+                with open(path, "rb") as source:
+                    digest = hashlib.sha256(_normalise_script(source.read()))
+                digests[os.path.abspath(path)] = digest.digest()
+            except EnvironmentError:
+                digests[os.path.abspath(path)] = None
+        return digests
+
+    def notify(self, changed_paths=()):
+        """
+        Schedules a call to func once things go quiet, optionally adding the
+        given paths to the ones checked for changes.
+        """
+        with self._condition:
+            self._changed_at = self._clock()
+            self._changed_paths.update(changed_paths)
+            self._pending = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def close(self):
+        """
+        Drops any pending call and waits for the one in flight to finish.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not (self._pending or self._closed):
+                    self._condition.wait()
+                # Wait for quiet_period seconds without any changes.
+                while not self._closed:
+                    remaining = (
+                        self._changed_at + self.quiet_period - self._clock()
+                    )
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                if self._closed:
+                    return
+                self._pending = False
+                paths = list(self.paths) + sorted(self._changed_paths)
+                self._changed_paths.clear()
+            digests = self._content_digests(paths)
+            changed = sorted(
+                path
+                for path, digest in digests.items()
+                if digest is None or self._digests.get(path) != digest
+            )
+            if not changed:
+                continue
+            # Everything is new on the first call, so there's nothing to
+            # report until a call has succeeded.
+            if len(digests) > 1 and self._digests:
+                print("Changed: {}".format(", ".join(changed)))
+            try:
+                self.func(*self.args, **self.kwargs)
+            except Exception as ex:
+                print("Error: {!s}".format(ex), file=sys.stderr)
+            else:
+                self._digests.update(digests)
+
+
+def watch_file(path, func, *args, **kwargs):
+    """
+    Watch a file for changes. Call the provided function with *args and
+    **kwargs upon modification.
+
+    On Linux inotify reports when the file is saved, including by editors
+    that save by renaming a new file over it. Elsewhere (or if inotify can't
+    be used) the file's last modification time is polled every second.
+    """
+    if not path:
+        raise ValueError("Please specify a file to watch")
+    print('Watching "{}" for changes'.format(path))
+    target = os.path.abspath(path)
+    try:
+        inotify = _Inotify([os.path.dirname(target)])
+    except OSError:
+        inotify = None
+    try:
+        if inotify:
+            try:
+                while True:
+                    if target in inotify.read():
+                        func(*args, **kwargs)
+            finally:
+                inotify.close()
+        else:
+            last_modification_time = os.path.getmtime(path)
+            while True:
+                time.sleep(1)
+                new_modification_time = os.path.getmtime(path)
+                if new_modification_time == last_modification_time:
+                    continue
+                func(*args, **kwargs)
+                last_modification_time = new_modification_time
+    except KeyboardInterrupt:
+        pass
+
+
+def _has_glob_magic(pattern):
+    """
+    Returns True if the pattern contains any glob wildcards.
+    """
+    return re.search(r"[*?[]", pattern) is not None
+
+
+def _watched_files(patterns):
+    """
+    Returns a dictionary with the absolute path of every file matching the
+    watch patterns (see _watch_paths) mapped to its last modification time.
+    """
+    import glob
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, names in os.walk(pattern):
+                dirs[:] = [name for name in dirs if not name.startswith(".")]
+                paths.extend(
+                    os.path.join(root, name)
+                    for name in names
+                    if name.endswith(".py") and not name.startswith(".")
+                )
+        elif _has_glob_magic(pattern):
+            paths.extend(glob.glob(pattern))
+        else:
+            paths.append(pattern)
+    files = {}
+    for path in paths:
+        try:
+            files[os.path.abspath(path)] = os.path.getmtime(path)
+        except EnvironmentError:
+            pass
+    return files
+
+
+def _is_watched(path, patterns):
+    """
+    Returns True if the absolute path matches any of the watch patterns (see
+    _watch_paths).
+    """
+    import fnmatch
+    for pattern in patterns:
+        pattern = os.path.abspath(pattern)
+        if os.path.isdir(pattern):
+            relative = path[len(pattern) :].split(os.sep)
+            if (
+                path.startswith(os.path.join(pattern, ""))
+                and path.endswith(".py")
+                and not any(name.startswith(".") for name in relative)
+            ):
+                return True
+        elif _has_glob_magic(pattern):
+            if fnmatch.fnmatch(path, pattern):
+                return True
+        elif path == pattern:
+            return True
+    return False
+
+
+def _watch_paths(patterns, func):
+    """
+    Watch the files matching the patterns for changes. Each pattern is either
+    a file, a directory (where all the Python files in it and in its
+    subdirectories are watched) or a glob pattern. Upon modification, call
+    the provided function with the list of the absolute paths changed.
+
+    All the files are watched with a single inotify instance on Linux, which
+    also reports files created after watching starts (but not in directories
+    created after that). Elsewhere (or if inotify can't be used) the files
+    matching the patterns are checked for new modification times every
+    second.
+    """
+    if not patterns:
+        raise ValueError("Please specify a file to watch")
+    print(
+        "Watching {} for changes".format(
+            ", ".join('"{}"'.format(pattern) for pattern in patterns)
+        )
+    )
+    files = _watched_files(patterns)
+    directories = set(os.path.dirname(path) for path in files)
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, _ in os.walk(pattern):
+                dirs[:] = [name for name in dirs if not name.startswith(".")]
+                directories.add(os.path.abspath(root))
+        elif not _has_glob_magic(os.path.dirname(pattern)):
+            directories.add(os.path.dirname(os.path.abspath(pattern)))
+    try:
+        inotify = _Inotify(
+            sorted(path for path in directories if os.path.isdir(path))
+        )
+    except OSError:
+        inotify = None
+    try:
+        if inotify:
+            try:
+                while True:
+                    changed = sorted(
+                        set(
+                            path
+                            for path in inotify.read()
+                            if _is_watched(path, patterns)
+                        )
+                    )
+                    if changed:
+                        func(changed)
+            finally:
+                inotify.close()
+        else:
+            while True:
+                time.sleep(1)
+                new_files = _watched_files(patterns)
+                changed = sorted(
+                    path
+                    for path, mtime in new_files.items()
+                    if files.get(path) != mtime
+                )
+                files = new_files
+                if changed:
+                    func(changed)
+    except KeyboardInterrupt:
+        pass
+
+
+def _py2hex_worker_init():
+    """
+    Prepares a py2hex worker process by loading the runtime and indexing its
+    sections once, so every script it hexifies only needs the filesystem
+    records generating.
+    """
+    _uhex_splice_index(_get_runtime_hex())
+
+
+def _py2hex_file_hex_path(path_to_python, outdir):
+    """
+    Returns the path of the hex file py2hex creates for the Python file in the
+    output directory.
+    """
+    script_name = os.path.basename(path_to_python)
+    return os.path.join(outdir, os.path.splitext(script_name)[0] + ".hex")
+
+
+def _py2hex_file(task):
+    """
+    Hexifies a Python script as py2hex does, but without printing anything,
+    so it can be run in a worker process. The task is a (path to the Python
+    file, output directory, cache directory) tuple.
+
+    Returns a (hex path, error message) tuple, where the error message is None
+    if the hex file was written.
+    """
+    path_to_python, outdir, cache_dir = task
+    hex_path = _py2hex_file_hex_path(path_to_python, outdir)
+    try:
+        python_script = _read_script(path_to_python)
+        runtime = _get_runtime_hex()
+        save_hex(
+            _embed_fs_uhex_chunks(runtime, python_script, cache_dir), hex_path
+        )
+    except Exception as ex:
+        return hex_path, "{!s}".format(ex)
+    return hex_path, None
+
+
+def _py2hex_all(tasks, jobs):
+    """
+    Hexifies the Python scripts of the tasks (see _py2hex_file) using a pool
+    of up to jobs worker processes, printing the result of each one in the
+    order given.
+
+    Returns the list of (hex path, error message) results, in the same order
+    as the tasks.
+    """
+    # Only imported when needed, as it noticeably slows down importing uflash.
+    import multiprocessing
+
+    workers = min(jobs, len(tasks))
+    # Load the runtime first, so forked workers share it with this process.
+    _py2hex_worker_init()
+    pool = multiprocessing.Pool(workers, _py2hex_worker_init)
+    all_results = []
+    try:
+        results = pool.imap(
+            _py2hex_file, tasks, max(1, len(tasks) // (workers * 4))
+        )
+        for (path_to_python, _, _), (hex_path, error) in zip(tasks, results):
+            all_results.append((hex_path, error))
+            script_name = os.path.basename(path_to_python)
+            if error is None:
+                print("Hexifying {} as: {}".format(script_name, hex_path))
+            else:
+                print(
+                    "Error hexifying {}: {}".format(path_to_python, error),
+                    file=sys.stderr,
+                )
+    finally:
+        pool.terminate()
+        pool.join()
+    return all_results
+
+
+def _read_manifest(outdir):
+    """
+    Returns the py2hex manifest in the output directory: a dictionary with
+    the name of each hex file mapped to the details it was generated from
+    (see _manifest_entry). It's empty if there's no valid manifest.
+    """
+    import json
+    try:
+        with open(os.path.join(outdir, _PY2HEX_MANIFEST), "rb") as manifest:
+            files = json.loads(manifest.read().decode("utf-8"))["files"]
+    except (EnvironmentError, ValueError, KeyError, TypeError):
+        return {}
+    return files if isinstance(files, dict) else {}
+
+
+def _write_manifest(outdir, files):
+    """
+    Writes the py2hex manifest (see _read_manifest) to the output directory,
+    so it's never partially written (see _write_atomically). The manifest is
+    only an optimisation, so any errors are ignored.
+    """
+    import json
+    try:
+        _write_atomically(
+            os.path.join(outdir, _PY2HEX_MANIFEST),
+            json.dumps({"files": files}, indent=1, sort_keys=True).encode(
+                "utf-8"
+            ),
+        )
+    except EnvironmentError:
+        pass
+
+
+def _manifest_entry(path_to_python):
+    """
+    Returns the py2hex manifest entry for the Python file: the SHA-256 digests
+    of the script (with normalised line endings) and of the runtime image, and
+    the uflash version. Returns None if the file can't be read.
+    """
+    import hashlib
+    try:
+        with open(path_to_python, "rb") as python_file:
+            script = _normalise_script(python_file.read())
+    except EnvironmentError:
+        return None
+    return {
+        "source": hashlib.sha256(script).hexdigest(),
+        "runtime": _runtime_image_digest(),
+        "uflash": get_version(),
+    }
+
+
+def _runtime_image_digest():
+    """
+    Returns the SHA-256 hex digest of the bundled runtime image, which
+    identifies the runtime without generating its hex (so it works in low
+    memory mode too). The image is read block by block, only the first time.
+    """
+    global _RUNTIME_IMAGE_DIGEST
+    if _RUNTIME_IMAGE_DIGEST is None:
+        import hashlib
+
+        digest = hashlib.sha256()
+        with open(_RUNTIME_PATH, "rb") as image_file:
+            for block in iter(
+                lambda: image_file.read(_LOW_MEMORY_BLOCK_SIZE), b""
+            ):
+                digest.update(block)
+        _RUNTIME_IMAGE_DIGEST = digest.hexdigest()
+    return _RUNTIME_IMAGE_DIGEST
+
+
+def _is_up_to_date(hex_path, entry, manifest):
+    """
+    Returns True if the hex file exists and its manifest entry shows it was
+    generated from the same script, runtime and uflash version as the given
+    entry.
+    """
+    recorded = manifest.get(os.path.basename(hex_path))
+    if entry is None or not isinstance(recorded, dict):
+        return False
+    try:
+        size = os.path.getsize(hex_path)
+    except EnvironmentError:
+        return False
+    return recorded == dict(entry, size=size)
+
+
+def _py2hex_serve(requests, responses, cache_dir=None, low_memory=False):
+    """
+    Hexifies Python scripts as requested by the JSON lines read from the
+    requests file, writing a JSON line to the responses file with the result
+    of each one. So tools hexifying many scripts only have to start uflash
+    (and load the runtime) once.
+
+    Each request is a JSON object with either the "path" to a Python file or
+    its "source" code, and the "output" path of the hex file (optional for a
+    path, which by default is hexified beside it). An "id" can be given to
+    match the response, which is a JSON object with the "id" (null if none),
+    whether it was "ok", and the "output" path written or the "error" that
+    happened.
+
+    If low_memory is True the runtime is streamed from its image for every
+    script (see _iter_low_memory_hex) instead of being loaded once.
+    """
+    import json
+    if not low_memory:
+        _py2hex_worker_init()
+    for line in iter(requests.readline, ""):
+        line = line.strip()
+        if not line:
+            continue
+        request_id = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("The request must be a JSON object.")
+            request_id = request.get("id")
+            output = request.get("output")
+            if "source" in request:
+                python_script = request["source"].encode("utf-8")
+                if not output:
+                    raise ValueError("An output path is required for source.")
+            elif "path" in request:
+                path_to_python = request["path"]
+                python_script = _read_script(path_to_python)
+                if not output:
+                    output = _py2hex_file_hex_path(
+                        path_to_python, os.path.dirname(path_to_python)
+                    )
+            else:
+                raise ValueError("The request needs a path or source.")
+            save_hex(
+                _hex_chunks(python_script, cache_dir, low_memory), output
+            )
+            response = {"id": request_id, "ok": True, "output": output}
+        except Exception as ex:
+            response = {"id": request_id, "ok": False, "error": str(ex)}
+        responses.write(json.dumps(response, sort_keys=True) + "\n")
+        responses.flush()
+
+
+def _py2hex_stream(path_to_python, output, cache_dir=None, low_memory=False):
+    """
+    Writes the hex of the Python file (read from stdin if the path is "-") to
+    the output binary file, generated by iter_hex so the whole hex is never
+    built in memory (nor the runtime, if low_memory is True).
+    """
+    if path_to_python == "-":
+        with _span("read_script"):
+            python_script = getattr(sys.stdin, "buffer", sys.stdin).read()
+    else:
+        python_script = _read_script(path_to_python)
+    for block in iter_hex(python_script, 64 * 1024, cache_dir, low_memory):
+        output.write(block)
+    output.flush()
+
+
+def _cpu_count():
+    """
+    Returns the number of CPUs in the system (1 if it can't be found out).
+    """
+    if hasattr(os, "cpu_count"):
+        # Avoids importing multiprocessing, which is slow, on Python 3.
+        return os.cpu_count() or 1
+    try:  # pragma: no cover
+        import multiprocessing
+
+        return multiprocessing.cpu_count()
+    except NotImplementedError:  # pragma: no cover
+        return 1
+
+
+def py2hex(argv=None):
+    """
+    Entry point for the command line tool 'py2hex'
+
+    Will print help text if the optional first argument is "help". Otherwise
+    it will ensure the first argument ends in ".py" (the source Python script).
+
+    An optional second argument is used to to reference the path where the
+    resultant hex file sill be saved (the default location is in the same
+    directory as the .py file).
+
+    Exceptions are caught and printed for the user.
+    """
+    if not argv:  # pragma: no cover
+        argv = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(description=_PY2HEX_HELP_TEXT)
+    parser.add_argument("source", nargs="*", default=None)
+    parser.add_argument(
+        "-r",
+        "--runtime",
+        default=None,
+        help="This feature has been deprecated.",
+    )
+    parser.add_argument(
+        "-o", "--outdir", default=None, help="Output directory"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory to cache generated hex records in, for reuse.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of scripts to hexify at the same time, when given more "
+        "than one (default: the number of CPUs).",
+    )
+    parser.add_argument(
+        "--stdout",
+        action="store_true",
+        help="Write the hex to stdout instead of a file (the default when "
+        'the source is "-", to read it from stdin).',
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Print the time taken by each stage to stderr.",
+    )
+    parser.add_argument(
+        "--memory-report",
+        action="store_true",
+        help="Print the peak memory allocated by each stage to stderr.",
+    )
+    parser.add_argument(
+        "--low-memory",
+        action="store_true",
+        help="Keep the memory used small, by generating the hex from the "
+        "runtime image block by block as it's written.",
+    )
+    parser.add_argument(
+        "--serve",
+        "--batch",
+        action="store_true",
+        help="Hexify the scripts requested by JSON lines read from stdin, "
+        "writing a JSON line with each result to stdout.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only hexify the scripts whose hex file isn't up to date, "
+        "according to a manifest kept in the output directory.",
+    )
+    parser.add_argument(
+        "-m",
+        "--minify",
+        action="store_true",
+        help="This feature has been deprecated.",
+    )
+    parser.add_argument(
+        "--version", action="version", version="%(prog)s " + get_version()
+    )
+    args = parser.parse_args(argv)
+
+    if args.runtime:
+        raise NotImplementedError("The 'runtime' flag is no longer supported.")
+    if args.minify:
+        print(
+            "The 'minify' flag is no longer supported, ignoring.",
+            file=sys.stderr,
+        )
+
+    reports = _reports(parser, args)
+    if reports or args.low_memory:
+        # Hexify the scripts one at a time in this process, so all the stages
+        # are reported and only one hex is generated at a time.
+        args.jobs = 1
+    _run_reported(reports, _py2hex, parser, args)
+
+
+def _py2hex(parser, args):
+    """
+    Runs py2hex with the parsed command line arguments.
+    """
+    if args.serve:
+        if args.source:
+            parser.error("no source files can be given with --serve")
+        _py2hex_serve(sys.stdin, sys.stdout, args.cache_dir, args.low_memory)
+        return
+    if args.stdout or "-" in args.source:
+        if len(args.source) != 1:
+            parser.error("a single source file is needed to write to stdout")
+        _py2hex_stream(
+            args.source[0],
+            getattr(sys.stdout, "buffer", sys.stdout),
+            args.cache_dir,
+            args.low_memory,
+        )
+        return
+
+    sources = args.source
+    if not args.outdir and sources:
+        # All the hex files go to the directory of the first script.
+        args.outdir = os.path.dirname(sources[0])
+    manifest = None
+    if args.incremental:
+        manifest = _read_manifest(args.outdir)
+        entries = {}
+        sources = []
+        for py_file in args.source:
+            hex_path = _py2hex_file_hex_path(py_file, args.outdir)
+            entries[hex_path] = _manifest_entry(py_file)
+            if _is_up_to_date(hex_path, entries[hex_path], manifest):
+                print(
+                    "Skipping {}, {} is up to date".format(
+                        os.path.basename(py_file), hex_path
+                    )
+                )
+            else:
+                sources.append(py_file)
+
+    def record(hex_path):
+        if manifest is not None and entries[hex_path] is not None:
+            manifest[os.path.basename(hex_path)] = dict(
+                entries[hex_path], size=os.path.getsize(hex_path)
+            )
+
+    # A single script is hexified in this process, without a worker pool.
+    jobs = 1
+    if len(sources) > 1:
+        jobs = args.jobs or _cpu_count()
+    failed = False
+    try:
+        if jobs > 1:
+            tasks = [
+                (py_file, args.outdir, args.cache_dir) for py_file in sources
+            ]
+            for hex_path, error in _py2hex_all(tasks, jobs):
+                if error is None:
+                    record(hex_path)
+                else:
+                    failed = True
+        else:
+            if len(sources) > 1 and not args.low_memory:
+                # The scripts share the runtime hex, so it's built once rather
+                # than streamed for each of them (see _hex_chunks).
+                _get_runtime_hex()
+            for py_file in sources:
+                # Like the worker pool, report a failure and carry on.
+                try:
+                    hex_paths = flash(
+                        path_to_python=py_file,
+                        paths_to_microbits=[args.outdir],
+                        keepname=True,
+                        cache_dir=args.cache_dir,
+                        low_memory=args.low_memory,
+                    )  # keepname is always True in py2hex
+                except Exception as ex:
+                    print(
+                        "Error hexifying {}: {!s}".format(py_file, ex),
+                        file=sys.stderr,
+                    )
+                    failed = True
+                    continue
+                for hex_path in hex_paths:
+                    record(hex_path)
+    finally:
+        if manifest is not None and sources:
+            _write_manifest(args.outdir, manifest)
+    if failed:
+        sys.exit(1)
+
+
+def main(argv=None):
+    """
+    Entry point for the command line tool 'uflash'.
+    Will print help text if the optional first argument is "help". Otherwise
+    it will ensure the optional first argument ends in ".py" (the source
+    Python script).
+
+    An optional second argument is used to reference the path to the micro:bit
+    device. Any more arguments are ignored.
+
+    Exceptions are caught and printed for the user.
+    """
+    if not argv:
+        argv = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(description=_HELP_TEXT)
+    parser.add_argument("source", nargs="?", default=None)
+    parser.add_argument("target", nargs="*", default=None)
+    parser.add_argument(
+        "-r",
+        "--runtime",
+        default=None,
+        help="This feature has been deprecated.",
+    )
+    parser.add_argument(
+        "-e",
+        "--extract",
+        action="store_true",
+        help="This feature has been deprecated.",
+    )
+    parser.add_argument(
+        "-w",
+        "--watch",
+        action="store_true",
+        help="Watch the source file for changes.",
+    )
+    parser.add_argument(
+        "--watch-path",
+        action="append",
+        metavar="PATH",
+        help="Also watch this file, directory (for all its Python files) or "
+        "glob pattern, and flash the source file when any of them change. "
+        "Implies --watch and can be used more than once.",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Print the time taken by each stage to stderr.",
+    )
+    parser.add_argument(
+        "--memory-report",
+        action="store_true",
+        help="Print the peak memory allocated by each stage to stderr.",
+    )
+    parser.add_argument(
+        "--low-memory",
+        action="store_true",
+        help="Keep the memory used small, by generating the hex from the "
+        "runtime image block by block as it's written.",
+    )
+    parser.add_argument(
+        "--quiet-period",
+        type=float,
+        default=_WATCH_QUIET_PERIOD,
+        metavar="SECONDS",
+        help="When watching, wait for this long without changes before "
+        "flashing (default: %(default)s).",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of micro:bits to flash at the same time.",
+    )
+    parser.add_argument(
+        "-m",
+        "--minify",
+        action="store_true",
+        help="This feature has been deprecated.",
+    )
+    parser.add_argument(
+        "--version", action="version", version="%(prog)s " + get_version()
+    )
+    args = parser.parse_args(argv)
+
+    if args.runtime:
+        raise NotImplementedError("The 'runtime' flag is no longer supported.")
+    if args.extract:
+        raise NotImplementedError("The 'extract' flag is no longer supported.")
+    if args.minify:
+        print(
+            "The 'minify' flag is no longer supported, ignoring.",
+            file=sys.stderr,
+        )
+
+    reports = _reports(parser, args)
+    if args.memory_report:
+        # Flash one device at a time, so the stages don't overlap.
+        args.jobs = 1
+    _run_reported(reports, _main, args)
+
+
+def _main(args):
+    """
+    Runs uflash with the parsed command line arguments.
+    """
+    if args.watch or args.watch_path:
+        if args.low_memory:
+            # Generate the hex from scratch for each flash.
+            scheduler = _RebuildScheduler(
+                flash,
+                [args.source] if args.source else [],
+                args.quiet_period,
+                args=(args.source, args.target),
+                kwargs={"max_workers": args.jobs, "low_memory": True},
+            )
+        else:
+            scheduler = _RebuildScheduler(
+                _WatchFlasher(args.source, args.target, args.jobs),
+                [args.source] if args.source else [],
+                args.quiet_period,
+            )
+        try:
+            if args.watch_path:
+                if not args.source:
+                    raise ValueError("Please specify a file to flash")
+                _watch_paths([args.source] + args.watch_path, scheduler.notify)
+            else:
+                watch_file(args.source, scheduler.notify)
+        except Exception as ex:
+            error_message = "Error watching {source}: {error!s}"
+            print(
+                error_message.format(source=args.source, error=ex),
+                file=sys.stderr,
+            )
+            sys.exit(1)
+        finally:
+            scheduler.close()
+
+    else:
+        try:
+            flash(
+                path_to_python=args.source,
+                paths_to_microbits=args.target,
+                keepname=False,
+                max_workers=args.jobs,
+                low_memory=args.low_memory,
+            )
+        except Exception as ex:
+            error_message = "Error flashing {source} to {target}: {error!s}"
+            source = args.source
+            target = args.target if args.target else "microbit"
+            print(
+                error_message.format(source=source, target=target, error=ex),
+                file=sys.stderr,
+            )
+            sys.exit(1)
+
+
+def __getattr__(name):
+    """
+    Lazily resolves the _RUNTIME module attribute, so existing callers of
+    uflash._RUNTIME keep working without paying for the runtime on import.
+    Only used by Python 3.7 and later (PEP 562).
+    """
+    if name == "_RUNTIME":
+        return get_runtime()
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name)
+    )
+
+
+if sys.version_info < (3, 7):  # pragma: no cover
+    # No module level __getattr__ support, so load the runtime on import.
+    get_runtime()
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+"""
+Allows uflash to be run with "python -m uflash".
+"""
+import sys
+
+from uflash import main
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
@@ -0,0 +1,554 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for every stage of the uflash hex generation pipeline.
+
+Run them with "python -m uflash.bench" (or "make bench"), which prints the
+results as JSON: for each benchmark, the median and 95th percentile time of a
+call (in seconds), the peak memory allocated by a call (in bytes) and the
+timing samples taken.
+
+Given a previous report as a baseline with the --compare option, the
+benchmarks in it are run again and any regressions are reported (with a
+non-zero exit status), so it can be used as a CI gate.
+
+Copyright (c) 2015-2020 Nicholas H.Tollervey and others.
+
+See the LICENSE file for more information, or visit:
+
+https://opensource.org/licenses/MIT
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    # Python 2 and 3.3.
+    tracemalloc = None
+
+import uflash
+
+
+#: The micro:bit filesystems to benchmark, as (name, ID, start, end address).
+FILESYSTEMS = (
+    ("V1", uflash._MICROBIT_ID_V1, "_FS_START_ADDR_V1", "_FS_END_ADDR_V1"),
+    ("V2", uflash._MICROBIT_ID_V2, "_FS_START_ADDR_V2", "_FS_END_ADDR_V2"),
+)
+
+#: The sizes of the scripts in the py2hex corpus (plus the maximum size).
+CORPUS_SIZES = (1024, 4096, 8192, 16384)
+
+#: The default relative slowdown (or memory increase) taken as a regression,
+#: and the significance level the slowdown must reach.
+THRESHOLD = 0.2
+ALPHA = 0.01
+
+#: Script run in a new Python process to time "import uflash", printing the
+#: seconds it took or, if the first argument is "memory", the peak memory.
+IMPORT_SCRIPT = """
+import json, sys, timeit
+memory = sys.argv[1:] == ["memory"]
+if memory:
+    import tracemalloc
+    tracemalloc.start()
+start = timeit.default_timer()
+import uflash
+seconds = timeit.default_timer() - start
+print(json.dumps(tracemalloc.get_traced_memory()[1] if memory else seconds))
+"""
+
+
+def make_script(size):
+    """
+    Returns a Python script (in bytes format) of exactly size bytes.
+    """
+    line = b"display.scroll('Hello, World!')  # A line of MicroPython.\n"
+    return (line * (size // len(line) + 1))[:size]
+
+
+def max_script_size(microbit_version_id):
+    """
+    Returns the size of the largest script that fits in the filesystem of the
+    given micro:bit version.
+    """
+    for _, version_id, start, end in FILESYSTEMS:
+        if version_id == microbit_version_id:
+            fs_size = getattr(uflash, end) - getattr(uflash, start)
+            # Each 128 byte chunk holds 126 bytes of data, and the file header
+            # takes 9 bytes (plus 1 as the script must be less than the max).
+            return (fs_size // 128) * 126 - 10
+    raise ValueError("Unknown micro:bit ID: {}".format(microbit_version_id))
+
+
+def median(values):
+    """
+    Returns the median of the values.
+    """
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2
+
+
+def percentile(values, percent):
+    """
+    Returns the given percentile of the values (by the nearest rank method).
+    """
+    ordered = sorted(values)
+    rank = int(math.ceil(percent / 100 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+def peak_memory(func):
+    """
+    Returns the peak memory, in bytes, allocated during a call to func, or
+    None if tracemalloc isn't available.
+    """
+    if tracemalloc is None:  # pragma: no cover
+        return None
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def summarise(samples, memory):
+    """
+    Returns the result dictionary of a benchmark from its timing samples (in
+    seconds per call) and peak memory.
+    """
+    return {
+        "median": median(samples),
+        "p95": percentile(samples, 95),
+        "peak_memory": memory,
+        "samples": samples,
+    }
+
+
+def measure(func, repeat=20, number=1):
+    """
+    Times repeat samples of number calls to func (after a warm up call), and
+    then measures the peak memory of a separate call, so tracing memory
+    doesn't slow down the timed calls. Returns the benchmark result (see
+    summarise).
+    """
+    func()
+    samples = [
+        seconds / number
+        for seconds in timeit.repeat(func, repeat=repeat, number=number)
+    ]
+    return summarise(samples, peak_memory(func))
+
+
+def bench_import(repeat=20):
+    """
+    Times "import uflash" in new Python processes. Returns a list of (name,
+    result) tuples.
+    """
+    env = dict(os.environ)
+    package_root = os.path.dirname(os.path.dirname(uflash.__file__))
+    env["PYTHONPATH"] = os.pathsep.join(
+        [package_root] + [p for p in [env.get("PYTHONPATH")] if p]
+    )
+
+    def run(*args):
+        output = subprocess.check_output(
+            [sys.executable, "-c", IMPORT_SCRIPT] + list(args), env=env
+        )
+        return json.loads(output.decode("ascii"))
+
+    # Warm up, so the bytecode is compiled and the files are in the OS cache.
+    run()
+    samples = [run() for _ in range(repeat)]
+    memory = run("memory") if tracemalloc else None
+    return [("import uflash", summarise(samples, memory))]
+
+
+def bench_script_to_fs(repeat=20):
+    """
+    Times script_to_fs for 1 KB, 8 KB and maximum size scripts, for each of
+    the micro:bit filesystems. Returns a list of (name, result) tuples.
+    """
+    results = []
+    for name, version_id, _, _ in FILESYSTEMS:
+        max_size = max_script_size(version_id)
+        for label, size in (("1 KB", 1024), ("8 KB", 8192), ("max", max_size)):
+            script = make_script(size)
+            results.append(
+                (
+                    "script_to_fs {} {} ({} bytes)".format(name, label, size),
+                    measure(
+                        lambda: uflash.script_to_fs(script, version_id),
+                        repeat,
+                    ),
+                )
+            )
+    return results
+
+
+def bench_bytes_to_ihex(repeat=20):
+    """
+    Times bytes_to_ihex for 1 KB and 32 KB of data, as Intel Hex and
+    Universal Hex records. Returns a list of (name, result) tuples.
+    """
+    results = []
+    for label, universal in (("Intel Hex", False), ("Universal Hex", True)):
+        for size in (1024, 32768):
+            data = make_script(size)
+            results.append(
+                (
+                    "bytes_to_ihex {} ({} bytes)".format(label, size),
+                    measure(
+                        lambda: uflash.bytes_to_ihex(
+                            uflash._FS_START_ADDR_V1, data, universal
+                        ),
+                        repeat,
+                    ),
+                )
+            )
+    return results
+
+
+def bench_pad_hex_string(repeat=20):
+    """
+    Times pad_hex_string for the filesystem records of 1 KB and maximum size
+    scripts. Returns a list of (name, result) tuples.
+    """
+    results = []
+    version_id = uflash._MICROBIT_ID_V1
+    for size in (1024, max_script_size(version_id)):
+        fs_hex = uflash.script_to_fs(make_script(size), version_id)
+        results.append(
+            (
+                "pad_hex_string ({} bytes)".format(size),
+                measure(lambda: uflash.pad_hex_string(fs_hex), repeat),
+            )
+        )
+    return results
+
+
+def bench_embed_fs_uhex(repeat=20):
+    """
+    Times embed_fs_uhex into the runtime for 1 KB and the largest script that
+    fits both micro:bit versions. Returns a list of (name, result) tuples.
+    """
+    runtime = uflash.get_runtime()
+    results = []
+    for size in (1024, min(max_script_size(f[1]) for f in FILESYSTEMS)):
+        script = make_script(size)
+        results.append(
+            (
+                "embed_fs_uhex ({} bytes)".format(size),
+                measure(lambda: uflash.embed_fs_uhex(runtime, script), repeat),
+            )
+        )
+    return results
+
+
+def bench_save_hex(directory, repeat=20):
+    """
+    Times save_hex writing a hex file (as a string, as the chunks used by
+    flash and as streamed from the runtime image in low memory mode) into the
+    directory. Returns a list of (name, result) tuples.
+    """
+    script = make_script(1024)
+    hex_str = uflash.embed_fs_uhex(uflash.get_runtime(), script)
+    chunks = uflash._embed_fs_uhex_chunks(uflash._get_runtime_hex(), script)
+    path = os.path.join(directory, "micropython.hex")
+    return [
+        (
+            "save_hex (str)",
+            measure(lambda: uflash.save_hex(hex_str, path), repeat),
+        ),
+        (
+            "save_hex (chunks)",
+            measure(lambda: uflash.save_hex(chunks, path), repeat),
+        ),
+        (
+            "save_hex (low memory)",
+            measure(
+                lambda: uflash.save_hex(uflash._LowMemoryHex(script), path),
+                repeat,
+            ),
+        ),
+    ]
+
+
+def bench_py2hex(directory, repeat=20):
+    """
+    Times py2hex hexifying a corpus of scripts, from 1 KB to the maximum size,
+    into the directory (one script at a time, in this process). Returns a
+    list of (name, result) tuples.
+    """
+    sizes = list(CORPUS_SIZES) + [
+        min(max_script_size(f[1]) for f in FILESYSTEMS)
+    ]
+    corpus = os.path.join(directory, "corpus")
+    os.mkdir(corpus)
+    paths = []
+    for size in sizes:
+        paths.append(os.path.join(corpus, "script_{}.py".format(size)))
+        with open(paths[-1], "wb") as script:
+            script.write(make_script(size))
+    argv = paths + ["-o", directory, "-j", "1"]
+
+    def py2hex():
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            uflash.py2hex(argv=argv)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    # py2hex writes several hex files, so don't take as many samples.
+    return [
+        (
+            "py2hex corpus ({} scripts)".format(len(paths)),
+            measure(py2hex, max(1, repeat // 4)),
+        )
+    ]
+
+
+def mann_whitney_u(baseline, current):
+    """
+    Returns the p-value of a one-sided Mann-Whitney U test of the current
+    samples tending to be larger than the baseline samples. It uses the normal
+    approximation, with a correction for ties, so it needs no dependencies.
+    """
+    n1, n2 = len(baseline), len(current)
+    n = n1 + n2
+    if not (n1 and n2):
+        return 1.0
+    ranked = sorted(
+        [(value, 0) for value in baseline] + [(value, 1) for value in current]
+    )
+    rank_sum = 0.0
+    ties = 0
+    i = 0
+    while i < n:
+        j = i
+        while j + 1 < n and ranked[j + 1][0] == ranked[i][0]:
+            j += 1
+        # Tied values all get the average of their ranks.
+        rank = (i + j) / 2 + 1
+        rank_sum += rank * sum(group for _, group in ranked[i : j + 1])
+        ties += (j - i + 1) ** 3 - (j - i + 1)
+        i = j + 1
+    u = rank_sum - n2 * (n2 + 1) / 2
+    variance = n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1)))
+    if variance <= 0:
+        return 1.0
+    z = (u - n1 * n2 / 2 - 0.5) / math.sqrt(variance)
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def compare(baseline, report, threshold=THRESHOLD, alpha=ALPHA):
+    """
+    Compares the benchmarks of a report against those of a baseline report.
+    Returns a list with a (name, baseline result, result, p-value,
+    regressions) tuple for each benchmark in the baseline, where regressions
+    lists what got worse: "time", if the median time is more than threshold
+    slower with a p-value under alpha, and "memory", if the peak memory is
+    more than threshold larger. The result is None if it's not in the report.
+    """
+    comparisons = []
+    for name, base in sorted(baseline["benchmarks"].items()):
+        result = report["benchmarks"].get(name)
+        if result is None:
+            comparisons.append((name, base, None, None, []))
+            continue
+        p_value = mann_whitney_u(base["samples"], result["samples"])
+        regressions = []
+        if (
+            result["median"] > base["median"] * (1 + threshold)
+            and p_value < alpha
+        ):
+            regressions.append("time")
+        if (
+            base["peak_memory"] is not None
+            and result["peak_memory"] is not None
+            and result["peak_memory"] > base["peak_memory"] * (1 + threshold)
+        ):
+            regressions.append("memory")
+        comparisons.append((name, base, result, p_value, regressions))
+    return comparisons
+
+
+def print_comparison(comparisons):
+    """
+    Prints the comparisons (see compare) and returns True if there are any
+    regressions (or benchmarks missing).
+    """
+    failed = False
+    for name, base, result, p_value, regressions in comparisons:
+        if result is None:
+            failed = True
+            print("{:<44} MISSING".format(name))
+            continue
+        failed = failed or bool(regressions)
+        print(
+            "{:<44} {:>9.3f} ms -> {:>9.3f} ms ({:+6.1%}, p={:.3f}) {}".format(
+                name,
+                base["median"] * 1000,
+                result["median"] * 1000,
+                result["median"] / base["median"] - 1,
+                p_value,
+                " ".join(r.upper() for r in regressions) or "ok",
+            )
+        )
+    return failed
+
+
+def default_directory():
+    """
+    Returns the directory to write the benchmark files in, preferably in a
+    tmpfs so the storage speed doesn't get in the way.
+    """
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def run(repeat=20, directory=None, names=None):
+    """
+    Runs the benchmarks (only those with a name starting with one of the
+    given names, if any), writing files into a temporary directory created in
+    the given directory. Returns the report dictionary.
+
+    The in-process hex cache is disabled while they run, so the hex is always
+    generated.
+    """
+
+    def wanted(group):
+        return not names or any(
+            n.startswith(group) or group.startswith(n) for n in names
+        )
+
+    temp_dir = tempfile.mkdtemp(
+        prefix="uflash-bench-", dir=directory or default_directory()
+    )
+    cache = uflash.cache_info()
+    uflash.cache_configure(max_entries=0)
+    benchmarks = {}
+    try:
+        for group, bench in (
+            ("import uflash", bench_import),
+            ("script_to_fs", bench_script_to_fs),
+            ("bytes_to_ihex", bench_bytes_to_ihex),
+            ("pad_hex_string", bench_pad_hex_string),
+            ("embed_fs_uhex", bench_embed_fs_uhex),
+            ("save_hex", lambda repeat: bench_save_hex(temp_dir, repeat)),
+            ("py2hex", lambda repeat: bench_py2hex(temp_dir, repeat)),
+        ):
+            if not wanted(group):
+                continue
+            for name, result in bench(repeat):
+                if not names or any(name.startswith(n) for n in names):
+                    benchmarks[name] = result
+    finally:
+        uflash.cache_configure(cache["max_entries"], cache["max_size"])
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return {
+        "python": platform.python_version(),
+        "uflash": uflash.get_version(),
+        "benchmarks": benchmarks,
+    }
+
+
+def main(argv=None):
+    """
+    Entry point for "python -m uflash.bench", prints the benchmark report as
+    JSON (or writes it to a file).
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m uflash.bench",
+        description="Benchmark every stage of the uflash pipeline.",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=20,
+        help="Number of timing samples to take (default: %(default)s).",
+    )
+    parser.add_argument(
+        "-d",
+        "--directory",
+        default=None,
+        help="Directory to write the files in (default: a tmpfs if there is "
+        "one).",
+    )
+    parser.add_argument(
+        "-o", "--output", default=None, help="File to write the report to."
+    )
+    parser.add_argument(
+        "-c",
+        "--compare",
+        metavar="BASELINE",
+        default=None,
+        help="Run the benchmarks in this baseline report, and exit with an "
+        "error if any of them regressed.",
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        type=float,
+        default=THRESHOLD,
+        help="Relative slowdown, or memory increase, taken as a regression "
+        "when comparing (default: %(default)s).",
+    )
+    parser.add_argument(
+        "-a",
+        "--alpha",
+        type=float,
+        default=ALPHA,
+        help="Significance level a slowdown must reach to be a regression "
+        "(default: %(default)s).",
+    )
+    parser.add_argument(
+        "names",
+        nargs="*",
+        help="Only run the benchmarks with a name starting with one of these "
+        '(such as "script_to_fs V1" or save_hex).',
+    )
+    args = parser.parse_args(argv)
+    baseline = None
+    names = args.names
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        baseline["benchmarks"] = dict(
+            (name, result)
+            for name, result in baseline["benchmarks"].items()
+            if not names or any(name.startswith(n) for n in names)
+        )
+        names = list(baseline["benchmarks"])
+    report = run(args.repeat, args.directory, names)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(json.dumps(report, indent=2, sort_keys=True) + "\n")
+    elif baseline is None:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    if baseline is not None:
+        comparisons = compare(baseline, report, args.threshold, args.alpha)
+        if print_comparison(comparisons):
+            sys.exit(1)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])